@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from nano3d.bvh import BVH
+from nano3d.culling import frustum_planes
+
+
+SIZES = [10**4, 10**5, 10**6]
+
+
+def random_aabbs(n, seed=0):
+    rng = np.random.default_rng(seed)
+    lo = rng.uniform(-1000.0, 1000.0, (n, 3))
+    return np.stack((lo, lo + rng.uniform(0.1, 2.0, (n, 3))), axis=1)
+
+@pytest.mark.parametrize('n', SIZES)
+def bench_bvh_build(benchmark, n):
+    aabbs = random_aabbs(n)
+    benchmark(BVH, aabbs)
+
+@pytest.mark.parametrize('n', SIZES)
+def bench_bvh_refit_one_percent(benchmark, n):
+    aabbs = random_aabbs(n)
+    bvh = BVH(aabbs)
+    moved = np.arange(0, n, 100)
+    benchmark(bvh.refit, moved, aabbs[moved] + 1.0)
+
+@pytest.mark.parametrize('n', SIZES)
+def bench_bvh_query_aabb(benchmark, n):
+    bvh = BVH(random_aabbs(n))
+    benchmark(bvh.query_aabb, (-50.0, -50.0, -50.0), (50.0, 50.0, 50.0))
+
+@pytest.mark.parametrize('n', SIZES)
+def bench_bvh_query_frustum(benchmark, n):
+    bvh = BVH(random_aabbs(n))
+    fovy, near, far = np.pi/3., 0.1, 500.0
+    c = 1/np.tan(fovy/2)
+    projection = np.array([
+        [c,   0.0, 0.0,                   0.0                  ],
+        [0.0, c,   0.0,                   0.0                  ],
+        [0.0, 0.0, (far+near)/(near-far), 2*near*far/(near-far)],
+        [0.0, 0.0, -1.0,                  0.0                  ],
+    ])
+    benchmark(bvh.query_frustum, frustum_planes(projection))
+
+@pytest.mark.parametrize('n', SIZES)
+def bench_bvh_nearest(benchmark, n):
+    bvh = BVH(random_aabbs(n))
+    benchmark(bvh.nearest, (1.0, 2.0, 3.0))
+
+@pytest.mark.parametrize('n', SIZES)
+def bench_brute_force_query_aabb(benchmark, n):
+    '''Baseline: linear scan over all the boxes.'''
+    aabbs = random_aabbs(n)
+    lo, hi = np.full(3, -50.0), np.full(3, 50.0)
+    benchmark(lambda: np.flatnonzero(
+        np.all((aabbs[:, 0] <= hi) & (aabbs[:, 1] >= lo), axis=1)
+    ))
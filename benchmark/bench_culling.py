@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from nano3d.culling import frustum_mask, frustum_planes
+from nano3d.mesh import Mesh, Primitive
+from nano3d.picking import pick
+
+from bench_scene import SIZES, cubes
+
+
+@pytest.mark.parametrize('bvh', [False, True])
+@pytest.mark.parametrize('n', SIZES)
+def bench_frustum_mask(benchmark, n, bvh):
+    scene = cubes(n)
+    if bvh:
+        scene.build_bvh()
+    camera = scene.nodes[0]
+    planes = frustum_planes(
+        camera.projection_mat((800, 600)) @ camera.view_mat()
+    )
+    benchmark.extra_info['visible'] = int(frustum_mask(scene, planes).sum())
+    benchmark(frustum_mask, scene, planes)
+
+@pytest.mark.parametrize('bvh', [False, True])
+@pytest.mark.parametrize('n', SIZES)
+def bench_pick(benchmark, n, bvh):
+    '''Casts rays from the camera through random screen points.'''
+    # picking only considers triangles
+    quad = Mesh()
+    quad.primitive = Primitive.TRIANGLES
+    quad.positions = np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0]]).T
+    quad.indices = np.array([[0, 1, 2], [0, 2, 3]]).T
+    quad.no_indices = 2
+    scene = cubes(n, mesh=quad)
+    if bvh:
+        scene.build_bvh()
+    origin = np.array([0.0, 0.0, 100.0])
+    rng = np.random.default_rng(2)
+    directions = np.column_stack((
+        rng.uniform(-0.5, 0.5, (100, 2)), -np.ones(100)
+    ))
+
+    def cast():
+        return [pick(scene, origin, direction) for direction in directions]
+    benchmark(cast)
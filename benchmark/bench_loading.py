@@ -0,0 +1,71 @@
+import collada as co
+import numpy as np
+import pytest
+
+from nano3d.mesh import Dae
+from nano3d.meshcache import MeshCache
+from nano3d.meshopt import optimize
+
+
+SIZES = [32, 128, 512]  # 2*n*n triangles
+
+
+def write_dae(path, n):
+    '''Writes a collada file with a single (n x n) height field made of
+    2*n*n triangles with smooth per vertex normals.'''
+    x, z = np.meshgrid(np.arange(n + 1.0), np.arange(n + 1.0))
+    y = np.sin(0.1*x)*np.cos(0.1*z)
+    verts = np.stack((x.ravel(), y.ravel(), z.ravel()), axis=1)
+    normals = np.stack((
+        -0.1*np.cos(0.1*x)*np.cos(0.1*z), np.ones(x.shape),
+        0.1*np.sin(0.1*x)*np.sin(0.1*z),
+    ), axis=-1).reshape(-1, 3)
+    normals /= np.linalg.norm(normals, axis=1)[:, np.newaxis]
+    cells = np.arange((n + 1)*n).reshape(n, n + 1)[:, :-1].ravel()
+    tris = np.concatenate((
+        np.stack((cells, cells + n + 1, cells + 1), axis=1),
+        np.stack((cells + 1, cells + n + 1, cells + n + 2), axis=1),
+    ))
+    dae = co.Collada()
+    geom = co.geometry.Geometry(dae, 'geom', 'geom', [
+        co.source.FloatSource('verts', verts.ravel(), ('X', 'Y', 'Z')),
+        co.source.FloatSource('normals', normals.ravel(), ('X', 'Y', 'Z')),
+    ])
+    inputs = co.source.InputList()
+    inputs.addInput(0, 'VERTEX', '#verts')
+    inputs.addInput(1, 'NORMAL', '#normals')
+    indices = np.stack((tris, tris), axis=2).ravel()
+    geom.primitives.append(geom.createTriangleSet(indices, inputs, 'material'))
+    dae.geometries.append(geom)
+    node = co.scene.Node('node', children=[co.scene.GeometryNode(geom, [])])
+    scene = co.scene.Scene('scene', [node])
+    dae.scenes.append(scene)
+    dae.scene = scene
+    with open(str(path), 'wb') as f:
+        dae.write(f)
+    return path
+
+@pytest.fixture(scope='module')
+def dae_files(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('dae')
+    return {
+        n: str(write_dae(directory / 'grid{}.dae'.format(n), n)) for n in SIZES
+    }
+
+@pytest.mark.parametrize('n', SIZES)
+def bench_dae(benchmark, dae_files, n):
+    mesh = benchmark.pedantic(Dae, (dae_files[n],), rounds=3)
+    benchmark.extra_info.update(mesh.timings)
+
+@pytest.mark.parametrize('n', SIZES)
+def bench_dae_cached(benchmark, dae_files, n, tmp_path):
+    cache = MeshCache(tmp_path / 'cache')
+    Dae(dae_files[n], cache=cache)
+    benchmark(Dae, dae_files[n], cache=cache)
+
+@pytest.mark.parametrize('n', SIZES[:2])
+def bench_optimize(benchmark, dae_files, n):
+    '''The mesh optimization pipeline, see `meshopt.optimize()`.'''
+    def setup():
+        return (Dae(dae_files[n]),), {}
+    benchmark.pedantic(optimize, setup=setup, rounds=3)
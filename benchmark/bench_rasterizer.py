@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from nano3d.camera import CameraPerspective
+from nano3d.mesh import Mesh, Primitive
+from nano3d.rasterizer import SoftwareRenderer
+from nano3d.scene import CameraNode, Node, Scene
+
+from bench_scene import cubes
+
+
+WORKERS = [1, 2, 4, 8]
+SIZES = [(1920, 1080), (3840, 2160)]
+
+
+def terrain(n, seed=0):
+    '''A bumpy randomly colored n x n grid of quads facing the camera.'''
+    rng = np.random.default_rng(seed)
+    mesh = Mesh()
+    mesh.primitive = Primitive.TRIANGLES
+    x, y = np.meshgrid(np.linspace(-2.0, 2.0, n+1), np.linspace(-1.2, 1.2, n+1))
+    z = 0.05*rng.standard_normal(x.shape)
+    mesh.positions = np.stack((x.ravel(), y.ravel(), z.ravel()))
+    mesh.colors = rng.uniform(size=(4, x.size)).astype(np.float32)
+    cells = np.arange((n+1)*n).reshape(n, n+1)[:, :-1].ravel()
+    mesh.indices = np.concatenate((
+        np.stack((cells, cells + 1, cells + n + 2), axis=1),
+        np.stack((cells, cells + n + 2, cells + n + 1), axis=1),
+    )).T
+    return mesh
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('workers', WORKERS)
+def bench_rasterizer_workers(benchmark, size, workers):
+    scene = Scene('scene')
+    camera = CameraPerspective(aspect=size[0]/size[1])
+    scene.add_node(CameraNode(camera, 'cam', position=(0.0, 0.0, 2.5)))
+    scene.add_node(Node('terrain', terrain(100)))
+    renderer = SoftwareRenderer('r', scene, 'cam', size=size, workers=workers)
+    benchmark.extra_info['workers'] = workers
+    benchmark.pedantic(renderer.draw_handler, rounds=3, warmup_rounds=1)
+    renderer.close()
+
+@pytest.mark.parametrize('n', [10**2, 10**3, 10**4])
+def bench_frame(benchmark, n):
+    '''A whole headless frame of a scene of many small nodes: culling,
+    transforms and rasterization.'''
+    renderer = SoftwareRenderer('r', cubes(n), 'cam', size=(640, 480))
+    benchmark.pedantic(renderer.draw_handler, rounds=3, warmup_rounds=1)
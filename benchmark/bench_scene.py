@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from nano3d.camera import CameraPerspective
+from nano3d.mesh import CubeWired, Grid, InfiniteGrid, Line, Polyline
+from nano3d.scene import CameraNode, Node, Scene
+
+
+SIZES = [10**3, 10**4, 10**5]
+
+
+def cubes(n, seed=0, spread=100.0, mesh=None):
+    '''A scene with a camera looking down -z and `n` nodes sharing a mesh, a
+    `CubeWired` by default, at random positions in a box of side `spread`
+    in front of it.'''
+    rng = np.random.default_rng(seed)
+    scene = Scene('scene')
+    camera = CameraPerspective(aspect=4/3)
+    scene.add_node(CameraNode(camera, 'cam', position=(0.0, 0.0, spread)))
+    mesh = CubeWired() if mesh is None else mesh
+    positions = rng.uniform(-spread/2, spread/2, (n, 3))
+    for i, position in enumerate(positions):
+        scene.add_node(Node('node{}'.format(i), mesh, position=position))
+    return scene
+
+@pytest.mark.parametrize('n', SIZES)
+def bench_model_mat(benchmark, n):
+    '''Moves every node then gets its model matrix, one node at a time.'''
+    nodes = cubes(n).nodes[1:]
+    positions = np.random.default_rng(1).uniform(-1.0, 1.0, (n, 3))
+
+    def move():
+        for node, position in zip(nodes, positions):
+            node.position = position
+            node.model_mat()
+    benchmark(move)
+
+@pytest.mark.parametrize('n', SIZES)
+def bench_world_mats_one_percent(benchmark, n):
+    '''Moves 1% of the nodes then gets all the world matrices at once.'''
+    scene = cubes(n)
+    moved = scene.nodes[1::100]
+
+    def move():
+        for node in moved:
+            node.position = node.position + 0.01
+        return scene.world_mats()
+    benchmark(move)
+
+def bench_view_mat(benchmark):
+    '''Moves the camera then gets its view matrix.'''
+    camera = cubes(1).nodes[0]
+    positions = np.random.default_rng(1).uniform(-1.0, 1.0, (1000, 3))
+
+    def move():
+        for position in positions:
+            camera.position = position
+            camera.view_mat()
+    benchmark(move)
+
+@pytest.mark.parametrize('n', [10**3, 10**5, 10**6])
+def bench_grid(benchmark, n):
+    benchmark(Grid, n)
+
+@pytest.mark.parametrize('extent', [10, 100])
+def bench_infinite_grid(benchmark, extent):
+    # a camera flying over a large map, crossing a cell every 10 frames
+    grid = InfiniteGrid(extent=extent, levels=3)
+    eyes = np.column_stack((
+        np.linspace(0.0, 100.0, 1000), np.full(1000, 2.0), np.zeros(1000)
+    ))
+
+    def fly():
+        for eye in eyes:
+            grid.follow(eye)
+    benchmark(fly)
+
+@pytest.mark.parametrize('n', [10**3, 10**5, 10**6])
+def bench_line(benchmark, n):
+    t = np.linspace(0.0, 100.0, n)
+    positions = np.stack((np.cos(t), np.sin(t), t, np.ones(n)), axis=1)
+    benchmark(Line, positions)
+
+@pytest.mark.parametrize('n', [10**5, 10**7])
+def bench_polyline_decimate(benchmark, n):
+    t = np.linspace(0.0, 40.0*np.pi, n)
+    points = np.column_stack((np.cos(t), np.sin(t), np.zeros(n)))
+    line = Polyline(points*(t/t[-1])[:, np.newaxis])
+    mvp = np.eye(4)
+    sizes = iter(range(10**9))
+
+    def decimate():
+        # a new size every call, so that nothing is cached
+        line.decimate(mvp, (1024 + next(sizes) % 2, 768))
+    benchmark(decimate)
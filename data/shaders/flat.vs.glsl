@@ -8,11 +8,12 @@ uniform mat4 mvp;
 uniform vec3 lAmbColor;
 uniform vec3 lDiffColor;
 uniform vec3 lDirection;
+uniform vec4 tint;
 
 void main()
 {
     gl_Position = mvp * position;
     vec4 ambient = vec4(lAmbColor, 0.2);
     vec4 diffuse = vec4(max(dot(lDirection, -normal), 0) * lDiffColor, 0.2);
-    fColor = ambient + diffuse;
+    fColor = (ambient + diffuse) * tint;
 }
@@ -0,0 +1,241 @@
+import hashlib
+
+import numpy as np
+
+from nano3d.mesh import (
+    ChunkedMesh, DynamicMesh, InfiniteGrid, Mesh, Polyline,
+)
+from nano3d.resources import program_key
+from nano3d.scene import InstancedNode
+
+
+class StaticBatcher():
+    '''Merges the meshes of static nodes into a few large world space meshes,
+    so that thousands of small nodes are drawn with a handful of draw calls.
+
+    Nodes opt in with `node.static = True`. Static nodes are grouped by
+    everything a single draw call must share: shader sources, primitive,
+    attributes and uniforms. Each group is split into batches of at most
+    `max_vertices` vertices, and every batch is a `Mesh` with the vertices of
+    its members transformed to world space (normals by the inverse transpose
+    of the world matrix) and their indices offset.
+
+    `update()` keeps the batches in sync with the scene: only the batches
+    whose members moved, were removed or stopped being static are rebuilt,
+    and new static nodes are appended to the batches of their group. Changes
+    to the vertex data of member meshes are not tracked, call `rebuild()`
+    after modifying them.
+    '''
+    def __init__(self, scene, max_vertices=2**16):
+        '''
+        Parameters
+        ----------
+        scene: the `Scene` whose static nodes are batched.
+        max_vertices: the maximum number of vertices of a batch. Batches are
+            the unit of rebuilding, smaller ones make updates cheaper.
+        '''
+        self.scene = scene
+        self.max_vertices = max_vertices
+        self.rebuild()
+
+    def rebuild(self):
+        '''Rebuilds all the batches from scratch.'''
+        self.batches = []  # Batch objects, None for removed ones
+        self.members = {}  # node -> index of its batch
+        self._topology = None
+        self._rows = np.zeros(0, dtype=np.int64)  # store rows of the members
+        self._owners = np.zeros(0, dtype=np.int64)  # batch of each row above
+        self._stamps = np.zeros(0, dtype=np.int64)  # stamps they were built at
+        self._nodes = []  # the members, in the order of the arrays above
+        self.update()
+
+    def meshes(self):
+        '''Returns a list of (index, mesh) tuples with the batch meshes.'''
+        return [
+            (i, batch.mesh) for i, batch in enumerate(self.batches)
+            if batch is not None
+        ]
+
+    def update(self):
+        '''Brings the batches up to date with the scene. Returns the set of
+        indices of the batches that were rebuilt, created or removed (those
+        are None in `batches`), e.g: to re-upload their buffers.
+
+        Moved members are found by comparing world stamps, which is cheap.
+        Membership (nodes added, removed, or whose `static` or `visible` flag
+        changed) is re-evaluated with a pass over the members, and over all
+        the nodes only when the scene topology changed.
+        '''
+        store = self.scene.transforms
+        worlds = store.world_mats()  # brings world_stamps up to date
+        dirty = set()
+        for node in [node for node in self.members if not is_batchable(node)]:
+            dirty.add(self._remove(node))
+        reindex = bool(dirty) or self._topology != store.topology
+        if self._topology != store.topology:
+            for node in [n for n in self.members if n._store is not store]:
+                dirty.add(self._remove(node))
+            for node in self.scene.nodes:
+                if node not in self.members and is_batchable(node):
+                    dirty.add(self._insert(node))
+            self._topology = store.topology
+        if reindex:
+            self._index_rows()
+        if self._rows.size:
+            moved = store.world_stamps[self._rows] != self._stamps
+            dirty.update(np.unique(self._owners[moved]).tolist())
+        for i in dirty:
+            batch = self.batches[i]
+            if batch is not None and not batch.stamps:
+                self.batches[i] = None
+            elif batch is not None:
+                batch.build(worlds, store.world_stamps)
+        if dirty:
+            self._stamps = self._built_stamps()
+        return dirty
+
+    def _index_rows(self):
+        '''Refreshes the store rows of the members, which change when nodes
+        are added to or removed from the scene.'''
+        nodes = list(self.members)
+        self._rows = np.array([node._index for node in nodes], np.int64)
+        self._owners = np.array([self.members[n] for n in nodes], np.int64)
+        self._nodes = nodes
+        self._stamps = self._built_stamps()
+
+    def _built_stamps(self):
+        '''Returns the world stamps the members were merged at.'''
+        return np.array([
+            self.batches[self.members[node]].stamps[node]
+            for node in self._nodes
+        ], dtype=np.int64)
+
+    def _remove(self, node):
+        i = self.members.pop(node)
+        del self.batches[i].stamps[node]
+        del self.batches[i].counts[node]
+        return i
+
+    def _insert(self, node):
+        key = batch_key(node.mesh)
+        n = node.mesh.positions.shape[1]
+        for i, batch in enumerate(self.batches):
+            if batch is not None and batch.key == key \
+                    and batch.vertices() + n <= self.max_vertices:
+                break
+        else:
+            i = len(self.batches)
+            self.batches.append(Batch(key))
+        self.batches[i].counts[node] = n
+        self.batches[i].stamps[node] = -1  # not merged yet
+        self.members[node] = i
+        return i
+
+
+class Batch():
+    '''A group of static nodes merged into one world space mesh.'''
+    def __init__(self, key):
+        self.key = key
+        self.counts = {}  # member node -> number of vertices
+        self.stamps = {}  # member node -> world stamp it was merged at
+        self.mesh = None
+
+    def vertices(self):
+        return sum(self.counts.values())
+
+    def build(self, worlds, stamps):
+        '''Merges the member meshes given the (N, 4, 4) `worlds` matrices and
+        the `world_stamps` of the scene store.'''
+        nodes = list(self.counts)
+        self.mesh = merge_meshes(
+            [node.mesh for node in nodes],
+            [worlds[node._index] for node in nodes],
+        )
+        for node in nodes:
+            self.stamps[node] = stamps[node._index]
+
+
+def is_batchable(node):
+    '''Whether `node` is static, visible and has a regular mesh.'''
+    return (
+        node.static and node.visible
+        and node.mesh is not None and node.mesh.positions is not None
+        and node.mesh.indices is not None
+        and not isinstance(
+            node.mesh, (ChunkedMesh, DynamicMesh, InfiniteGrid, Polyline)
+        )
+        and not isinstance(node, InstancedNode)
+    )
+
+
+def batch_key(mesh):
+    '''Returns a key that is equal for meshes that can be drawn together:
+    same shader sources, primitive, attribute shapes and uniform values.'''
+    uniforms = hashlib.blake2b(digest_size=16)
+    for name in sorted(mesh.uniforms):
+        uniforms.update(name.encode())
+        uniforms.update(np.ascontiguousarray(mesh.uniforms[name]).tobytes())
+    attribs = tuple(sorted(
+        (name, np.shape(array)[0]) for name, array in mesh.attribs.items()
+    ))
+    arrays = tuple(
+        None if array is None else array.shape[0]
+        for array in [mesh.positions, mesh.normals, mesh.colors]
+    )
+    return (
+        program_key(mesh.material), mesh.primitive, attribs, arrays,
+        uniforms.hexdigest(),
+    )
+
+
+def merge_meshes(meshes, worlds):
+    '''Returns a `Mesh` with the geometry of all the `meshes` (sharing a
+    `batch_key()`) transformed by their `worlds` matrices: positions as
+    points, normals by the inverse transpose, colors and other attributes
+    are copied.'''
+    first = meshes[0]
+    merged = Mesh()
+    merged.primitive = first.primitive
+    merged.material = first.material
+    merged.uniforms = first.uniforms
+    counts = [mesh.positions.shape[1] for mesh in meshes]
+    offsets = np.cumsum([0] + counts[:-1])
+
+    def merge(arrays, transform=None):
+        parts = []
+        for array, world in zip(arrays, worlds):
+            array = np.asarray(array, dtype=np.float64)
+            if transform is not None:
+                array = transform(array, world)
+            parts.append(array)
+        return np.concatenate(parts, axis=1).astype(np.float32)
+
+    def points(array, world):
+        if array.shape[0] == 4:
+            return world @ array  # keeps points at infinity (w = 0), if any
+        return world[:3, :3] @ array + world[:3, 3:4]
+
+    def normals(array, world):
+        array = np.linalg.inv(world[:3, :3]).T @ array
+        return array / np.maximum(np.linalg.norm(array, axis=0), 1e-12)
+
+    merged.positions = merge([mesh.positions for mesh in meshes], points)
+    if first.normals is not None:
+        merged.normals = merge([mesh.normals for mesh in meshes], normals)
+    if first.colors is not None:
+        merged.colors = merge([mesh.colors for mesh in meshes])
+    merged.indices = np.concatenate([
+        np.asarray(mesh.indices)[:, :mesh.no_indices] + offset
+        for mesh, offset in zip(meshes, offsets)
+    ], axis=1).astype(np.int32)
+    merged.no_indices = merged.indices.shape[1]
+    standard = {
+        'position': merged.positions, 'normal': merged.normals,
+        'color': merged.colors,
+    }
+    merged.attribs = {
+        name: standard[name] if name in standard
+        else merge([mesh.attribs[name] for mesh in meshes])
+        for name in first.attribs
+    }
+    return merged
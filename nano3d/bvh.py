@@ -0,0 +1,292 @@
+import numpy as np
+
+from nano3d.culling import transform_aabbs
+
+
+class BVH():
+    '''A bounding volume hierarchy over a set of axis aligned boxes.
+
+    This is a linear BVH: primitives are sorted along a Morton (Z-order) curve
+    of their centers and grouped, in that order, into leaves of `leaf_size`
+    primitives. The leaves are the bottom level of a complete binary tree kept
+    in heap order (the children of node i are 2i+1 and 2i+2) in two arrays
+    with the min and max corners of every node. Building, refitting and
+    querying are all done level by level with NumPy, without any Python loop
+    over primitives or nodes.
+    '''
+    def __init__(self, aabbs, leaf_size=4):
+        '''
+        Parameters
+        ----------
+        aabbs: an (N, 2, 3) array with the min and max corners of the boxes.
+        leaf_size: the number of primitives per leaf.
+        '''
+        self.leaf_size = leaf_size
+        self.build(aabbs)
+
+    def __len__(self):
+        return self.aabbs.shape[0]
+
+    def build(self, aabbs):
+        '''Builds the hierarchy from scratch for the (N, 2, 3) `aabbs`.'''
+        self.aabbs = np.array(aabbs, dtype=np.float32).reshape(-1, 2, 3)
+        n = len(self)
+        self.order = np.argsort(morton_codes(self.aabbs), kind='stable')
+        n_leaves = max(1, -(-n // self.leaf_size))
+        self.depth = int(np.ceil(np.log2(n_leaves)))
+        n_leaves = 2**self.depth
+        # leaf slots hold primitive indices, -1 for padding
+        self.slots = np.full(n_leaves*self.leaf_size, -1, dtype=np.int64)
+        self.slots[:n] = self.order
+        self.leaf_of = np.empty(n, dtype=np.int64)
+        self.leaf_of[self.order] = np.arange(n) // self.leaf_size
+        self.lo = np.empty((2*n_leaves - 1, 3), dtype=np.float32)
+        self.hi = np.empty((2*n_leaves - 1, 3), dtype=np.float32)
+        self.refit()
+
+    def refit(self, indices=None, aabbs=None):
+        '''Updates the boxes of the nodes after primitives moved, keeping the
+        tree topology. Quality degrades if primitives move a lot, in which case
+        `build()` should be called again.
+
+        Parameters
+        ----------
+        indices: the indices of the primitives whose boxes changed, or None to
+            refit the whole tree.
+        aabbs: the new (len(indices), 2, 3) boxes of those primitives, if None
+            the boxes are assumed to have been updated in place in `aabbs`.
+        '''
+        first_leaf = 2**self.depth - 1
+        if indices is None:
+            leaves = np.arange(2**self.depth)
+        else:
+            indices = np.asarray(indices, dtype=np.int64)
+            if aabbs is not None:
+                self.aabbs[indices] = aabbs
+            leaves = np.unique(self.leaf_of[indices])
+        self._fit_leaves(leaves)
+        nodes = leaves + first_leaf
+        for _ in range(self.depth):
+            nodes = np.unique((nodes - 1) // 2)
+            self.lo[nodes] = np.minimum(
+                self.lo[2*nodes + 1], self.lo[2*nodes + 2]
+            )
+            self.hi[nodes] = np.maximum(
+                self.hi[2*nodes + 1], self.hi[2*nodes + 2]
+            )
+
+    def _fit_leaves(self, leaves):
+        nodes = leaves + 2**self.depth - 1
+        if len(self) == 0:
+            self.lo[nodes], self.hi[nodes] = np.inf, -np.inf
+            return
+        slots = self.slots.reshape(-1, self.leaf_size)[leaves]
+        valid = slots >= 0
+        boxes = self.aabbs[np.where(valid, slots, 0)]  # (L, leaf_size, 2, 3)
+        lo = np.where(valid[..., np.newaxis], boxes[:, :, 0], np.inf)
+        hi = np.where(valid[..., np.newaxis], boxes[:, :, 1], -np.inf)
+        self.lo[nodes] = lo.min(axis=1)
+        self.hi[nodes] = hi.max(axis=1)
+
+    def _traverse(self, test):
+        '''Returns the indices of the primitives accepted by `test`, a
+        function of (lo, hi) arrays returning a boolean mask, descending only
+        into the nodes accepted by it.'''
+        frontier = np.zeros(1, dtype=np.int64)
+        for _ in range(self.depth):
+            frontier = self._accept(frontier, test)
+            frontier = np.stack((2*frontier + 1, 2*frontier + 2), axis=1)
+            frontier = frontier.ravel()
+        leaves = self._accept(frontier, test) - (2**self.depth - 1)
+        prims = self.slots.reshape(-1, self.leaf_size)[leaves].ravel()
+        prims = prims[prims >= 0]
+        boxes = self.aabbs[prims]
+        return np.sort(prims[test(boxes[:, 0], boxes[:, 1])])
+
+    def _accept(self, nodes, test):
+        lo, hi = self.lo[nodes], self.hi[nodes]
+        nonempty = lo[:, 0] <= hi[:, 0]
+        with np.errstate(invalid='ignore'):
+            return nodes[nonempty & test(lo, hi)]
+
+    def query_aabb(self, lo, hi):
+        '''Returns the indices of the primitives whose boxes intersect the box
+        with min and max corners `lo` and `hi`.'''
+        lo, hi = np.asarray(lo), np.asarray(hi)
+        return self._traverse(
+            lambda blo, bhi: np.all((blo <= hi) & (bhi >= lo), axis=1)
+        )
+
+    def query_sphere(self, center, radius):
+        '''Returns the indices of the primitives whose boxes are at most
+        `radius` away from `center`.'''
+        center = np.asarray(center)
+        return self._traverse(
+            lambda lo, hi: _min_dist2(center, lo, hi) <= radius**2
+        )
+
+    def query_frustum(self, planes):
+        '''Returns the indices of the primitives whose boxes intersect the
+        frustum defined by the (6, 4) `planes`, see `culling.frustum_planes`.
+        '''
+        normals, offsets = planes[:, :3], planes[:, 3]
+
+        def test(lo, hi):
+            center, extent = 0.5*(lo + hi), 0.5*(hi - lo)
+            dist = center @ normals.T + offsets
+            return np.all(dist + extent @ np.abs(normals).T >= 0.0, axis=1)
+        return self._traverse(test)
+
+    def query_ray(self, origin, direction, tmax=np.inf):
+        '''Returns a tuple (indices, tnear) with the primitives whose boxes are
+        hit by the ray `origin + t*direction`, for 0 <= t <= tmax, sorted by
+        the distance `tnear` at which the ray enters each box.'''
+        def test(lo, hi):
+            tnear, tfar = ray_aabbs(origin, direction, lo, hi, tmax)
+            return tnear <= tfar
+        prims = self._traverse(test)
+        tnear, _ = ray_aabbs(
+            origin, direction, self.aabbs[prims, 0], self.aabbs[prims, 1], tmax
+        )
+        order = np.argsort(tnear, kind='stable')
+        return prims[order], tnear[order]
+
+    def nearest(self, point):
+        '''Returns a tuple (index, distance) with the primitive whose box is
+        closest to `point`, or (-1, inf) if the hierarchy is empty.'''
+        point = np.asarray(point)
+        if len(self) == 0:
+            return -1, np.inf
+        bound = [np.inf]
+
+        def test(lo, hi):
+            # every non empty node holds a primitive that is no further than
+            # the farthest corner of the node
+            far = np.maximum(np.abs(lo - point), np.abs(hi - point))
+            bound[0] = min(bound[0], np.min(np.sum(far**2, axis=1)))
+            return _min_dist2(point, lo, hi) <= bound[0]
+        prims = self._traverse(test)
+        dist2 = _min_dist2(point, self.aabbs[prims, 0], self.aabbs[prims, 1])
+        best = np.argmin(dist2)
+        return int(prims[best]), float(np.sqrt(dist2[best]))
+
+
+def ray_aabbs(origin, direction, lo, hi, tmax=np.inf):
+    '''Slab test of the ray `origin + t*direction`, 0 <= t <= tmax, against
+    the boxes with corners `lo` and `hi`. Returns a tuple (tnear, tfar) of
+    arrays, the ray hits a box where tnear <= tfar.'''
+    origin = np.asarray(origin, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv = 1.0 / np.asarray(direction, dtype=np.float64)
+        t0, t1 = (lo - origin)*inv, (hi - origin)*inv
+        tnear = np.nanmax(np.minimum(t0, t1), axis=1)
+        tfar = np.nanmin(np.maximum(t0, t1), axis=1)
+    return np.maximum(tnear, 0.0), np.minimum(tfar, tmax)
+
+
+def _min_dist2(point, lo, hi):
+    '''Squared distance from `point` to the boxes with corners `lo`, `hi`.'''
+    delta = np.maximum(np.maximum(lo - point, point - hi), 0.0)
+    return np.sum(delta**2, axis=1)
+
+
+def morton_codes(aabbs):
+    '''Returns the 30-bit Morton codes of the centers of the (N, 2, 3) boxes
+    `aabbs`, quantized to 10 bits per axis within their common bounds.'''
+    centers = 0.5*(aabbs[:, 0] + aabbs[:, 1]).astype(np.float64)
+    if centers.shape[0] == 0:
+        return np.zeros(0, dtype=np.uint32)
+    lo, hi = centers.min(axis=0), centers.max(axis=0)
+    extent = np.where(hi > lo, hi - lo, 1.0)
+    cells = ((centers - lo) / extent * 1023.0).astype(np.uint32)
+    codes = np.zeros(centers.shape[0], dtype=np.uint32)
+    for axis in range(3):
+        codes |= _spread_bits(cells[:, axis]) << np.uint32(2 - axis)
+    return codes
+
+
+def _spread_bits(v):
+    '''Inserts two zero bits between each of the 10 lower bits of `v`.'''
+    v = v.astype(np.uint32)
+    v = (v * np.uint32(0x00010001)) & np.uint32(0xFF0000FF)
+    v = (v * np.uint32(0x00000101)) & np.uint32(0x0F00F00F)
+    v = (v * np.uint32(0x00000011)) & np.uint32(0xC30C30C3)
+    v = (v * np.uint32(0x00000005)) & np.uint32(0x49249249)
+    return v
+
+
+class SceneBVH():
+    '''A BVH over the world space bounding boxes of the nodes of a scene that
+    have geometry. Queries return row indices into `scene.nodes`.
+
+    `update()` refits the boxes of the nodes whose world matrix changed since
+    the last call and rebuilds the tree when nodes were added, removed or
+    reparented. Changes to mesh positions are not tracked, call `rebuild()`
+    after modifying the geometry of a mesh.
+    '''
+    def __init__(self, scene, leaf_size=4):
+        self.scene = scene
+        self.leaf_size = leaf_size
+        self.rebuild()
+
+    def rebuild(self):
+        '''Rebuilds the tree from scratch.'''
+        store = self.scene.transforms
+        rows, unbounded, aabbs = [], [], []
+        for i, node in enumerate(store.nodes):
+            if node.mesh is None:
+                continue
+            aabb = node.aabb()
+            if aabb is None:
+                unbounded.append(i)
+            else:
+                rows.append(i)
+                aabbs.append(aabb)
+        self.rows = np.array(rows, dtype=np.int64)
+        self.unbounded = np.array(unbounded, dtype=np.int64)
+        self.local_aabbs = np.array(aabbs, dtype=np.float32).reshape(-1, 2, 3)
+        worlds = store.world_mats()[self.rows]
+        self.bvh = BVH(
+            transform_aabbs(self.local_aabbs, worlds), self.leaf_size
+        )
+        self._topology = store.topology
+        self._stamps = store.world_stamps[self.rows].copy()
+
+    def update(self):
+        '''Brings the tree up to date with the scene.'''
+        store = self.scene.transforms
+        if store.topology != self._topology:
+            self.rebuild()
+            return
+        worlds = store.world_mats()
+        stamps = store.world_stamps[self.rows]
+        moved = np.flatnonzero(stamps != self._stamps)
+        if moved.size:
+            self.bvh.refit(moved, transform_aabbs(
+                self.local_aabbs[moved], worlds[self.rows[moved]]
+            ))
+            self._stamps[moved] = stamps[moved]
+
+    def query_aabb(self, lo, hi):
+        '''Returns the rows of the nodes intersecting the box [lo, hi].'''
+        return self.rows[self.bvh.query_aabb(lo, hi)]
+
+    def query_sphere(self, center, radius):
+        '''Returns the rows of the nodes at most `radius` away from `center`.'''
+        return self.rows[self.bvh.query_sphere(center, radius)]
+
+    def query_frustum(self, planes):
+        '''Returns the rows of the nodes intersecting the frustum `planes`.'''
+        return self.rows[self.bvh.query_frustum(planes)]
+
+    def query_ray(self, origin, direction, tmax=np.inf):
+        '''Returns a tuple (rows, tnear) with the nodes whose bounds are hit by
+        the ray, sorted by distance.'''
+        prims, tnear = self.bvh.query_ray(origin, direction, tmax)
+        return self.rows[prims], tnear
+
+    def nearest(self, point):
+        '''Returns a tuple (row, distance) with the node closest to `point`,
+        or (-1, inf) if there is none.'''
+        prim, dist = self.bvh.nearest(point)
+        return (int(self.rows[prim]) if prim >= 0 else -1), dist
@@ -0,0 +1,100 @@
+import numpy as np
+
+
+def frustum_planes(mat):
+    '''Returns a (6, 4) array with the left, right, bottom, top, near and far
+    planes of the frustum defined by the clip matrix `mat`, i.e:
+    projection @ view (@ model). Each plane (a, b, c, d) is normalized so that
+    a*x + b*y + c*z + d is the signed distance of a point to the plane, which
+    is positive inside the frustum.
+    '''
+    mat = np.asarray(mat, dtype=np.float64)
+    planes = np.array([
+        mat[3] + mat[0], mat[3] - mat[0],
+        mat[3] + mat[1], mat[3] - mat[1],
+        mat[3] + mat[2], mat[3] - mat[2],
+    ])
+    return planes / np.linalg.norm(planes[:, :3], axis=1)[:, np.newaxis]
+
+
+def transform_aabbs(aabbs, mats):
+    '''Returns an (N, 2, 3) array with the world space axis aligned bounding
+    boxes enclosing the (N, 2, 3) model space boxes `aabbs` transformed by the
+    (N, 4, 4) matrices `mats`.
+    '''
+    center = 0.5*(aabbs[:, 0] + aabbs[:, 1])
+    extent = 0.5*(aabbs[:, 1] - aabbs[:, 0])
+    lin = mats[:, :-1, :-1]
+    wcenter = np.einsum('nij,nj->ni', lin, center) + mats[:, :-1, -1]
+    wextent = np.einsum('nij,nj->ni', np.abs(lin), extent)
+    return np.stack((wcenter - wextent, wcenter + wextent), axis=1)
+
+
+def aabbs_in_frustum(planes, aabbs):
+    '''Returns a boolean (N,) array telling which of the (N, 2, 3) boxes
+    `aabbs` intersect, or are inside, the frustum defined by the (6, 4)
+    `planes`. The test is conservative: boxes close to a frustum corner may be
+    reported visible even though they are outside.
+    '''
+    center = 0.5*(aabbs[:, 0] + aabbs[:, 1])
+    extent = 0.5*(aabbs[:, 1] - aabbs[:, 0])
+    dist = center @ planes[:, :3].T + planes[:, 3]   # (N, 6)
+    radius = extent @ np.abs(planes[:, :3]).T        # (N, 6)
+    return np.all(dist + radius >= 0.0, axis=1)
+
+
+def visibility_mask(scene, camera_node, projection):
+    '''Returns a boolean array, aligned with `scene.nodes`, telling which
+    nodes should be drawn: nodes with a mesh, flagged visible and whose world
+    space bounding box intersects the camera frustum. Meshes without positions
+    have no bounds and are never culled. If the scene has a BVH (see
+    `Scene.build_bvh()`) it is brought up to date and queried instead of
+    testing every node.
+
+    Parameters
+    ----------
+    scene: the `Scene` to cull.
+    camera_node: the `CameraNode` the scene is seen from.
+    projection: the 4x4 projection matrix of the camera.
+    '''
+    return frustum_mask(
+        scene, frustum_planes(projection @ camera_node.view_mat())
+    )
+
+
+def frustum_mask(scene, planes):
+    '''Same as `visibility_mask()` for a frustum given by its (6, 4)
+    `planes`, see `frustum_planes()`.'''
+    nodes = scene.nodes
+    mask = np.zeros(len(nodes), dtype=bool)
+    if scene.bvh is not None:
+        scene.bvh.update()
+        rows = np.concatenate((
+            scene.bvh.query_frustum(planes), scene.bvh.unbounded
+        ))
+        mask[[row for row in rows if nodes[row].visible]] = True
+        return mask
+    rows, aabbs = [], []
+    for i, node in enumerate(nodes):
+        if node.mesh is None or not node.visible:
+            continue
+        aabb = node.aabb()
+        if aabb is None:
+            mask[i] = True
+            continue
+        rows.append(i)
+        aabbs.append(aabb)
+    if rows:
+        rows = np.array(rows)
+        worlds = scene.world_mats()[rows]
+        mask[rows] = aabbs_in_frustum(
+            planes, transform_aabbs(np.array(aabbs), worlds)
+        )
+    return mask
+
+
+def visible_nodes(scene, camera_node, projection):
+    '''Returns the list of nodes of `scene` that survive frustum culling, see
+    `visibility_mask()`.'''
+    mask = visibility_mask(scene, camera_node, projection)
+    return [node for node, visible in zip(scene.nodes, mask) if visible]
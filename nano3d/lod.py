@@ -0,0 +1,153 @@
+import numpy as np
+
+from nano3d.mesh import BadPrimitiveError, Mesh, Primitive
+
+
+class LODChain():
+    '''Levels of detail of a TRIANGLES mesh, from the mesh itself (level 0)
+    to coarser and coarser simplifications, see `simplify()`.
+
+    Level k > 0 clusters vertices in a grid of cells `diagonal/resolution *
+    2**(k-1)` wide, so each level has about a quarter of the vertices of the
+    previous one for surface meshes. The geometric error of a level is
+    bounded by the diagonal of its cells, which `select()` projects to the
+    screen to pick the coarsest level whose error stays under a pixel budget.
+    '''
+    def __init__(self, mesh, levels=4, resolution=64, min_triangles=16):
+        '''
+        Parameters
+        ----------
+        mesh: the full resolution TRIANGLES `Mesh`.
+        levels: the maximum number of levels, the full mesh included.
+        resolution: the number of cells along the bounding box diagonal of
+            the first simplified level.
+        min_triangles: levels stop before going below this many triangles.
+
+        Raises
+        ------
+        BadPrimitiveError: if the mesh is not made of triangles.
+        '''
+        if mesh.primitive != Primitive.TRIANGLES:
+            raise BadPrimitiveError()
+        self.meshes = [mesh]
+        self.positions = mesh.positions  # the positions the levels come from
+        self.errors = [0.0]  # model space geometric error of each level
+        aabb = mesh.aabb()
+        diagonal = 0.0
+        if aabb is not None:
+            diagonal = float(np.linalg.norm(aabb[1] - aabb[0]))
+        cell = diagonal/resolution
+        while len(self.meshes) < levels and diagonal > 0.0:
+            coarse = simplify(mesh, cell)
+            if coarse.no_indices < min_triangles \
+                    or coarse.no_indices >= self.meshes[-1].no_indices:
+                break
+            self.meshes.append(coarse)
+            self.errors.append(cell*np.sqrt(3.0))
+            cell *= 2.0
+        self.errors = np.array(self.errors)
+
+    def __len__(self):
+        return len(self.meshes)
+
+    def select(self, world, view, projection, height, max_error=1.0):
+        '''Returns the index of the coarsest level whose error, projected on
+        the screen, is at most `max_error` pixels.
+
+        Parameters
+        ----------
+        world: the 4x4 world matrix of the node.
+        view, projection: the camera view and projection matrices, the
+            projection gives the field of view (perspective) or the view
+            height (orthographic).
+        height: the viewport height in pixels.
+        max_error: the error budget in pixels.
+        '''
+        ppu = pixels_per_unit(self.meshes[0], world, view, projection, height)
+        if not np.isfinite(ppu):
+            return 0  # the camera is inside the mesh
+        errors = np.where(self.errors == 0.0, 0.0, self.errors*ppu)
+        level = np.searchsorted(errors, max_error, side='right') - 1
+        return max(int(level), 0)
+
+
+def pixels_per_unit(mesh, world, view, projection, height):
+    '''Returns how many pixels a model space unit of `mesh` covers on the
+    screen, at the point of its bounding sphere nearest to the camera.'''
+    center, radius = mesh.bounding_sphere()
+    scale = np.linalg.norm(world[:3, :3], axis=0).max()
+    pixels = 0.5*height*abs(projection[1, 1])*scale
+    if projection[3, 2] == 0.0:
+        return pixels  # orthographic, no foreshortening
+    eye = view @ world @ np.append(center, 1.0)
+    distance = -eye[2] - radius*scale
+    if distance <= 0.0:
+        return np.inf  # the camera is inside the bounding sphere
+    return pixels/distance
+
+
+def simplify(mesh, cell_size):
+    '''Returns a simplified copy of a TRIANGLES `mesh` using vertex
+    clustering: vertices are grouped by the cell of a grid of `cell_size`
+    they fall in and replaced by their mean (normals and colors too),
+    triangles collapsing to an edge or a point are dropped, as well as
+    duplicates.'''
+    positions = np.asarray(mesh.positions, dtype=np.float64)
+    xyz = positions[:3].T
+    cells = np.floor((xyz - xyz.min(axis=0))/cell_size).astype(np.int64)
+    dims = cells.max(axis=0) + 1
+    keys = (cells[:, 0]*dims[1] + cells[:, 1])*dims[2] + cells[:, 2]
+    _, cluster = np.unique(keys, return_inverse=True)
+
+    triangles = cluster[np.asarray(mesh.indices)[:, :mesh.no_indices].T]
+    t0, t1, t2 = triangles.T
+    triangles = triangles[(t0 != t1) & (t1 != t2) & (t2 != t0)]
+    _, first = np.unique(np.sort(triangles, axis=1), axis=0, return_index=True)
+    triangles = triangles[np.sort(first)]
+
+    # keep only the clusters still referenced by a triangle
+    used, remap = np.unique(triangles, return_inverse=True)
+    lookup = np.full(cluster.max() + 1, -1, dtype=np.int64)
+    lookup[used] = np.arange(used.size)
+    cluster = lookup[cluster]
+    keep = cluster >= 0
+    cluster, m = cluster[keep], used.size
+
+    def average(array):
+        array = np.asarray(array, dtype=np.float64)[:, keep]
+        sums = np.stack([
+            np.bincount(cluster, weights=row, minlength=m) for row in array
+        ])
+        return sums/np.bincount(cluster, minlength=m)
+
+    simple = Mesh()
+    simple.primitive = Primitive.TRIANGLES
+    simple.material = mesh.material
+    simple.uniforms = mesh.uniforms
+    simple.positions = average(positions).astype(np.float32)
+    if mesh.normals is not None:
+        normals = average(mesh.normals)
+        normals /= np.maximum(np.linalg.norm(normals, axis=0), 1e-12)
+        simple.normals = normals.astype(np.float32)
+    if mesh.colors is not None:
+        simple.colors = average(mesh.colors).astype(np.float32)
+    simple.indices = remap.reshape(-1, 3).T.astype(np.int32)
+    simple.no_indices = simple.indices.shape[1]
+    arrays = {
+        'position': simple.positions, 'normal': simple.normals,
+        'color': simple.colors,
+    }
+    simple.attribs = {
+        name: arrays[name] for name in mesh.attribs if name in arrays
+    }
+    return simple
+
+
+def lod_chain(mesh, **kwargs):
+    '''Returns the `LODChain` of `mesh`, built on the first call and cached
+    on the mesh afterwards (until its positions are set again).'''
+    chain = getattr(mesh, '_lod_chain', None)
+    if chain is None or chain.positions is not mesh.positions:
+        chain = LODChain(mesh, **kwargs)
+        mesh._lod_chain = chain
+    return chain
@@ -12,8 +12,9 @@ class Material():
             in vec4 color;
             out vec4 fColor;
             uniform mat4 mvp;
+            uniform vec4 tint;
             void main(void) {
-                fColor = color;
+                fColor = color * tint;
                 gl_Position = mvp * position;
             }
         '''
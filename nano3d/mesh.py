@@ -1,12 +1,16 @@
 
+from collections import OrderedDict, deque
 from enum import Enum
 import errno
 import os
 from pathlib import Path
+import time
 
 import collada as co
 import numpy as np
 
+from nano3d.bvh import BVH
+from nano3d.culling import aabbs_in_frustum, frustum_planes
 from nano3d.material import Material
 
 class Primitive(Enum):
@@ -15,6 +19,19 @@ class Primitive(Enum):
     TRIANGLES = 3
 
 class Mesh():
+    '''Vertex data of a drawable object.
+
+    Per-vertex arrays (positions, normals, colors) are stored with one vertex
+    per column, i.e: (components, N), and indices with one primitive per
+    column. The setters only convert when needed: an array that already has
+    the right dtype and is contiguous, in either C or Fortran order, is
+    stored as it is, without a copy. Objects exporting a buffer of the right
+    type (memoryview, array.array, ...) are wrapped without a copy too, see
+    also `set_buffer()` for untyped buffers.
+
+    The vertex layout is either planar, one array per attribute, or
+    interleaved, see `interleave()`.
+    '''
     def __init__(self):
         # vertex data
         self._positions = None
@@ -22,6 +39,9 @@ class Mesh():
         self._normals = None
         self._colors = None
         self._primitive = None # one of: {Primitive.POINTS/LINES/TRIANGLES}
+        self._aabb = None
+        self._triangle_bvh = None
+        self.vertices = None  # (N, stride) array in the interleaved layout
         self.no_indices = None
         self.material = Material('base')
         self.attribs = {}
@@ -33,7 +53,9 @@ class Mesh():
 
     @positions.setter
     def positions(self, value):
-        self._positions = np.array(value, dtype=np.float32)
+        self._set_vertex_array('positions', value)
+        self._aabb = None  # bounds are recomputed on demand
+        self._triangle_bvh = None
 
     @property
     def indices(self):
@@ -41,7 +63,10 @@ class Mesh():
 
     @indices.setter
     def indices(self, value):
-        self._indices = np.array(value, dtype=np.int32)
+        # uint16 indices are kept as they are, see `meshopt.narrow_indices()`
+        value = np.asarray(value)
+        dtype = np.uint16 if value.dtype == np.uint16 else np.int32
+        self._indices = as_array(value, dtype)
 
     @property
     def normals(self):
@@ -49,7 +74,7 @@ class Mesh():
 
     @normals.setter
     def normals(self, value):
-        self._normals = np.array(value, dtype=np.float32)
+        self._set_vertex_array('normals', value)
 
     @property
     def colors(self):
@@ -57,7 +82,130 @@ class Mesh():
 
     @colors.setter
     def colors(self, value):
-        self._colors = np.array(value, dtype=np.float32)
+        self._set_vertex_array('colors', value)
+
+    def _set_vertex_array(self, name, value):
+        current = getattr(self, '_' + name)
+        if self.vertices is not None and current is not None:
+            value = np.asarray(value, dtype=np.float32)
+            others = {'positions', 'normals', 'colors'} - {name}
+            aliased = any(
+                getattr(self, '_' + other) is current for other in others
+            )
+            if value.shape == current.shape and not aliased:
+                current[...] = value  # write into the interleaved buffer
+                return
+            self.planarize()
+        setattr(self, '_' + name, as_array(value, np.float32))
+
+    def set_buffer(self, name, buffer, components, dtype=np.float32):
+        '''Assigns the vertex array `name` (e.g: 'positions') from an object
+        exposing the buffer protocol, such as bytes, bytearray or a ctypes
+        array, holding `components` values of `dtype` per vertex. The buffer
+        is wrapped, not copied, and must stay alive as long as the mesh.'''
+        array = np.frombuffer(buffer, dtype=dtype).reshape(-1, components)
+        setattr(self, name, array.T)
+
+    @property
+    def layout(self):
+        '''Either 'planar' or 'interleaved'.'''
+        return 'planar' if self.vertices is None else 'interleaved'
+
+    def interleave(self):
+        '''Switches to the interleaved layout: positions, normals and colors
+        are packed side by side in the rows of a single (N, stride) float32
+        `vertices` array, a single strided vertex buffer, and become views
+        into it. Attribs referencing the old arrays are updated.'''
+        if self.vertices is not None:
+            return
+        names = [
+            name for name in ['positions', 'normals', 'colors']
+            if getattr(self, name) is not None
+        ]
+        arrays = [getattr(self, name) for name in names]
+        # attributes may alias the same array (e.g: CubeWired colors), which
+        # is packed only once
+        unique = list({id(array): array for array in arrays}.values())
+        stride = sum(array.shape[0] for array in unique)
+        self.vertices = np.empty((unique[0].shape[1], stride), np.float32)
+        views, offset = {}, 0
+        for array in unique:
+            width = array.shape[0]
+            self.vertices[:, offset:offset+width] = array.T
+            views[id(array)] = self.vertices[:, offset:offset+width].T
+            offset += width
+        for name, array in zip(names, arrays):
+            setattr(self, '_' + name, views[id(array)])
+        self._rebind_attribs(views)
+
+    def planarize(self):
+        '''Switches to the planar layout: every attribute gets an array of its
+        own, with one vertex per column. Attribs are updated.'''
+        if self.vertices is None:
+            return
+        names = [
+            name for name in ['positions', 'normals', 'colors']
+            if getattr(self, name) is not None
+        ]
+        arrays = [getattr(self, name) for name in names]
+        copies = {id(array): np.asfortranarray(array) for array in arrays}
+        for name, array in zip(names, arrays):
+            setattr(self, '_' + name, copies[id(array)])
+        self.vertices = None
+        self._rebind_attribs(copies)
+
+    def _rebind_attribs(self, new):
+        '''Replaces attribs by `new`, a dict of id(old array) to array.'''
+        for key, array in self.attribs.items():
+            self.attribs[key] = new.get(id(array), array)
+
+    def aabb(self):
+        '''Returns a (2, 3) array with the min and max corners of the axis
+        aligned bounding box of the vertex positions, in model space. The box
+        is cached until positions are set again. Returns None if the mesh has
+        no positions, or is unbounded: it has points at infinity (w = 0), e.g:
+        a `Grid`.'''
+        if self._aabb is None:
+            if self.positions is None or self.positions.size == 0:
+                return None
+            if self.positions.shape[0] == 4 and not self.positions[3].all():
+                return None
+            xyz = self.positions[:3]  # positions are stored as columns
+            self._aabb = np.array(
+                [xyz.min(axis=1), xyz.max(axis=1)], dtype=np.float32
+            )
+        return self._aabb
+
+    def bounding_sphere(self):
+        '''Returns a tuple (center, radius) with a sphere enclosing the
+        axis aligned bounding box, in model space, or None if the mesh has no
+        positions.'''
+        aabb = self.aabb()
+        if aabb is None:
+            return None
+        center = 0.5*(aabb[0] + aabb[1])
+        return center, float(np.linalg.norm(aabb[1] - center))
+
+    def triangles(self, which=None):
+        '''Returns an (M, 3, 3) array with the model space corners of the
+        triangles of a TRIANGLES mesh, either all of them or the ones indexed
+        by `which`.'''
+        indices = self.indices.reshape(3, -1)
+        if which is not None:
+            indices = indices[:, which]
+        corners = self.positions[:3, indices]  # (3, 3, M)
+        return np.ascontiguousarray(corners.transpose(2, 1, 0))
+
+    def triangle_bvh(self):
+        '''Returns a `BVH` over the triangles of the mesh, in model space. The
+        hierarchy is cached until positions are set again.'''
+        if self._triangle_bvh is None:
+            tris = self.triangles()
+            self._triangle_bvh = BVH(
+                np.stack((tris.min(axis=1), tris.max(axis=1)), axis=1),
+                leaf_size=8,
+            )
+        return self._triangle_bvh
 
     @property
     def primitive(self):
@@ -79,6 +227,95 @@ class BadPrimitiveError(Exception):
     pass
 
 
+def as_array(value, dtype):
+    '''Returns `value` as a contiguous numpy array of `dtype`, without copying
+    it if it already is one, in either C or Fortran order. Non contiguous
+    arrays are copied to Fortran order, i.e: one vertex per column.'''
+    array = np.asarray(value, dtype=dtype)
+    if not (array.flags.c_contiguous or array.flags.f_contiguous):
+        array = np.asfortranarray(array)
+    return array
+
+
+def smooth_normals(positions, triangles, crease_angle=None):
+    '''Returns smooth vertex normals for a triangle mesh, the sum of the
+    normals of the triangles around every vertex weighted by their area.
+
+    With a `crease_angle`, in degrees, the corners of every vertex are
+    grouped greedily: a corner starts a group with the corners whose triangle
+    normal is within that angle of its own, and so on with the corners left.
+    Each group averages its triangles and becomes an output vertex, so that
+    vertices are split along hard edges, which stay sharp.
+
+    Parameters
+    ----------
+    positions: the (3, N) or (4, N) vertex positions.
+    triangles: the (M, 3) vertex indices of the triangles.
+    crease_angle: the maximum angle, in degrees, between smoothed triangles,
+        or None to smooth across all of them.
+
+    Returns
+    -------
+    A tuple (normals, source, triangles) with the (3, V) unit normals of the
+    V output vertices, the (V,) index of the input vertex each comes from
+    and the (M, 3) triangles indexing them. Without a crease angle, source
+    is `arange(N)` and the triangles are the input ones.
+    '''
+    xyz = np.asarray(positions, dtype=np.float64)[:3].T
+    triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+    n = xyz.shape[0]
+    corners = xyz[triangles]
+    # the cross product is twice the area along the normal
+    faces = np.cross(
+        corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]
+    )
+    vertex = triangles.ravel()
+    if crease_angle is None:
+        normals = np.stack([
+            np.bincount(vertex, weights=np.repeat(faces[:, c], 3), minlength=n)
+            for c in range(3)
+        ])
+        return normalized(normals), np.arange(n), triangles
+
+    # group the corners of every vertex, corner c belongs to face c//3: the
+    # first corner left of each vertex starts a group, which takes the
+    # corners left whose face normal is within the crease angle of its own,
+    # until no corner is left. Memory is linear in the number of corners.
+    units = normalized(faces.T).T
+    threshold = np.cos(np.radians(crease_angle)) - 1e-9
+    group = np.empty(vertex.size, dtype=np.int64)
+    left = np.argsort(vertex, kind='stable')
+    groups = 0
+    while left.size:
+        starts = np.r_[True, vertex[left[1:]] != vertex[left[:-1]]]
+        rank = np.cumsum(starts) - 1
+        reference = left[starts][rank]
+        taken = (left == reference) | (np.einsum(
+            'pc,pc->p', units[left//3], units[reference//3]
+        ) >= threshold)
+        group[left[taken]] = groups + rank[taken]
+        groups += rank[-1] + 1
+        left = left[~taken]
+    # number the groups, i.e: the output vertices, by input vertex
+    source = np.empty(groups, dtype=np.int64)
+    source[group] = vertex
+    order = np.argsort(source, kind='stable')
+    renumber = np.empty_like(order)
+    renumber[order] = np.arange(groups)
+    group = renumber[group]
+    normals = normalized(np.stack([
+        np.bincount(group, weights=faces[:, c].repeat(3), minlength=groups)
+        for c in range(3)
+    ]))
+    return normals, source[order], group.reshape(-1, 3)
+
+
+def normalized(vectors):
+    '''Returns the (3, N) `vectors` scaled to unit length, zero vectors are
+    left as they are.'''
+    return vectors/np.maximum(np.linalg.norm(vectors, axis=0), 1e-12)
+
+
 class CubeWired(Mesh):
 
     def __init__(self):
@@ -129,53 +366,154 @@ class Grid(Mesh):
     def __init__(self, n):
         super(Grid, self).__init__()
         self.primitive = Primitive.LINES
-        positions = np.zeros((n*4+4, 4))
+        ticks = np.concatenate((np.arange(-n, 0), np.arange(1, n+1)))
+        # vertices 0, 1, 2n+2 and 2n+3 are points at infinity (w = 0) along
+        # -z, z, -x and x, the lines go from the ticks on the axes to them
+        positions = np.zeros((n*4+4, 4), dtype=np.float32)
         positions[0, 2] = -1; positions[1, 2] = 1
-        positions[2:2*n+2, 0] = np.concatenate((np.arange(-n, 0), np.arange(1, n+1)))
-        positions[2:2*n+2, -1] = np.ones(2*n)
+        positions[2:2*n+2, 0] = ticks
+        positions[2:2*n+2, -1] = 1
         positions[2*n+2, 0] = -1; positions[2*n+3, 0] = 1
-        positions[2*n+4:, 2] = np.concatenate((np.arange(-n, 0), np.arange(1, n+1)))
-        positions[2*n+4:, -1] = np.ones(2*n)
+        positions[2*n+4:, 2] = ticks
+        positions[2*n+4:, -1] = 1
         self.positions = positions.T
 
-        indices = np.zeros((8*n, 2), dtype=np.int32)
-        indices[:2*n, 0] = np.zeros(2*n)
-        indices[2*n:4*n, 0] = np.ones(2*n)
-        indices[:2*n, 1] = np.arange(2, 2*n+2)
-        indices[2*n:4*n, 1] = np.arange(2, 2*n+2)
-        indices[4*n:6*n, 0] = (2*n+2)*np.ones(2*n)
-        indices[6*n:8*n, 0] = (2*n+3)*np.ones(2*n)
-        indices[4*n:6*n, 1] = np.arange(2*n+4, 2*n+4+2*n)
-        indices[6*n:8*n, 1] = np.arange(2*n+4, 2*n+4+2*n)
+        indices = np.empty((8*n, 2), dtype=np.int32)
+        indices[:, 0] = np.repeat([0, 1, 2*n+2, 2*n+3], 2*n)
+        indices[:4*n, 1] = np.tile(np.arange(2, 2*n+2), 2)
+        indices[4*n:, 1] = np.tile(np.arange(2*n+4, 4*n+4), 2)
         self.indices = indices.T
-        colors = np.zeros((n*4+4, 4), dtype=np.float32)
-        colors[:, 0] = 0.3*np.ones(n*4+4)
-        colors[:, 1] = 0.3*np.ones(n*4+4)
-        colors[:, 2] = 0.3*np.ones(n*4+4)
-        colors[:, 3] = 0.3*np.ones(n*4+4)
-        self.colors = colors.T
+        self.colors = np.full((n*4+4, 4), 0.3, dtype=np.float32).T
         self.no_indices = self.indices.shape[1]
         self.material = Material('grid-material')
         self.attribs = { 'position': self.positions, 'color': self.colors }
         self.uniforms = {}
 
 
+class InfiniteGrid(Mesh):
+    '''A grid on the xz plane generated around the camera, for maps of any
+    extent.
+
+    Level k has lines every `cell_size * ratio**k` units, `2*extent + 1`
+    along each axis around the camera, and fades out towards `background`
+    with the distance to the camera: over `extent` cells of the level along
+    the plane, and as the camera rises over the same distance, so that finer
+    levels vanish before their lines crowd the screen. Lines of coarser
+    levels overlap lines of finer ones, which makes them stand out.
+
+    The vertices live in buffers allocated once, whose size only depends on
+    `levels` and `extent`: `follow()` regenerates them in place when the
+    camera enters another cell and bumps `version`, so that renderers stream
+    them like a `DynamicMesh`. The grid has no bounds, it is never culled.
+    '''
+    def __init__(self, cell_size=1.0, extent=20, levels=3, ratio=10,
+            color=(0.6, 0.6, 0.6, 1.0), background=(0.1, 0.1, 0.1, 1.0),
+            buffers=2,
+    ):
+        '''
+        Parameters
+        ----------
+        cell_size: the spacing of the lines of the finest level.
+        extent: the number of lines of every level on each side of the
+            camera, along each axis.
+        levels: the number of levels of subdivision.
+        ratio: the spacing of the lines of a level over the ones of the
+            previous level.
+        color: the RGBA color of the lines closest to the camera.
+        background: the RGBA color lines fade to, e.g: the clear color.
+        buffers: the number of GPU copies, see `DynamicMesh`.
+        '''
+        super(InfiniteGrid, self).__init__()
+        self.primitive = Primitive.LINES
+        self.material = Material('grid-material')
+        self.cell_size = cell_size
+        self.extent = extent
+        self.levels = levels
+        self.ratio = ratio
+        self.color = np.array(color, dtype=np.float32)
+        self.background = np.array(background, dtype=np.float32)
+        self.buffers = buffers
+        self.version = 0
+        self.cell = None  # the cell of the camera the grid was made for
+        # every line is made of 2 segments: end, middle (closest to the
+        # camera, where it is the most opaque) and end
+        lines = levels*2*(2*extent + 1)
+        self.positions = np.zeros((3, 3*lines), dtype=np.float32, order='F')
+        self.colors = np.zeros((4, 3*lines), dtype=np.float32, order='F')
+        first = (3*np.arange(lines)[:, np.newaxis] + [0, 1]).ravel()
+        self.indices = np.asfortranarray(
+            np.stack((first, first + 1)).astype(np.int32)
+        )
+        self.no_indices = self.indices.shape[1]
+        self.attribs = {'position': self.positions, 'color': self.colors}
+        self.follow((0.0, 0.0, 0.0))
+
+    def aabb(self):
+        return None
+
+    def follow(self, eye):
+        '''Regenerates the grid around the model space camera position
+        `eye` if it is not in the cell the grid was made for. Returns whether
+        it was regenerated.'''
+        eye = np.asarray(eye, dtype=np.float64)[:3]
+        cell = tuple(np.floor(eye/self.cell_size).astype(np.int64).tolist())
+        if cell == self.cell:
+            return False
+        self.cell = cell
+        cx, cy, cz = (np.array(cell) + 0.5)*self.cell_size
+        spacing = self.cell_size*float(self.ratio)**np.arange(self.levels)
+        spacing = spacing[:, np.newaxis]
+        radius = self.extent*spacing
+        ticks = np.arange(-self.extent, self.extent + 1)
+        xs = (np.round(cx/spacing) + ticks)*spacing  # (levels, 2*extent + 1)
+        zs = (np.round(cz/spacing) + ticks)*spacing
+        height = np.clip(1.0 - abs(cy)/radius, 0.0, 1.0)
+        along = radius[:, :, np.newaxis]*[-1.0, 0.0, 1.0]
+
+        # [level, axis, line, vertex, xyz]
+        points = np.zeros(xs.shape[:1] + (2,) + xs.shape[1:] + (3, 3))
+        points[:, 0, :, :, 0] = xs[:, :, np.newaxis]
+        points[:, 0, :, :, 2] = cz + along
+        points[:, 1, :, :, 0] = cx + along
+        points[:, 1, :, :, 2] = zs[:, :, np.newaxis]
+        fade = np.zeros(points.shape[:-1])
+        fade[:, 0, :, 1] = np.clip(1.0 - abs(xs - cx)/radius, 0.0, 1.0)
+        fade[:, 1, :, 1] = np.clip(1.0 - abs(zs - cz)/radius, 0.0, 1.0)
+        fade = (fade*height[:, :, np.newaxis, np.newaxis]).ravel()
+
+        self._positions[...] = points.reshape(-1, 3).T
+        self._colors[...] = self.background[:, np.newaxis] \
+            + (self.color - self.background)[:, np.newaxis]*fade
+        self._colors[3] = self.color[3]*fade
+        self.version += 1
+        return True
+
+    def dirty_range(self, since):
+        '''Returns (0, number of vertices) if the grid was regenerated
+        after `version` `since`, None otherwise, see `DynamicMesh`.'''
+        if since >= self.version:
+            return None
+        return 0, self.positions.shape[1]
+
+
 class Line(Mesh):
     def __init__(self, positions, colors=[(1, 1, 1, 1),]):
-        super(Mesh, self).__init__()
-        self.positions = positions
-        self.indices = np.zeros((self.positions.shape[0] - 1, 2))
-        self.indices[:, 0] = np.arange(0, self.indices.shape[0])
-        self.indices[:, 1] = np.arange(1, self.indices.shape[0] + 1)
-        self.colors = colors
-        if self.colors.shape[0] < self.positions.shape[0]:
-            tmp = self.colors
-            self.colors = np.zeros((self.positions.shape))
-            self.colors[:tmp.shape[0], :] = tmp
-            self.colors[tmp.shape[0]:, :] = tmp[-1, :]
-        self.positions = self.positions.T
-        self.indices = self.indices.T
-        self.colors = self.colors.T
+        super(Line, self).__init__()
+        positions = np.asarray(positions, dtype=np.float32)
+        n = positions.shape[0]
+        indices = np.empty((n - 1, 2), dtype=np.int32)
+        indices[:, 0] = np.arange(n - 1, dtype=np.int32)
+        indices[:, 1] = indices[:, 0] + 1
+        colors = np.asarray(colors, dtype=np.float32)
+        if colors.shape[0] < n:
+            # the last color is repeated for the remaining vertices
+            padded = np.empty((n, colors.shape[1]), dtype=np.float32)
+            padded[:colors.shape[0]] = colors
+            padded[colors.shape[0]:] = colors[-1]
+            colors = padded
+        self.positions = positions.T
+        self.indices = indices.T
+        self.colors = colors.T
         self.no_indices = self.indices.shape[1]
         self.attribs = { 'position': self.positions, 'color': self.colors }
         self.uniforms = {}
@@ -184,77 +522,197 @@ class Line(Mesh):
 
 
 class Dae(Mesh):
-    def __init__(self, daefile):
+    def __init__(self, daefile, cache=None, optimize=False,
+            crease_angle=None,
+    ):
         '''Instantiates a Mesh from a collada file (.dae)
 
         Parameters
         ----------
         daefile: the path to the collada file, e.g: /path/to/obj3d.dae
+        cache: an optional `MeshCache`. On a hit the final arrays are
+            memory-mapped from the cache and the collada file is not parsed
+            (`objects` is then empty), on a miss the parsed mesh is stored.
+            Entries are kept apart by `optimize` and `crease_angle`.
+        optimize: whether to run `meshopt.optimize()` on the loaded mesh,
+            welding the vertices duplicated across triangle sets and
+            reordering them for the vertex cache. Its reports are kept in
+            `optimization`. The optimized arrays are the ones cached.
+        crease_angle: the crease angle, in degrees, of the smooth normals
+            generated for triangle sets without normals, see
+            `smooth_normals()`. None smooths across all the triangles.
         '''
-        super(Mesh, self).__init__()
+        super(Dae, self).__init__()
         self.daefile = daefile
-        mesh = co.Collada(self._daefile)
+        self.crease_angle = crease_angle
+        self.timings = {}  # seconds spent in each loading phase
+        self.optimization = []  # reports of `meshopt.optimize()`
+        t0 = time.perf_counter()
+        # the options change the arrays, each set of them has its own entry
+        variant = 'optimize={} crease_angle={}'.format(optimize, crease_angle)
+        entry = None
+        if cache is not None:
+            entry = cache.get(daefile, variant=variant)
+        if entry is not None:
+            self._load_cached(entry)
+        else:
+            self._load_collada()
+            self.attribs = {
+                'position': self.positions,
+                # 'color': self.colors,
+                'normal': self.normals
+            }
+            ldir = np.array([-1.0, -2.0, -3.0])
+            self.uniforms = {
+                'lAmbColor': np.array([0.1, 0.1, 0.1]),
+                'lDiffColor': np.array([0.3, 0.3, 0.3]),
+                'lDirection':  ldir/np.linalg.norm(ldir),
+            }
+            self.primitive = Primitive.TRIANGLES
+            if optimize:
+                self._optimize()
+            if cache is not None:
+                t1 = time.perf_counter()
+                self._store_cached(cache, variant, optimized=optimize)
+                self.timings['store'] = time.perf_counter() - t1
 
-        self.positions = np.array([], dtype=np.float32)
-        self.indices = np.array([], dtype=np.int32)
-        self.normals = np.array([], dtype=np.float32)
-        # self.colors = np.array([], dtype=np.float32)
+        self.material = Material('dae-material')
+        self.material.load_shaders(
+            'data/shaders/flat.vs.glsl',
+            'data/shaders/flat.fs.glsl',
+        )
+        self.timings['total'] = time.perf_counter() - t0
 
+    def _load_collada(self):
+        '''Parses the collada file and fills the vertex data.'''
+        t0 = time.perf_counter()
+        mesh = co.Collada(self._daefile)
+        t1 = time.perf_counter()
+        self.timings['parse'] = t1 - t0
 
-        self.objects = []
+        trisets = []
         for g in mesh.scene.objects('geometry'):
             for triset in g.primitives():
                 if type(triset) != co.triangleset.BoundTriangleSet:
                     # ignore everything that is not a triangle
                     continue
-                normal = np.zeros(triset.vertex.shape)
-                for i, tri in enumerate(triset.vertex_index):
-                    normal[tri] = triset.normal[triset.normal_index[i]]
-                o = {
-                    'positions': triset.vertex,
-                    'normals': normal,
-                    'indices': triset.vertex_index
-                }
-                self.objects.append(o)
-
-        for o in self.objects:
-            self.indices = np.concatenate((
-                self.indices.flatten(),
-                (o['indices'] + self.positions.shape[0]).flatten()
-            )).reshape(-1, 3)
-            self.positions = np.concatenate((
-                self.positions.flatten(),
-                o['positions'].flatten()
-            )).reshape(-1, 3)
-            self.normals = np.concatenate((
-                self.normals.flatten(),
-                o['normals'].flatten()
-            )).reshape(-1, 3)
-
-        self.no_indices = self.indices.shape[0]
-
-        self.positions = self.positions.T
-        self.indices = self.indices.T
-        self.normals = self.normals.T
+                trisets.append(triset)
+        t2 = time.perf_counter()
+        self.timings['collect'] = t2 - t1
+
+        # preallocate the final arrays from the summed sizes, then copy every
+        # triangle set into its slice
+        parts = [self._triset_vertices(triset) for triset in trisets]
+        no_vertices = sum(len(vertex) for vertex, _, _ in parts)
+        no_triangles = sum(len(triset.vertex_index) for triset in trisets)
+        positions = np.empty((no_vertices, 3), dtype=np.float32)
+        normals = np.empty((no_vertices, 3), dtype=np.float32)
+        indices = np.empty((no_triangles, 3), dtype=np.int32)
+        self.objects = []
+        v, i = 0, 0
+        for triset, (vertex, normal, triangles) in zip(trisets, parts):
+            nv, nt = len(vertex), len(triangles)
+            positions[v:v+nv] = triset.vertex[vertex]
+            normals[v:v+nv] = normal
+            indices[i:i+nt] = triangles
+            indices[i:i+nt] += v
+            self.objects.append({
+                'positions': positions[v:v+nv],
+                'normals': normals[v:v+nv],
+                'indices': triangles,
+            })
+            v, i = v + nv, i + nt
+        t3 = time.perf_counter()
+        self.timings['assemble'] = t3 - t2
+
+        self.no_indices = indices.shape[0]
+
+        self.positions = positions.T
+        self.indices = indices.T
+        self.normals = normals.T
         # self.colors = np.ones(self.positions.shape)
+        self.timings['convert'] = time.perf_counter() - t3
 
-        self.material = Material('dae-material')
-        self.material.load_shaders(
-            'data/shaders/flat.vs.glsl',
-            'data/shaders/flat.fs.glsl',
+    def _triset_vertices(self, triset):
+        '''Returns a tuple (vertex, normals, triangles) with the index in
+        `triset.vertex` of each vertex of a triangle set, their (nv, 3) unit
+        normals and the (nt, 3) triangles indexing them.
+
+        A vertex is made for every distinct (position, normal) pair used by
+        the corners of the triangles, so flat and smooth shading are both
+        kept as authored. Triangle sets without normals get smooth normals,
+        see `smooth_normals()`.'''
+        if triset.normal is None:
+            normals, vertex, triangles = smooth_normals(
+                triset.vertex.T, triset.vertex_index, self.crease_angle
+            )
+            return vertex, normals.T, triangles
+        corners = np.stack((
+            np.ravel(triset.vertex_index), np.ravel(triset.normal_index)
+        ), axis=1)
+        pairs, inverse = np.unique(corners, axis=0, return_inverse=True)
+        normals = normalized(triset.normal[pairs[:, 1]].T).T
+        return pairs[:, 0], normals, inverse.reshape(-1, 3)
+
+    def _optimize(self):
+        '''Welds and reorders the vertex data, see `meshopt.optimize()`.'''
+        from nano3d.meshopt import optimize
+        t0 = time.perf_counter()
+        self.optimization = optimize(self)
+        self.timings['optimize'] = time.perf_counter() - t0
+
+    def _store_cached(self, cache, variant='', optimized=False):
+        '''Stores the vertex data, attribs and uniforms in `cache`, as the
+        entry `variant`.'''
+        arrays = {
+            'positions': self.positions,
+            'indices': self.indices,
+            'normals': self.normals,
+        }
+        names = {id(array): name for name, array in arrays.items()}
+        attribs = {}
+        for key, array in self.attribs.items():
+            if id(array) not in names:
+                names[id(array)] = 'attrib_' + key
+                arrays['attrib_' + key] = array
+            attribs[key] = names[id(array)]
+        cache.put(
+            self._daefile, arrays, variant,
+            attribs=attribs,
+            uniforms={
+                key: np.asarray(value).tolist()
+                for key, value in self.uniforms.items()
+            },
+            no_indices=self.no_indices,
+            primitive=self.primitive.name,
+            optimized=optimized,
+            crease_angle=self.crease_angle,
         )
+
+    def _load_cached(self, entry):
+        '''Fills the mesh from a `MeshCache` entry. The memory-mapped arrays
+        are wrapped by the setters, not copied.'''
+        t0 = time.perf_counter()
+        arrays = entry['arrays']
+        self.positions = arrays['positions']
+        self.indices = arrays['indices']
+        self.normals = arrays['normals']
+        self.objects = []
+        self.no_indices = entry['no_indices']
+        self.primitive = Primitive[entry['primitive']]
+        vertex_data = {
+            'positions': self.positions,
+            'indices': self.indices,
+            'normals': self.normals,
+        }
         self.attribs = {
-            'position': self.positions,
-            # 'color': self.colors,
-            'normal': self.normals
+            key: vertex_data.get(name, arrays[name])
+            for key, name in entry['attribs'].items()
         }
-        ldir = np.array([-1.0, -2.0, -3.0])
         self.uniforms = {
-            'lAmbColor': np.array([0.1, 0.1, 0.1]),
-            'lDiffColor': np.array([0.3, 0.3, 0.3]),
-            'lDirection':  ldir/np.linalg.norm(ldir),
+            key: np.array(value) for key, value in entry['uniforms'].items()
         }
-        self.primitive = Primitive.TRIANGLES
+        self.timings['cache'] = time.perf_counter() - t0
 
     @property
     def daefile(self):
@@ -268,3 +726,482 @@ class Dae(Mesh):
                 errno.ENOENT, os.strerror(errno.ENOENT), filename
             )
         self._daefile = filename
+
+
+class ChunkedMesh(Mesh):
+    '''A mesh split into fixed-size chunks that are loaded lazily, for models
+    that do not fit in memory, e.g: point clouds or scanned terrain backed by
+    memory-mapped files.
+
+    Chunks hold `chunk_size` primitives each (points, lines or triangles) and
+    are regular `Mesh` objects with their own bounds. A chunk is read from
+    the source arrays the first time it is used, and the least recently used
+    chunks are dropped once the resident data exceeds `budget` bytes. The
+    bounds of all the chunks are computed by a single streaming pass when
+    the mesh is created, so culling never needs the geometry.
+    '''
+    def __init__(self, positions, indices=None, colors=None,
+            primitive=Primitive.POINTS, chunk_size=2**16, budget=2**28,
+    ):
+        '''
+        Parameters
+        ----------
+        positions: an (N, 3) or (N, 4) array-like with one row per vertex,
+            e.g: a numpy.memmap or the result of `np.load(mmap_mode='r')`.
+            Only the rows used by loaded chunks are read.
+        indices: an optional (M, k) array-like with the vertex indices of each
+            primitive, where k is 1, 2 or 3 for points, lines and triangles.
+            If None, consecutive vertices make up the primitives.
+        colors: an optional (N, 4) array-like with per vertex colors, white
+            if None.
+        primitive: one of Primitive.POINTS/LINES/TRIANGLES.
+        chunk_size: the number of primitives per chunk.
+        budget: the maximum number of bytes of loaded chunk data.
+        '''
+        super(ChunkedMesh, self).__init__()
+        self.primitive = primitive
+        self.source_positions = positions
+        self.source_indices = indices
+        self.source_colors = colors
+        self.chunk_size = chunk_size
+        self.budget = budget
+        self.material = Material('chunk-material')
+        self.vertices_per_primitive = primitive.value
+        if indices is None:
+            no_primitives = len(positions) // self.vertices_per_primitive
+        else:
+            no_primitives = len(indices)
+        self.no_chunks = -(-no_primitives // chunk_size)
+        self.no_primitives = no_primitives
+        self._loaded = OrderedDict()  # chunk index -> Mesh, in LRU order
+        self.resident_bytes = 0
+        self.bounds = np.empty((self.no_chunks, 2, 3), dtype=np.float32)
+        for i in range(self.no_chunks):
+            positions, _, _ = self._read(i)
+            xyz = positions[:, :3]
+            self.bounds[i] = (xyz.min(axis=0), xyz.max(axis=0))
+
+    def __len__(self):
+        return self.no_chunks
+
+    def aabb(self):
+        '''Returns the union of the bounds of all the chunks.'''
+        if self.no_chunks == 0:
+            return None
+        return np.array(
+            [self.bounds[:, 0].min(axis=0), self.bounds[:, 1].max(axis=0)]
+        )
+
+    def _read(self, i):
+        '''Reads the positions, local indices and colors of chunk `i`.'''
+        start = i*self.chunk_size
+        stop = min(start + self.chunk_size, self.no_primitives)
+        k = self.vertices_per_primitive
+        if self.source_indices is None:
+            vertices = slice(start*k, stop*k)
+            indices = np.arange((stop - start)*k, dtype=np.int32)
+        else:
+            primitives = np.asarray(self.source_indices[start:stop])
+            vertices, indices = np.unique(primitives, return_inverse=True)
+            indices = indices.astype(np.int32)
+        positions = np.asarray(self.source_positions[vertices], np.float32)
+        if self.source_colors is None:
+            colors = np.ones((positions.shape[0], 4), dtype=np.float32)
+        else:
+            colors = np.asarray(self.source_colors[vertices], np.float32)
+        return positions, indices.reshape(-1, k), colors
+
+    def is_loaded(self, i):
+        return i in self._loaded
+
+    def chunk(self, i):
+        '''Returns chunk `i` as a `Mesh`, loading it if needed.'''
+        if i in self._loaded:
+            self._loaded.move_to_end(i)
+            return self._loaded[i]
+        positions, indices, colors = self._read(i)
+        mesh = Mesh()
+        mesh.primitive = self.primitive
+        mesh.positions = positions.T
+        mesh.indices = indices.T
+        mesh.colors = colors.T
+        mesh._aabb = self.bounds[i]
+        mesh.no_indices = indices.shape[0]
+        mesh.material = self.material
+        mesh.attribs = {'position': mesh.positions, 'color': mesh.colors}
+        mesh.uniforms = self.uniforms
+        self._loaded[i] = mesh
+        self.resident_bytes += self._nbytes(mesh)
+        self.evict(keep=i)
+        return mesh
+
+    def _nbytes(self, mesh):
+        return mesh.positions.nbytes + mesh.indices.nbytes + mesh.colors.nbytes
+
+    def evict(self, keep=None):
+        '''Drops least recently used chunks until the resident data fits in
+        the budget. Chunk `keep` is never dropped.'''
+        for i in list(self._loaded):
+            if self.resident_bytes <= self.budget:
+                break
+            if i == keep:
+                continue
+            self.resident_bytes -= self._nbytes(self._loaded.pop(i))
+
+    def chunks(self, which=None):
+        '''Generator of (index, Mesh) tuples with the chunks in `which`, all
+        of them if None. Chunks are loaded as the generator advances.'''
+        for i in (range(self.no_chunks) if which is None else which):
+            yield i, self.chunk(i)
+
+    def visible_chunks(self, mvp):
+        '''Returns the indices of the chunks whose bounds intersect the frustum
+        of the clip matrix `mvp`, i.e: projection @ view @ model.'''
+        planes = frustum_planes(mvp)
+        return np.flatnonzero(aabbs_in_frustum(planes, self.bounds))
+
+
+class DynamicMesh(Mesh):
+    '''A mesh whose vertices change from frame to frame, e.g: a live
+    trajectory or a sensor trace, streamed to the GPU without rebuilding the
+    renderer.
+
+    Vertices are stored in arrays with room for `capacity` vertices, which
+    doubles whenever an `append()` does not fit, so appending n vertices
+    costs amortized O(n). `positions`, `colors` and `indices` are views of
+    the used part. Primitives are made from consecutive vertices: every
+    vertex is a point for POINTS, every vertex is joined to the previous one
+    for LINES (a line strip) and every 3 vertices make a triangle for
+    TRIANGLES.
+
+    Every change bumps `version` and records the range of vertices it
+    touched, see `dirty_range()`, so that renderers re-upload only what
+    changed since the copy they hold, into one of `buffers` rotating copies
+    (see `resources.BufferRing`) so that a frame never writes a buffer the
+    previous ones may still be drawing from. The bounds follow the vertices,
+    but a scene BVH caches them: rebuild it if the mesh grows.
+    '''
+    def __init__(self, primitive=Primitive.LINES, capacity=1024, buffers=3,
+            color=(1.0, 1.0, 1.0, 1.0), history=64,
+    ):
+        '''
+        Parameters
+        ----------
+        primitive: one of Primitive.POINTS/LINES/TRIANGLES.
+        capacity: the number of vertices allocated up front.
+        buffers: the number of GPU copies renderers rotate through, 2 for
+            double buffering, 3 for triple buffering.
+        color: the RGBA color of the vertices appended without colors.
+        history: the number of changes whose ranges are remembered, older
+            copies are re-uploaded entirely.
+        '''
+        super(DynamicMesh, self).__init__()
+        self.primitive = primitive
+        self.buffers = buffers
+        self.color = np.array(color, dtype=np.float32)
+        self.material = Material('dynamic-material')
+        self.count = 0  # number of vertices
+        self.version = 0
+        self.history = history
+        self._changes = []  # (version, start, stop) of the recent changes
+        self._allocation = 0  # version of the last reallocation
+        self._allocate(max(capacity, 1))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def capacity(self):
+        return self._store_positions.shape[1]
+
+    def _allocate(self, capacity):
+        '''(Re)allocates the arrays for `capacity` vertices, keeping the used
+        ones.'''
+        k = self.primitive.value
+        positions = np.zeros((3, capacity), dtype=np.float32, order='F')
+        colors = np.zeros((4, capacity), dtype=np.float32, order='F')
+        if self.count:
+            positions[:, :self.count] = self._store_positions[:, :self.count]
+            colors[:, :self.count] = self._store_colors[:, :self.count]
+        self._store_positions, self._store_colors = positions, colors
+        # primitive i uses vertices i*step .. i*step + k - 1
+        step = 1 if self.primitive == Primitive.LINES else k
+        first = step*np.arange(capacity // step, dtype=np.int32)
+        self._store_indices = np.asfortranarray(
+            first + np.arange(k, dtype=np.int32)[:, np.newaxis]
+        )
+        self._allocation = self.version + 1
+        self._views()
+
+    def _views(self):
+        '''Points the vertex data and attribs at the used vertices.'''
+        n = self.count
+        self._positions = self._store_positions[:, :n]
+        self._colors = self._store_colors[:, :n]
+        k = self.primitive.value
+        if self.primitive == Primitive.LINES:
+            self.no_indices = max(n - 1, 0)
+        else:
+            self.no_indices = n // k
+        self._indices = self._store_indices[:, :self.no_indices]
+        self.attribs = {'position': self._positions, 'color': self._colors}
+
+    def _changed(self, start, stop):
+        self.version += 1
+        self._changes.append((self.version, start, stop))
+        del self._changes[:-self.history]
+
+    def append(self, positions, colors=None):
+        '''Appends vertices at the end of the mesh.
+
+        Parameters
+        ----------
+        positions: an (n, 3) or (n, 4) array-like, one row per vertex.
+        colors: an optional (n, 4) array-like or a single RGBA color, `color`
+            if None.
+        '''
+        positions = np.asarray(positions, dtype=np.float32).reshape(
+            -1, np.shape(positions)[-1]
+        )
+        n = positions.shape[0]
+        if n == 0:
+            return
+        start, stop = self.count, self.count + n
+        if stop > self.capacity:
+            self._allocate(max(stop, 2*self.capacity))
+        self._store_positions[:, start:stop] = positions[:, :3].T
+        self._store_colors[:, start:stop] = np.reshape(
+            self.color if colors is None else colors, (-1, 4)
+        ).T
+        self.count = stop
+        if self._aabb is not None:
+            xyz = positions[:, :3]
+            self._aabb = np.array([
+                np.minimum(self._aabb[0], xyz.min(axis=0)),
+                np.maximum(self._aabb[1], xyz.max(axis=0)),
+            ], dtype=np.float32)
+        self._triangle_bvh = None
+        self._views()
+        self._changed(start, stop)
+
+    def update(self, start, positions=None, colors=None):
+        '''Overwrites the positions and/or colors of the vertices from index
+        `start` on, which must exist.'''
+        n = len(positions if positions is not None else colors)
+        stop = start + n
+        if start < 0 or stop > self.count:
+            raise IndexError(
+                'vertices {}:{} out of {}'.format(start, stop, self.count)
+            )
+        if positions is not None:
+            positions = np.asarray(positions, dtype=np.float32)
+            self._store_positions[:, start:stop] = positions[:, :3].T
+            self._aabb = None
+            self._triangle_bvh = None
+        if colors is not None:
+            self._store_colors[:, start:stop] = np.reshape(colors, (-1, 4)).T
+        self._changed(start, stop)
+
+    def clear(self):
+        '''Removes all the vertices, keeping the capacity.'''
+        self.count = 0
+        self._aabb = None
+        self._triangle_bvh = None
+        self._views()
+        self._changed(0, 0)
+
+    def dirty_range(self, since):
+        '''Returns a tuple (start, stop) with the range of vertices changed
+        after `version` `since`, (0, count) if the arrays were reallocated
+        meanwhile or the changes are too old to be remembered, or None if
+        nothing changed.'''
+        if since >= self.version:
+            return None
+        if since < self._allocation or not self._changes \
+                or since < self._changes[0][0] - 1:
+            return 0, self.count
+        start, stop = self.count, 0
+        for version, first, last in self._changes:
+            if version > since:
+                start, stop = min(start, first), max(stop, last)
+        return min(start, self.count), min(stop, self.count)
+
+
+class Polyline(Mesh):
+    '''A polyline with up to tens of millions of points, e.g: a long
+    trajectory, drawn at a cost bounded by the screen resolution.
+
+    Points are appended to a ring of fixed-size chunks: once `max_points` is
+    exceeded the oldest chunks are dropped, and the bounds of every chunk
+    are kept so that chunks outside the frustum are skipped when drawing.
+
+    Renderers draw `decimate()`, a `DynamicMesh` line strip with the points
+    needed for the current camera: within every run of consecutive points
+    falling in the same pixel column only the first, last, lowest and
+    highest ones are kept (M4 decimation), which draws the same pixels up to
+    a pixel of error while keeping at most 4 points per column for time
+    series. The full resolution `positions` and `indices` (int32) are built
+    on demand.
+    '''
+    def __init__(self, points=None, color=(1.0, 1.0, 1.0, 1.0),
+            chunk_size=2**16, max_points=None, buffers=3,
+    ):
+        '''
+        Parameters
+        ----------
+        points: an optional (N, 3) or (N, 4) array-like with the first
+            points, see `append()`.
+        color: the RGBA color of the line.
+        chunk_size: the number of points per chunk.
+        max_points: the number of most recent points kept, at least, or
+            None to keep all of them.
+        buffers: the number of GPU copies of the decimated line, see
+            `DynamicMesh`.
+        '''
+        super(Polyline, self).__init__()
+        self.primitive = Primitive.LINES
+        self.material = Material('polyline-material')
+        self.color = np.array(color, dtype=np.float32)
+        self.chunk_size = chunk_size
+        self.max_points = max_points
+        self.count = 0
+        self.no_indices = 0
+        self.version = 0
+        self._chunks = deque()  # (chunk_size, 3) float32 arrays
+        self._bounds = deque()  # (2, 3) bounds of every chunk
+        self._fill = chunk_size  # points in the last chunk
+        self.output = DynamicMesh(Primitive.LINES, buffers=buffers)
+        self.output.material = self.material
+        self._decimated = None  # (version, mvp, size) of the output
+        if points is not None:
+            self.append(points)
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def positions(self):
+        '''The (3, N) full resolution points, built on first use.'''
+        if self._positions is None and self.count:
+            self._positions = np.asfortranarray(self.points().T)
+        return self._positions
+
+    @property
+    def indices(self):
+        '''The (2, N - 1) int32 indices of the full resolution segments,
+        built on first use.'''
+        if self._indices is None:
+            first = np.arange(self.no_indices, dtype=np.int32)
+            self._indices = np.asfortranarray(np.stack((first, first + 1)))
+        return self._indices
+
+    def append(self, points):
+        '''Appends an (n, 3) or (n, 4) array-like of points.'''
+        points = np.asarray(points, dtype=np.float32)
+        points = points.reshape(-1, points.shape[-1])[:, :3]
+        while len(points):
+            if self._fill == self.chunk_size:
+                self._chunks.append(
+                    np.empty((self.chunk_size, 3), dtype=np.float32)
+                )
+                self._bounds.append(np.array([points[0], points[0]]))
+                self._fill = 0
+            n = min(len(points), self.chunk_size - self._fill)
+            part, points = points[:n], points[n:]
+            self._chunks[-1][self._fill:self._fill + n] = part
+            bounds = self._bounds[-1]
+            bounds[0] = np.minimum(bounds[0], part.min(axis=0))
+            bounds[1] = np.maximum(bounds[1], part.max(axis=0))
+            self._fill += n
+            self.count += n
+        if self.max_points is not None:
+            while self.count - self.chunk_size >= self.max_points:
+                self._chunks.popleft()
+                self._bounds.popleft()
+                self.count -= self.chunk_size
+        self.no_indices = max(self.count - 1, 0)
+        self._positions = None
+        self._indices = None
+        self._aabb = None
+        self.version += 1
+
+    def chunks(self):
+        '''Returns the list of (n, 3) arrays with the points of every chunk,
+        oldest first.'''
+        chunks = list(self._chunks)
+        if chunks:
+            chunks[-1] = chunks[-1][:self._fill]
+        return chunks
+
+    def points(self):
+        '''Returns an (N, 3) array with all the points.'''
+        chunks = self.chunks()
+        if not chunks:
+            return np.zeros((0, 3), dtype=np.float32)
+        return np.concatenate(chunks)
+
+    def aabb(self):
+        '''Returns the union of the bounds of the chunks, or None.'''
+        if self._aabb is None and self._bounds:
+            bounds = np.array(self._bounds)
+            self._aabb = np.array(
+                [bounds[:, 0].min(axis=0), bounds[:, 1].max(axis=0)],
+                dtype=np.float32,
+            )
+        return self._aabb
+
+    def decimate(self, mvp, size):
+        '''Returns the `output` mesh updated with the points drawn through
+        the clip matrix `mvp` (projection @ view @ model) in a viewport of
+        `size` (width, height) pixels. It is only recomputed when the points,
+        the matrix or the size changed.'''
+        mvp = np.asarray(mvp, dtype=np.float64)
+        key = (self.version, mvp.tobytes(), tuple(size))
+        if self._decimated == key:
+            return self.output
+        self._decimated = key
+        self.output.clear()
+        if not self.count:
+            return self.output
+        planes = frustum_planes(mvp)
+        inside = aabbs_in_frustum(planes, np.array(self._bounds))
+        parts = []
+        for chunk, visible in zip(self.chunks(), inside):
+            if visible:
+                parts.append(chunk[decimate_columns(chunk, mvp, size)])
+            else:
+                # all its segments are outside, as the first to last one is
+                parts.append(chunk[[0, -1]] if len(chunk) > 1 else chunk)
+        self.output.append(np.concatenate(parts), self.color)
+        return self.output
+
+
+def decimate_columns(points, mvp, size):
+    '''Returns the sorted indices of the (N, 3) `points` of a polyline to
+    keep when drawn through the clip matrix `mvp` in a viewport of `size`
+    pixels: the first, last, lowest and highest points of every run of
+    consecutive points projected in the same pixel column. Points behind the
+    camera are all kept.'''
+    n = len(points)
+    if n < 3:
+        return np.arange(n)
+    clip = points.astype(np.float64) @ mvp[:, :3].T + mvp[:, 3]
+    w = clip[:, 3]
+    front = w > 1e-9
+    w = np.where(front, w, 1.0)
+    width, height = size
+    x = np.clip((clip[:, 0]/w + 1.0)*0.5*width, -1.0, width)
+    y = (clip[:, 1]/w + 1.0)*0.5*height
+    # points behind the camera get a column of their own
+    columns = np.where(front, np.floor(x), -2.0 - np.arange(n))
+    starts = np.flatnonzero(np.r_[True, columns[1:] != columns[:-1]])
+    if len(starts) == n:
+        return np.arange(n)
+    run = np.cumsum(np.r_[True, columns[1:] != columns[:-1]]) - 1
+    keep = [starts, np.r_[starts[1:] - 1, n - 1]]
+    for extreme in [np.minimum, np.maximum]:
+        values = extreme.reduceat(y, starts)
+        candidates = np.flatnonzero(y == values[run])
+        _, first = np.unique(run[candidates], return_index=True)
+        keep.append(candidates[first])
+    return np.unique(np.concatenate(keep))
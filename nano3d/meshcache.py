@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+import tempfile
+
+import numpy as np
+
+
+class MeshCache():
+    '''A binary on-disk cache of the final arrays of loaded meshes.
+
+    Every entry is a directory holding one `.npy` file per array plus a
+    `meta.json` file. Entries are keyed by the absolute path, modification
+    time and size of the source file, and by a `variant` string telling the
+    options it was loaded with apart, and record a digest of its contents.
+    Cached arrays are opened with `np.load(mmap_mode='r')`, so a hit costs
+    almost nothing and processes loading the same asset share the same pages.
+    The total size of the cache is bounded by `max_bytes`, least recently
+    used entries are evicted first.
+    '''
+    def __init__(self, directory, max_bytes=2**30):
+        '''
+        Parameters
+        ----------
+        directory: where entries are stored, created if missing.
+        max_bytes: upper bound for the size of all the entries.
+        '''
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def key(self, path, variant=''):
+        '''Returns the key of the entry for the source file `path` loaded with
+        the options described by `variant`.'''
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        ident = '{}\0{}\0{}\0{}'.format(
+            path, stat.st_mtime_ns, stat.st_size, variant
+        )
+        return hashlib.blake2b(ident.encode(), digest_size=16).hexdigest()
+
+    def get(self, path, verify=False, variant=''):
+        '''Returns a dict with the cached arrays (memory-mapped, read only)
+        and metadata for the source file `path`, or None on a miss.
+
+        Parameters
+        ----------
+        path: the source file the entry was created from.
+        verify: whether to check the digest of the source file contents too,
+            which reads the whole file.
+        variant: the options the entry was stored with, see `put()`.
+        '''
+        entry = self.directory / self.key(path, variant)
+        try:
+            with open(str(entry / 'meta.json'), 'r') as f:
+                meta = json.load(f)
+            if verify and meta['digest'] != file_digest(path):
+                return None
+            arrays = {
+                name: np.load(str(entry / (name + '.npy')), mmap_mode='r')
+                for name in meta['arrays']
+            }
+        except (OSError, ValueError, KeyError):
+            return None  # missing, partially evicted or corrupted entry
+        os.utime(str(entry))  # most recently used
+        meta['arrays'] = arrays
+        return meta
+
+    def put(self, path, arrays, variant='', **meta):
+        '''Stores `arrays`, a dict of name to numpy.ndarray, and the JSON
+        serializable `meta` for the source file `path` loaded with the options
+        described by the string `variant`, then evicts entries if the cache
+        grew too large. Returns the entry directory.'''
+        entry = self.directory / self.key(path, variant)
+        tmp = Path(tempfile.mkdtemp(dir=str(self.directory), prefix='.tmp'))
+        for name, array in arrays.items():
+            np.save(str(tmp / (name + '.npy')), array)
+        meta['arrays'] = list(arrays)
+        meta['source'] = os.path.abspath(path)
+        meta['digest'] = file_digest(path)
+        with open(str(tmp / 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.rename(str(tmp), str(entry))
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(str(tmp), ignore_errors=True)
+        self.evict()
+        return entry
+
+    def entries(self):
+        '''Returns a list of (entry, size in bytes, last used time) tuples.'''
+        entries = []
+        for entry in self.directory.iterdir():
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            try:
+                size = sum(f.stat().st_size for f in entry.iterdir())
+                entries.append((entry, size, entry.stat().st_mtime))
+            except OSError:
+                continue  # removed concurrently
+        return entries
+
+    def size(self):
+        '''Returns the total size in bytes of the cached entries.'''
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        '''Removes the least recently used entries until the cache is no
+        larger than `max_bytes`.'''
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        for entry, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(str(entry), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        '''Removes all the entries.'''
+        for entry, _, _ in self.entries():
+            shutil.rmtree(str(entry), ignore_errors=True)
+
+
+def file_digest(path, chunk_size=2**20):
+    '''Returns the hex digest of the contents of the file `path`.'''
+    digest = hashlib.blake2b(digest_size=16)
+    with open(str(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,319 @@
+import time
+
+import numpy as np
+
+from nano3d.mesh import BadPrimitiveError, Primitive, smooth_normals
+
+
+STAGES = ['weld', 'triangles', 'vertices', 'indices']
+
+
+def optimize(mesh, stages=STAGES, tolerance=1e-6, normal_tolerance=1e-3,
+        cache_size=32,
+):
+    '''Runs the mesh optimization pipeline on `mesh`, in place:
+
+    - 'weld': merges duplicate vertices, see `weld()`.
+    - 'triangles': reorders triangles for the post-transform vertex cache,
+      see `optimize_triangles()`. Skipped for other primitives.
+    - 'vertices': reorders vertices in the order they are first used, see
+      `optimize_vertices()`.
+    - 'indices': stores the indices as uint16 when possible, see
+      `narrow_indices()`.
+
+    Returns a list with one dict per stage, holding its 'stage' name, the
+    'seconds' it took and the ('vertices', 'indices', 'index_bytes', 'acmr')
+    before and after it, as (before, after) tuples, see `acmr()`.
+
+    Parameters
+    ----------
+    mesh: the `Mesh` to optimize.
+    stages: the names of the stages to run, in order.
+    tolerance, normal_tolerance: the welding tolerances, see `weld()`.
+    cache_size: the size of the vertex cache optimized for and simulated.
+    '''
+    functions = {
+        'weld': lambda: weld(mesh, tolerance, normal_tolerance),
+        'triangles': lambda: optimize_triangles(mesh, cache_size),
+        'vertices': lambda: optimize_vertices(mesh),
+        'indices': lambda: narrow_indices(mesh),
+    }
+    reports = []
+    for stage in stages:
+        if stage == 'triangles' and mesh.primitive != Primitive.TRIANGLES:
+            continue
+        before = statistics(mesh, cache_size)
+        t0 = time.perf_counter()
+        functions[stage]()
+        seconds = time.perf_counter() - t0
+        after = statistics(mesh, cache_size)
+        report = {'stage': stage, 'seconds': seconds}
+        for name in before:
+            report[name] = (before[name], after[name])
+        reports.append(report)
+    return reports
+
+
+def statistics(mesh, cache_size=32):
+    '''Returns a dict with the number of vertices, of indices, the size in
+    bytes of the index buffer and the ACMR of `mesh`.'''
+    indices = primitives(mesh)
+    return {
+        'vertices': mesh.positions.shape[1],
+        'indices': indices.size,
+        'index_bytes': indices.size*indices.itemsize,
+        'acmr': acmr(mesh, cache_size),
+    }
+
+
+def format_reports(reports):
+    '''Returns the reports of `optimize()` as a text table.'''
+    lines = ['{:<10}{:>20}{:>20}{:>16}{:>10}'.format(
+        'stage', 'vertices', 'indices', 'acmr', 'ms'
+    )]
+    for report in reports:
+        lines.append('{:<10}{:>20}{:>20}{:>16}{:>10.1f}'.format(
+            report['stage'],
+            '{} -> {}'.format(*report['vertices']),
+            '{} -> {}'.format(*report['indices']),
+            '{:.3f} -> {:.3f}'.format(*report['acmr']),
+            1e3*report['seconds'],
+        ))
+    return '\n'.join(lines)
+
+
+def acmr(mesh, cache_size=32):
+    '''Returns the average cache miss ratio of `mesh`: the number of vertices
+    transformed per primitive when drawn through a FIFO post-transform
+    vertex cache of `cache_size` entries. It ranges from 3 (no reuse) down
+    to about 0.5 for triangles of a regular grid.'''
+    indices = primitives(mesh)
+    if indices.shape[0] == 0:
+        return 0.0
+    inserted = [-cache_size - 1]*mesh.positions.shape[1]
+    misses = 0
+    for v in indices.ravel().tolist():
+        if misses - inserted[v] > cache_size:
+            inserted[v] = misses
+            misses += 1
+    return misses/indices.shape[0]
+
+
+def primitives(mesh):
+    '''Returns an (M, k) array with the vertex indices of each primitive.'''
+    k = mesh.primitive.value
+    indices = np.asarray(mesh.indices).reshape(k, -1).T
+    return indices[:mesh.no_indices] if mesh.no_indices else indices
+
+
+def weld(mesh, tolerance=1e-6, normal_tolerance=1e-3):
+    '''Merges the vertices of `mesh` that have the same position, normal,
+    color and other attributes once quantized: positions and extra
+    attributes to multiples of `tolerance`, normals of `normal_tolerance`
+    and colors to 8 bits. Primitives collapsing as a result are dropped.
+    The first vertex of every group is kept, in order.'''
+    keys = []
+    for name, array in vertex_arrays(mesh).items():
+        step = {'normals': normal_tolerance, 'colors': 1.0/255}.get(
+            name, tolerance
+        )
+        keys.append(np.round(np.asarray(array, np.float64)/step))
+    keys = np.concatenate(keys).T.astype(np.int64)
+    _, first, inverse = np.unique(
+        keys, axis=0, return_index=True, return_inverse=True
+    )
+    # number the groups in the order of their first vertex
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.size)
+    remap_vertices(mesh, first[order], rank[inverse.ravel()])
+    indices = primitives(mesh)
+    if indices.shape[1] > 1:
+        distinct = np.ones(indices.shape[0], dtype=bool)
+        for i in range(indices.shape[1]):
+            for j in range(i + 1, indices.shape[1]):
+                distinct &= indices[:, i] != indices[:, j]
+        set_primitives(mesh, indices[distinct])
+
+
+def optimize_triangles(mesh, cache_size=32):
+    '''Reorders the triangles of `mesh` with Tom Forsyth's linear-speed
+    vertex cache optimization: triangles are emitted greedily by the score
+    of their vertices, which favors vertices recently used (in a simulated
+    LRU cache of `cache_size` entries) and vertices with few triangles left.
+
+    Raises
+    ------
+    BadPrimitiveError: if the mesh is not made of triangles.
+    '''
+    if mesh.primitive != Primitive.TRIANGLES:
+        raise BadPrimitiveError()
+    triangles = primitives(mesh)
+    order = forsyth_order(triangles, mesh.positions.shape[1], cache_size)
+    set_primitives(mesh, triangles[order])
+
+
+def forsyth_order(triangles, no_vertices, cache_size=32):
+    '''Returns the order in which to draw the (M, 3) `triangles`, see
+    `optimize_triangles()`.'''
+    m = triangles.shape[0]
+    if m == 0:
+        return np.zeros(0, dtype=np.int64)
+    flat = np.asarray(triangles, dtype=np.int64).ravel()
+    valence = np.bincount(flat, minlength=no_vertices)
+    # triangles of every vertex, the live ones first in each range
+    starts = (np.cumsum(valence) - valence).tolist()
+    adjacency = (np.argsort(flat, kind='stable') // 3).tolist()
+    live = valence.tolist()
+
+    # scores of the cache positions, the last triangle's vertices get a
+    # fixed score so that strips do not simply go back and forth
+    cache_scores = [0.75]*3 + [
+        (1.0 - (p - 3)/(cache_size - 3))**1.5 for p in range(3, cache_size)
+    ]
+    valence_scores = [0.0] + (
+        2.0*np.arange(1, valence.max() + 1)**-0.5
+    ).tolist()
+    vertex_scores = [valence_scores[k] for k in live]
+    triangle_scores = np.array(vertex_scores)[flat].reshape(-1, 3)
+    triangle_scores = triangle_scores.sum(axis=1).tolist()
+    corners = np.asarray(triangles).tolist()
+    position = [-1]*no_vertices
+    emitted = [False]*m
+    order = []
+    cache = []
+    best, cursor = int(np.argmax(triangle_scores)), 0
+    while True:
+        order.append(best)
+        emitted[best] = True
+        triangle = corners[best]
+        for v in triangle:
+            # move the triangle past the live range of its vertices
+            start, last = starts[v], starts[v] + live[v] - 1
+            i = adjacency.index(best, start, last + 1)
+            adjacency[i], adjacency[last] = adjacency[last], adjacency[i]
+            live[v] -= 1
+        touched = triangle + [v for v in cache if v not in triangle]
+        cache = touched[:cache_size]
+        for v in touched[cache_size:]:
+            position[v] = -1
+        for p, v in enumerate(cache):
+            position[v] = p
+        for v in touched:
+            p = position[v]
+            score = valence_scores[live[v]] if live[v] else 0.0
+            if live[v] and p >= 0:
+                score += cache_scores[p]
+            delta = score - vertex_scores[v]
+            vertex_scores[v] = score
+            if delta:
+                for t in adjacency[starts[v]:starts[v] + live[v]]:
+                    triangle_scores[t] += delta
+        best, best_score = -1, -1.0
+        for v in cache:
+            for t in adjacency[starts[v]:starts[v] + live[v]]:
+                if triangle_scores[t] > best_score:
+                    best, best_score = t, triangle_scores[t]
+        if best < 0:
+            # dead end, restart from the first triangle left
+            while cursor < m and emitted[cursor]:
+                cursor += 1
+            if cursor == m:
+                break
+            best = cursor
+    return np.array(order, dtype=np.int64)
+
+
+def compute_normals(mesh, crease_angle=None):
+    '''Sets smooth vertex normals on a TRIANGLES `mesh`, see
+    `smooth_normals()`, replacing its normals if any. Vertices are split
+    where the crease angle requires it. The normals are added to the attribs
+    as 'normal'.
+
+    Raises
+    ------
+    BadPrimitiveError: if the mesh is not made of triangles.
+    '''
+    if mesh.primitive != Primitive.TRIANGLES:
+        raise BadPrimitiveError()
+    interleaved = mesh.layout == 'interleaved'
+    mesh.planarize()
+    mesh.attribs.pop('normal', None)
+    mesh._normals = None  # the old normals are not split with the vertices
+    normals, source, triangles = smooth_normals(
+        mesh.positions, primitives(mesh), crease_angle
+    )
+    if crease_angle is not None:
+        select_vertices(mesh, source, triangles)
+    mesh.normals = normals.astype(np.float32)
+    mesh.attribs['normal'] = mesh.normals
+    if interleaved:
+        mesh.interleave()
+
+
+def optimize_vertices(mesh):
+    '''Reorders the vertices of `mesh` in the order the primitives first use
+    them, so that vertex fetches walk the buffers mostly forward. Unused
+    vertices are dropped.'''
+    indices = primitives(mesh)
+    used, first = np.unique(indices.ravel(), return_index=True)
+    kept = used[np.argsort(first)]
+    remap = np.full(mesh.positions.shape[1], -1, dtype=np.int64)
+    remap[kept] = np.arange(kept.size)
+    remap_vertices(mesh, kept, remap)
+
+
+def narrow_indices(mesh):
+    '''Stores the indices of `mesh` as uint16 if it has at most 65536
+    vertices, halving the index buffer.'''
+    if mesh.positions.shape[1] <= 2**16:
+        mesh.indices = primitives(mesh).T.astype(np.uint16)
+
+
+def vertex_arrays(mesh):
+    '''Returns a dict with the distinct per vertex arrays of `mesh`: the
+    positions, normals and colors, if any, and the attribs that are none of
+    them, keyed by attribute name.'''
+    arrays = {}
+    for name in ['positions', 'normals', 'colors']:
+        array = getattr(mesh, name)
+        if array is not None and all(array is not a for a in arrays.values()):
+            arrays[name] = array
+    for name, array in mesh.attribs.items():
+        if all(array is not a for a in arrays.values()):
+            arrays[name] = array
+    return arrays
+
+
+def remap_vertices(mesh, kept, remap):
+    '''Keeps the vertices of `mesh` at the indices `kept`, in that order, and
+    rewrites the indices through `remap`, the new index of every old vertex.
+    Aliased arrays stay aliased and the vertex layout is preserved.'''
+    indices = primitives(mesh)
+    select_vertices(mesh, kept, remap[indices].astype(indices.dtype))
+
+
+def select_vertices(mesh, kept, indices):
+    '''Replaces the vertices of `mesh` by its vertices at the indices `kept`,
+    which may repeat some of them, and its primitives by the (M, k)
+    `indices` into the new vertices. Aliased arrays stay aliased and the
+    vertex layout is preserved.'''
+    interleaved = mesh.layout == 'interleaved'
+    mesh.planarize()
+    new = {}  # id(old array) -> new array
+    for array in vertex_arrays(mesh).values():
+        new[id(array)] = np.asfortranarray(np.asarray(array)[:, kept])
+    for name in ['positions', 'normals', 'colors']:
+        array = getattr(mesh, name)
+        if array is not None:
+            setattr(mesh, name, new[id(array)])
+    mesh._rebind_attribs(new)
+    set_primitives(mesh, indices)
+    if interleaved:
+        mesh.interleave()
+
+
+def set_primitives(mesh, indices):
+    '''Sets the indices of `mesh` from an (M, k) array.'''
+    mesh.indices = np.asarray(indices).T
+    mesh.no_indices = indices.shape[0]
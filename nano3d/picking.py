@@ -0,0 +1,220 @@
+import numpy as np
+
+from nano3d.bvh import ray_aabbs
+from nano3d.culling import transform_aabbs
+from nano3d.mesh import ChunkedMesh, Primitive
+from nano3d.scene import InstancedNode
+
+
+class Hit():
+    '''The result of a successful pick.'''
+    def __init__(self, node, triangle, distance, point, instance=None):
+        '''
+        Parameters
+        ----------
+        node: the `Node` that was hit.
+        triangle: the index of the triangle of the node mesh that was hit,
+            among all the chunks for a `ChunkedMesh`.
+        distance: the ray parameter of the hit, i.e: the distance along the ray
+            in units of its direction length.
+        point: the world space position of the hit.
+        instance: the index of the instance that was hit, for an
+            `InstancedNode`.
+        '''
+        self.node = node
+        self.triangle = triangle
+        self.distance = distance
+        self.point = point
+        self.instance = instance
+
+
+def unproject(camera_node, pos, size):
+    '''Returns a tuple (origin, direction) with the world space ray going
+    through the screen point `pos`, starting at the camera near plane. The
+    direction is normalized.
+
+    Parameters
+    ----------
+    camera_node: the `CameraNode` the scene is seen from.
+    pos: a 2-tuple with the screen coordinates in pixels, origin at the top
+        left corner, e.g: a mouse position.
+    size: a 2-tuple with width and height of the viewport.
+    '''
+    w, h = size
+    x = 2.0*pos[0]/w - 1.0
+    y = 1.0 - 2.0*pos[1]/h
+    clip_to_world = np.linalg.inv(
+        camera_node.projection_mat(size) @ camera_node.view_mat()
+    )
+    near = clip_to_world @ np.array([x, y, -1.0, 1.0])
+    far = clip_to_world @ np.array([x, y, 1.0, 1.0])
+    near, far = near[:-1]/near[-1], far[:-1]/far[-1]
+    direction = far - near
+    return near, direction/np.linalg.norm(direction)
+
+
+def ray_triangles(origin, direction, triangles):
+    '''Intersects a ray with many triangles at once using the Moller-Trumbore
+    algorithm. Returns an (M,) array with the ray parameter of the hit with
+    each of the (M, 3, 3) `triangles`, inf where the ray misses. Hits behind
+    the origin are misses.'''
+    eps = 1e-12
+    v0, e1, e2 = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    e1, e2 = e1 - v0, e2 - v0
+    p = np.cross(direction, e2)
+    det = np.einsum('ij,ij->i', e1, p)
+    valid = np.abs(det) > eps
+    inv = np.where(valid, 1.0/np.where(valid, det, 1.0), 0.0)
+    s = origin - v0
+    u = np.einsum('ij,ij->i', s, p)*inv
+    q = np.cross(s, e1)
+    v = (q @ direction)*inv
+    t = np.einsum('ij,ij->i', e2, q)*inv
+    hit = valid & (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0) & (t >= 0.0)
+    return np.where(hit, t, np.inf)
+
+
+def ray_mesh(origin, direction, mesh, world=None):
+    '''Returns a tuple (triangle, distance) with the nearest triangle of a
+    TRIANGLES `mesh` hit by the ray, or (-1, inf) on a miss. The triangle
+    BVH of the mesh narrows the search to the triangles whose boxes are hit.
+
+    Parameters
+    ----------
+    origin, direction: the world space ray.
+    mesh: the `Mesh` to intersect.
+    world: the 4x4 world matrix of the mesh, identity if None. The ray is
+        taken to model space rather than transforming the triangles, which
+        keeps the ray parameter unchanged.
+    '''
+    origin = np.asarray(origin, dtype=np.float64)
+    direction = np.asarray(direction, dtype=np.float64)
+    if world is not None:
+        inv = np.linalg.inv(world)
+        origin = inv[:-1, :-1] @ origin + inv[:-1, -1]
+        direction = inv[:-1, :-1] @ direction
+    candidates, _ = mesh.triangle_bvh().query_ray(origin, direction)
+    if candidates.size == 0:
+        return -1, np.inf
+    tris = mesh.triangles(candidates).astype(np.float64)
+    t = ray_triangles(origin, direction, tris)
+    best = np.argmin(t)
+    if np.isinf(t[best]):
+        return -1, np.inf
+    return int(candidates[best]), float(t[best])
+
+
+def ray_chunks(origin, direction, mesh, world):
+    '''Returns a tuple (triangle, distance) with the nearest triangle of a
+    TRIANGLES `ChunkedMesh` hit by the ray, or (-1, inf) on a miss. Chunks
+    are visited front to back by the distance to their bounds, and only the
+    ones the ray hits are loaded.
+
+    Parameters
+    ----------
+    origin, direction: the world space ray.
+    mesh: the `ChunkedMesh`.
+    world: the 4x4 world matrix of the mesh.
+    '''
+    inv = np.linalg.inv(world)
+    origin = inv[:-1, :-1] @ np.asarray(origin, np.float64) + inv[:-1, -1]
+    direction = inv[:-1, :-1] @ np.asarray(direction, np.float64)
+    bounds = mesh.bounds
+    tnear, tfar = ray_aabbs(origin, direction, bounds[:, 0], bounds[:, 1])
+    hit = np.flatnonzero(tnear <= tfar)
+    best = (-1, np.inf)
+    for i in hit[np.argsort(tnear[hit], kind='stable')]:
+        if tnear[i] > best[1]:
+            break
+        triangle, distance = ray_mesh(origin, direction, mesh.chunk(i))
+        if distance < best[1]:
+            best = (int(i)*mesh.chunk_size + triangle, distance)
+    return best
+
+
+def ray_instances(origin, direction, node, world):
+    '''Returns a tuple (instance, triangle, distance) with the nearest
+    triangle hit by the ray among the instances of an `InstancedNode`, or
+    (-1, -1, inf) on a miss. Instances are visited front to back by the
+    distance to their bounding box.
+
+    Parameters
+    ----------
+    origin, direction: the world space ray.
+    node: the `InstancedNode`.
+    world: the 4x4 world matrix of the node.
+    '''
+    mats = node.instance_mats(world)
+    aabbs = node.instance_aabbs(mats)
+    tnear, tfar = ray_aabbs(origin, direction, aabbs[:, 0], aabbs[:, 1])
+    hit = np.flatnonzero(tnear <= tfar)
+    best = (-1, -1, np.inf)
+    for instance in hit[np.argsort(tnear[hit], kind='stable')]:
+        if tnear[instance] > best[2]:
+            break
+        triangle, distance = ray_mesh(
+            origin, direction, node.mesh, mats[instance]
+        )
+        if distance < best[2]:
+            best = (int(instance), triangle, distance)
+    return best
+
+
+def pick(scene, origin, direction):
+    '''Returns the `Hit` with the nearest triangle of the scene hit by the ray
+    `origin + t*direction`, or None. Only visible nodes with TRIANGLES meshes
+    are considered. Nodes are visited front to back by the distance to their
+    bounding box, through the scene BVH when there is one, and the search
+    stops as soon as no remaining box can hold a nearer hit.
+    '''
+    nodes = scene.nodes
+    worlds = scene.world_mats()
+    if scene.bvh is not None:
+        scene.bvh.update()
+        rows, tnear = scene.bvh.query_ray(origin, direction)
+    else:
+        rows = np.array([
+            i for i, node in enumerate(nodes)
+            if node.mesh is not None and node.aabb() is not None
+        ], dtype=np.int64)
+        aabbs = np.array([nodes[i].aabb() for i in rows])
+        aabbs = transform_aabbs(aabbs.reshape(-1, 2, 3), worlds[rows])
+        tnear, tfar = ray_aabbs(origin, direction, aabbs[:, 0], aabbs[:, 1])
+        hit = tnear <= tfar
+        order = np.argsort(tnear[hit], kind='stable')
+        rows, tnear = rows[hit][order], tnear[hit][order]
+
+    best = None
+    for row, t in zip(rows, tnear):
+        if best is not None and t > best.distance:
+            break
+        node = nodes[row]
+        if not node.visible or node.mesh.primitive != Primitive.TRIANGLES:
+            continue
+        instance = None
+        if isinstance(node, InstancedNode):
+            instance, triangle, distance = ray_instances(
+                origin, direction, node, worlds[row]
+            )
+        elif isinstance(node.mesh, ChunkedMesh):
+            triangle, distance = ray_chunks(
+                origin, direction, node.mesh, worlds[row]
+            )
+        elif node.mesh.indices is None:
+            continue
+        else:
+            triangle, distance = ray_mesh(
+                origin, direction, node.mesh, worlds[row]
+            )
+        if best is None or distance < best.distance:
+            if triangle >= 0:
+                point = np.asarray(origin) + distance*np.asarray(direction)
+                best = Hit(node, triangle, distance, point, instance)
+    return best
+
+
+def pick_screen(scene, camera_node, pos, size):
+    '''Returns the `Hit` under the screen point `pos`, or None, see
+    `unproject()` and `pick()`.'''
+    origin, direction = unproject(camera_node, pos, size)
+    return pick(scene, origin, direction)
@@ -0,0 +1,202 @@
+from collections import deque
+import functools
+import json
+import os
+import threading
+import time
+
+
+class Profiler():
+    '''Frame profiler: nested scoped timers and counters recorded frame by
+    frame into a ring buffer of the most recent frames.
+
+    A frame is recorded between `begin_frame()` and `end_frame()`. Within
+    it, `scope(name)` returns a context manager timing its block, scopes
+    nest, and `count(name, value)` accumulates a per frame counter, e.g: the
+    draws or the bytes uploaded. Recorded frames can be exported as a Chrome
+    trace, see `chrome_trace()`, and opened in chrome://tracing or Perfetto.
+
+    A disabled profiler records nothing: `begin_frame()` does not start a
+    frame, and outside a frame `scope()` returns a shared do-nothing context
+    manager and `count()` returns right away, so instrumented code only pays
+    for a method call.
+    '''
+    def __init__(self, frames=300, enabled=False):
+        '''
+        Parameters
+        ----------
+        frames: the number of recent frames kept.
+        enabled: whether frames are recorded, can be toggled at any time.
+        '''
+        self.enabled = enabled
+        self.frames = deque(maxlen=frames)  # FrameRecord objects
+        self.index = 0  # number of frames begun while enabled
+        self.origin = time.perf_counter_ns()  # time 0 of the traces
+        self._frame = None  # the frame being recorded, if any
+        self._depth = 0
+
+    @property
+    def recording(self):
+        '''Whether a frame is being recorded.'''
+        return self._frame is not None
+
+    def begin_frame(self):
+        '''Starts recording a frame, if enabled.'''
+        if not self.enabled:
+            return
+        self._frame = FrameRecord(self.index, time.perf_counter_ns())
+        self._depth = 0
+        self.index += 1
+
+    def end_frame(self):
+        '''Stops recording the current frame and keeps it in `frames`.'''
+        frame = self._frame
+        if frame is None:
+            return
+        frame.duration = time.perf_counter_ns() - frame.start
+        self.frames.append(frame)
+        self._frame = None
+
+    def scope(self, name, **args):
+        '''Returns a context manager timing its block as a scope named
+        `name` of the current frame, with the optional `args` attached to it
+        in the trace.'''
+        if self._frame is None:
+            return _NULL_SCOPE
+        return Scope(self, name, args)
+
+    def count(self, name, value=1):
+        '''Adds `value` to the counter `name` of the current frame.'''
+        frame = self._frame
+        if frame is None:
+            return
+        frame.counters[name] = frame.counters.get(name, 0) + value
+
+    def wrap(self, function, name=None):
+        '''Returns `function` timed as a scope, by default named after it,
+        e.g: to profile the handlers of an application.'''
+        name = function.__name__ if name is None else name
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.scope(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    def clear(self):
+        self.frames.clear()
+
+    def summary(self):
+        '''Returns a dict with, for every scope name, a dict with the number
+        of 'calls' and the 'mean' and 'max' time in milliseconds spent in it
+        per frame over the recorded frames. The whole frames are under the
+        name 'frame'.'''
+        totals = {}  # name -> [calls, list of the time of every frame]
+        for frame in self.frames:
+            times = {'frame': frame.duration}
+            calls = {'frame': 1}
+            for name, _, duration, _, _, _ in frame.events:
+                times[name] = times.get(name, 0) + duration
+                calls[name] = calls.get(name, 0) + 1
+            for name in times:
+                entry = totals.setdefault(name, [0, []])
+                entry[0] += calls[name]
+                entry[1].append(times[name])
+        return {
+            name: {
+                'calls': calls,
+                'mean': 1e-6*sum(times)/len(times),
+                'max': 1e-6*max(times),
+            }
+            for name, (calls, times) in totals.items()
+        }
+
+    def chrome_trace(self):
+        '''Returns the recorded frames in the Chrome trace event format, as a
+        JSON serializable dict: frames and scopes are complete ('X') events
+        and the counters of every frame a counter ('C') event.'''
+        pid = os.getpid()
+        events = []
+
+        def us(ns):
+            return 1e-3*(ns - self.origin)
+
+        for frame in self.frames:
+            events.append({
+                'name': 'frame', 'ph': 'X', 'pid': pid, 'tid': frame.thread,
+                'ts': us(frame.start), 'dur': 1e-3*frame.duration,
+                'args': {'index': frame.index},
+            })
+            for name, start, duration, depth, thread, args in frame.events:
+                events.append({
+                    'name': name, 'ph': 'X', 'pid': pid, 'tid': thread,
+                    'ts': us(start), 'dur': 1e-3*duration, 'args': args,
+                })
+            if frame.counters:
+                events.append({
+                    'name': 'counters', 'ph': 'C', 'pid': pid,
+                    'ts': us(frame.start), 'args': dict(frame.counters),
+                })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save_chrome_trace(self, path):
+        '''Writes `chrome_trace()` as JSON to the file `path`.'''
+        with open(str(path), 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+class FrameRecord():
+    '''The scopes and counters recorded during a frame. Times are
+    `time.perf_counter_ns()` values.'''
+    __slots__ = ['index', 'start', 'duration', 'thread', 'events', 'counters']
+
+    def __init__(self, index, start):
+        self.index = index
+        self.start = start
+        self.duration = 0
+        self.thread = threading.get_ident()
+        # (name, start, duration, depth, thread, args) of every scope, in
+        # the order they ended
+        self.events = []
+        self.counters = {}
+
+
+class Scope():
+    '''Context manager recording a scope into the current frame.'''
+    __slots__ = ['profiler', 'name', 'args', 'start', 'depth']
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.depth = self.profiler._depth
+        self.profiler._depth += 1
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        profiler = self.profiler
+        profiler._depth -= 1
+        if profiler._frame is not None:
+            profiler._frame.events.append((
+                self.name, self.start, end - self.start, self.depth,
+                threading.get_ident(), self.args,
+            ))
+        return False
+
+
+class NullScope():
+    '''Context manager doing nothing, returned by disabled profilers.'''
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SCOPE = NullScope()
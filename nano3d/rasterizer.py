@@ -0,0 +1,790 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from nano3d import culling, picking
+from nano3d.lod import lod_chain
+from nano3d.mesh import (
+    ChunkedMesh, DynamicMesh, InfiniteGrid, Polyline, Primitive,
+)
+from nano3d.profiler import Profiler
+from nano3d.scene import InstancedNode, MissingCameraNodeError
+
+
+class SoftwareRenderer():
+    '''A renderer that rasterizes POINTS, LINES and TRIANGLES meshes on the
+    CPU into NumPy color and depth buffers, without OpenGL. It takes the same
+    scene, camera node and meshes as `renderer.Renderer` and mimics its
+    output: per vertex colors (or the flat lighting of `Dae` meshes), depth
+    testing, no face culling.
+
+    The frame is built in three vectorized stages: vertices of every visible
+    node are transformed to clip space and their primitives clipped against
+    the near plane, primitives are binned into screen tiles by their bounding
+    boxes, and every tile is rasterized for batches of primitives at once.
+
+    Tiles cover disjoint pixels, so with `workers` > 1 they are rasterized
+    concurrently by a pool of threads writing straight into the shared
+    buffers. NumPy releases the GIL inside the per tile kernels, and since
+    every pixel is owned by exactly one tile the output does not depend on
+    the number of workers nor on scheduling.
+    '''
+    def __init__(self, name, scene, camera, size=(640, 480), tile_size=32,
+            background=(0.1, 0.1, 0.1, 1.0), workers=1,
+    ):
+        '''
+        Parameters
+        ----------
+        name: a string that identifies the renderer.
+        scene: the `Scene` to render.
+        camera: the name of the camera node to render from.
+        size: a 2-tuple with the width and height of the framebuffer.
+        tile_size: width and height in pixels of the screen tiles.
+        background: the RGBA color the framebuffer is cleared to.
+        workers: the number of threads rasterizing tiles in parallel.
+
+        Raises
+        ------
+        MissingCameraNodeError: when `camera` does not match any of the
+            available cameras.
+        '''
+        self.name = name
+        self.scene = scene
+        self.camera_name = camera
+        self.camera_node = None
+        self.tile_size = tile_size
+        self.batch_size = 64  # primitives rasterized at once within a tile
+        self.background = np.array(background, dtype=np.float32)
+        self.workers = workers
+        self._pool = None
+        self.lod = None  # see `enable_lod()`
+        self.profiler = Profiler()  # see `renderer.Renderer.profiler`
+        for node in scene.nodes:
+            if node.name == self.camera_name:
+                self.camera_node = node
+        if self.camera_node == None:
+            raise MissingCameraNodeError()
+        self.resize_handler(size)
+
+    def resize_handler(self, size):
+        '''Reallocates the framebuffer for a new viewport size.'''
+        self.size = tuple(size)
+        w, h = self.size
+        self.color = np.empty((h, w, 4), dtype=np.float32)
+        self.depth = np.empty((h, w), dtype=np.float32)
+        self.projection = self.camera_node.projection_mat(size)
+        self.clear()
+
+    def close(self):
+        '''Shuts down the worker threads, if any.'''
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    @property
+    def pool(self):
+        '''The thread pool tiles are rasterized with, None for a single
+        worker.'''
+        if self._pool is None and self.workers > 1:
+            self._pool = ThreadPoolExecutor(self.workers)
+        return self._pool
+
+    def enable_lod(self, max_error=1.0, **kwargs):
+        '''Renders TRIANGLES meshes at the coarsest level of detail whose
+        geometric error projects to at most `max_error` pixels, see
+        `renderer.Renderer.enable_lod()`.'''
+        self.lod = dict(kwargs, max_error=max_error)
+
+    def select_lod(self, mesh, world, view, projection):
+        '''Returns the level of detail of `mesh` to render this frame.'''
+        options = dict(self.lod)
+        max_error = options.pop('max_error')
+        chain = lod_chain(mesh, **options)
+        return chain.meshes[chain.select(
+            world, view, projection, self.size[1], max_error
+        )]
+
+    def clear(self):
+        self.color[...] = self.background
+        self.depth[...] = 1.0
+
+    def visible_nodes(self):
+        '''Returns the nodes visible from the camera node, see
+        `culling.visible_nodes()`.'''
+        return culling.visible_nodes(
+            self.scene, self.camera_node, self.projection
+        )
+
+    def pick(self, pos):
+        '''Returns the `picking.Hit` under the screen point `pos`, or None.'''
+        return picking.pick_screen(
+            self.scene, self.camera_node, pos, self.size
+        )
+
+    def draw_handler(self):
+        '''Renders the scene from the camera node into `color` and `depth`.'''
+        self.profiler.begin_frame()
+        with self.profiler.scope('view_mat'):
+            view = self.camera_node.view_mat()
+        self.render(view, self.projection)
+        self.profiler.end_frame()
+
+    def image(self):
+        '''Returns the color buffer as an (h, w, 4) uint8 array.'''
+        return (np.clip(self.color, 0.0, 1.0)*255.0 + 0.5).astype(np.uint8)
+
+    def render_views(self, views, projections=None, depth=False):
+        '''Renders the scene from many views, yielding one image per view as
+        a new (h, w, 4) uint8 array, or a tuple (image, depth) if `depth`.
+        The world space geometry is computed once for the whole batch (see
+        `SceneGeometry`), each view only transforms, culls and rasterizes.
+        The scene must not change while iterating.
+
+        Parameters
+        ----------
+        views: an (M, 4, 4) array, or iterable, of view matrices.
+        projections: a 4x4 projection matrix shared by all the views, an
+            (M, 4, 4) array of them, or None for the camera node projection.
+        depth: whether to yield a copy of the depth buffer too.
+        '''
+        geometry = None  # built within the first frame, to profile it
+        if projections is None:
+            projections = self.projection
+        projections = np.asarray(projections)
+        for i, view in enumerate(views):
+            projection = projections if projections.ndim == 2 \
+                else projections[i]
+            self.profiler.begin_frame()
+            if geometry is None:
+                with self.profiler.scope('scene_geometry'):
+                    geometry = SceneGeometry(self.scene)
+            self.clear()
+            frame = Frame(self.size)
+            with self.profiler.scope('geometry'):
+                geometry.add_to(frame, projection @ view)
+                for node, world in geometry.view_dependent:
+                    self.add_node(frame, node, world, view, projection)
+            self.rasterize(frame)
+            self.profiler.end_frame()
+            yield (self.image(), self.depth.copy()) if depth else self.image()
+
+    def write_views(self, views, directory, projections=None,
+            pattern='view{:05d}.ppm', writers=4,
+    ):
+        '''Renders the scene from many views, see `render_views()`, and writes
+        the images to `directory` while the next views are rendered. Returns
+        the list of written paths.
+
+        Parameters
+        ----------
+        directory: where the images are written, created if missing.
+        pattern: format string for the file names, given the view index. The
+            extension selects the format, see `save_image()`.
+        writers: the number of threads writing images.
+        '''
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        paths, futures = [], []
+        with ThreadPoolExecutor(writers) as pool:
+            images = self.render_views(views, projections)
+            for i, image in enumerate(images):
+                paths.append(directory / pattern.format(i))
+                futures.append(pool.submit(save_image, paths[-1], image))
+            for future in futures:
+                future.result()  # raises what the write raised
+        return paths
+
+    def render(self, view, projection):
+        '''Renders the scene seen through the `view` and `projection`
+        matrices into `color` and `depth`.'''
+        profiler = self.profiler
+        self.clear()
+        frame = Frame(self.size)
+        clip_mat = projection @ view
+        with profiler.scope('cull'):
+            mask = culling.frustum_mask(
+                self.scene, culling.frustum_planes(clip_mat)
+            )
+        with profiler.scope('world_mats'):
+            worlds = self.scene.world_mats()
+        with profiler.scope('geometry'):
+            for i in np.flatnonzero(mask):
+                node = self.scene.nodes[i]
+                with profiler.scope(node.name):
+                    self.add_node(frame, node, worlds[i], view, projection)
+        self.rasterize(frame)
+
+    def add_node(self, frame, node, world, view, projection):
+        '''Adds the primitives of `node` to `frame`.'''
+        clip_mat = projection @ view
+        mvp = clip_mat @ world
+        if isinstance(node, InstancedNode):
+            mats = node.instance_mats(world)
+            frame.add_instances(node.mesh, clip_mat, mats, node.colors)
+            meshes = [(node.mesh, len(mats))]
+        elif isinstance(node.mesh, ChunkedMesh):
+            meshes = []
+            for _, chunk in node.mesh.chunks(node.mesh.visible_chunks(mvp)):
+                frame.add(chunk, mvp)
+                meshes.append((chunk, 1))
+        elif isinstance(node.mesh, InfiniteGrid):
+            node.mesh.follow(np.linalg.inv(view @ world)[:3, 3])
+            frame.add(node.mesh, mvp)
+            meshes = [(node.mesh, 1)]
+        elif isinstance(node.mesh, Polyline):
+            mesh = node.mesh.decimate(mvp, self.size)
+            frame.add(mesh, mvp)
+            meshes = [(mesh, 1)]
+        elif self.lod is not None and not isinstance(node.mesh, DynamicMesh) \
+                and node.mesh.primitive == Primitive.TRIANGLES:
+            mesh = self.select_lod(node.mesh, world, view, projection)
+            frame.add(mesh, mvp)
+            meshes = [(mesh, 1)]
+        else:
+            frame.add(node.mesh, mvp)
+            meshes = [(node.mesh, 1)]
+        if not self.profiler.recording:
+            return
+        for mesh, copies in meshes:
+            self.profiler.count('draws')
+            if mesh.primitive == Primitive.TRIANGLES:
+                triangles = copies*len(mesh_primitives(mesh))
+                self.profiler.count('triangles', triangles)
+
+    def rasterize(self, frame):
+        '''Rasterizes `frame` into `color` and `depth`.'''
+        with self.profiler.scope('rasterize'):
+            frame.rasterize(
+                self.color, self.depth, self.tile_size, self.batch_size,
+                pool=self.pool,
+            )
+
+
+def save_image(path, image):
+    '''Writes an (h, w, 4) uint8 `image` to `path`, as a binary PPM (alpha
+    is dropped) or, for a `.npy` extension, as a NumPy array.'''
+    path = str(path)
+    if path.endswith('.npy'):
+        np.save(path, image)
+        return
+    h, w = image.shape[:2]
+    with open(path, 'wb') as f:
+        f.write('P6\n{} {}\n255\n'.format(w, h).encode())
+        f.write(np.ascontiguousarray(image[..., :3]).tobytes())
+
+
+def load_ppm(path):
+    '''Reads a binary PPM written by `save_image()` into an (h, w, 3) uint8
+    array.'''
+    with open(str(path), 'rb') as f:
+        magic, size, maxval, data = f.read().split(b'\n', 3)
+    w, h = (int(v) for v in size.split())
+    return np.frombuffer(data, dtype=np.uint8).reshape(h, w, 3)
+
+
+class SceneGeometry():
+    '''The world space geometry of the visible nodes of a scene, computed
+    once and then projected for any number of views: homogeneous world
+    vertices, vertex colors, primitives and world bounding boxes. The scene
+    must not change while it is in use.
+
+    Chunks of `ChunkedMesh` nodes are not flattened, they are still loaded
+    per view as they become visible so that their memory budget holds, and
+    instances of `InstancedNode` are only expanded when inside the view.
+    Meshes generated for the view, `Polyline` and `InfiniteGrid`, are left
+    in `view_dependent`.
+    '''
+    def __init__(self, scene):
+        self.meshes = []  # (world vertices, colors, primitives, primitive)
+        self.chunked = []  # (mesh, world matrix)
+        self.instanced = []  # (mesh, instance world matrices, colors)
+        # (node, world matrix) of the nodes whose geometry depends on the
+        # view, which are added per view, see `SoftwareRenderer.add_node()`
+        self.view_dependent = []
+        aabbs, mats, bounded = [], [], []
+        for node, world in zip(scene.nodes, scene.world_mats()):
+            mesh = node.mesh
+            if mesh is None or not node.visible:
+                continue
+            if isinstance(node, InstancedNode):
+                self.instanced.append((
+                    mesh, node.instance_mats(world), node.colors
+                ))
+                continue
+            if isinstance(mesh, ChunkedMesh):
+                self.chunked.append((mesh, world))
+                continue
+            if isinstance(mesh, (InfiniteGrid, Polyline)):
+                self.view_dependent.append((node, world))
+                continue
+            if mesh.positions is None or mesh.indices is None:
+                continue
+            self.meshes.append((
+                to_clip(mesh.positions, world), vertex_colors(mesh),
+                mesh_primitives(mesh), mesh.primitive,
+            ))
+            aabb = mesh.aabb()
+            # meshes without bounds, e.g: an InfiniteGrid, are always drawn
+            aabbs.append(np.zeros((2, 3)) if aabb is None else aabb)
+            mats.append(world)
+            bounded.append(aabb is not None)
+        self.aabbs = np.zeros((0, 2, 3))
+        self.bounded = np.array(bounded, dtype=bool)
+        if aabbs:
+            self.aabbs = culling.transform_aabbs(
+                np.array(aabbs), np.array(mats)
+            )
+
+    def add_to(self, frame, clip_mat):
+        '''Adds the geometry inside the frustum of the world to clip space
+        matrix `clip_mat` to `frame`.'''
+        planes = culling.frustum_planes(clip_mat)
+        inside = culling.aabbs_in_frustum(planes, self.aabbs) | ~self.bounded
+        for i in np.flatnonzero(inside):
+            world, colors, prims, primitive = self.meshes[i]
+            frame.add_primitives(world @ clip_mat.T, colors, prims, primitive)
+        for mesh, mats, tints in self.instanced:
+            frame.add_instances(mesh, clip_mat, mats, tints)
+        for mesh, world in self.chunked:
+            mvp = clip_mat @ world
+            for _, chunk in mesh.chunks(mesh.visible_chunks(mvp)):
+                frame.add(chunk, mvp)
+
+
+class Frame():
+    '''Screen space primitives of a frame, ready to be rasterized.'''
+    def __init__(self, size):
+        self.size = size
+        # triangles: (M, 3, 2) screen xy, (M, 3) depth, (M, 3) 1/w and
+        # (M, 3, 4) colors
+        self.tris = [[], [], [], []]
+        # fragments of points and lines: pixel x, pixel y, depth and colors
+        self.frags = [[], [], [], []]
+
+    def add(self, mesh, mvp):
+        '''Transforms, clips and projects the primitives of `mesh`.'''
+        if mesh.positions is None or mesh.indices is None:
+            return
+        self.add_primitives(
+            to_clip(mesh.positions, mvp), vertex_colors(mesh),
+            mesh_primitives(mesh), mesh.primitive,
+        )
+
+    def add_instances(self, mesh, clip_mat, mats, tints):
+        '''Transforms, clips and projects the primitives of one copy of `mesh`
+        per instance inside the frustum of `clip_mat`.
+
+        Parameters
+        ----------
+        mesh: the `Mesh` of the instances.
+        clip_mat: the world to clip space matrix.
+        mats: an (I, 4, 4) array with the world matrices of the instances.
+        tints: an (I, 4) array with the colors the instance vertex colors are
+            multiplied with.
+        '''
+        if mesh.positions is None or mesh.indices is None:
+            return
+        planes = culling.frustum_planes(clip_mat)
+        aabb = mesh.aabb()
+        inside = culling.aabbs_in_frustum(planes, culling.transform_aabbs(
+            np.broadcast_to(aabb, (len(mats), 2, 3)), mats
+        ))
+        mats, tints = mats[inside], tints[inside]
+        n = mesh.positions.shape[1]
+        clip = to_clip(mesh.positions, clip_mat @ mats).reshape(-1, 4)
+        colors = vertex_colors(mesh)*tints[:, np.newaxis]
+        prims = mesh_primitives(mesh)
+        prims = prims + n*np.arange(len(mats))[:, np.newaxis, np.newaxis]
+        self.add_primitives(
+            clip, colors.reshape(-1, 4), prims.reshape(-1, prims.shape[-1]),
+            mesh.primitive,
+        )
+
+    def add_primitives(self, clip, colors, prims, primitive):
+        '''Clips and projects primitives given by their vertices.
+
+        Parameters
+        ----------
+        clip: (N, 4) clip space coordinates of the vertices.
+        colors: (N, 4) colors of the vertices.
+        prims: (M, k) vertex indices of the primitives, see
+            `mesh_primitives()`.
+        primitive: a `Primitive`.
+        '''
+        if primitive == Primitive.TRIANGLES:
+            self._add_triangles(clip[prims], colors[prims])
+        elif primitive == Primitive.LINES:
+            self._add_lines(clip[prims], colors[prims])
+        else:
+            self._add_points(clip[prims[:, 0]], colors[prims[:, 0]])
+
+    def _to_screen(self, clip):
+        '''Perspective divide and viewport transform of (..., 4) clip space
+        coordinates. Returns screen xy, depth in [0, 1] and 1/w.'''
+        w, h = self.size
+        invw = 1.0/clip[..., 3]
+        ndc = clip[..., :3]*invw[..., np.newaxis]
+        xy = np.empty(ndc.shape[:-1] + (2,))
+        xy[..., 0] = (ndc[..., 0] + 1.0)*0.5*w
+        xy[..., 1] = (1.0 - ndc[..., 1])*0.5*h
+        return xy, (ndc[..., 2] + 1.0)*0.5, invw
+
+    def _add_triangles(self, clip, colors):
+        # trivially reject triangles fully outside one of the side planes
+        x, y, w = clip[..., 0], clip[..., 1], clip[..., 3]
+        outside = (
+            np.all(x > w, axis=1) | np.all(x < -w, axis=1)
+            | np.all(y > w, axis=1) | np.all(y < -w, axis=1)
+        )
+        clip, colors = clip[~outside], colors[~outside]
+        clip, colors = clip_triangles(clip, colors)
+        xy, depth, invw = self._to_screen(clip)
+        for lst, value in zip(self.tris, [xy, depth, invw, colors]):
+            lst.append(value)
+
+    def _add_lines(self, clip, colors):
+        clip, colors = clip_lines(clip, colors)
+        xy, depth, _ = self._to_screen(clip)
+        # one sample per pixel along the major axis of each line, lines are
+        # clipped to the viewport so the cap only guards against rounding
+        n = np.ceil(np.abs(xy[:, 1] - xy[:, 0]).max(axis=1)).astype(np.int64)
+        n = np.minimum(n, 4*max(self.size)) + 1
+        line = np.repeat(np.arange(n.size), n)
+        starts = np.cumsum(n) - n
+        t = (np.arange(line.size) - starts[line]) / np.maximum(n[line] - 1, 1)
+        t = t[:, np.newaxis]
+        pxy = xy[line, 0]*(1.0 - t) + xy[line, 1]*t
+        pdepth = depth[line, 0]*(1.0 - t[:, 0]) + depth[line, 1]*t[:, 0]
+        pcolor = colors[line, 0]*(1.0 - t) + colors[line, 1]*t
+        self._add_fragments(pxy, pdepth, pcolor)
+
+    def _add_points(self, clip, colors):
+        inside = clip[:, 3] > 0.0
+        xy, depth, _ = self._to_screen(clip[inside])
+        self._add_fragments(xy, depth, colors[inside])
+
+    def _add_fragments(self, xy, depth, colors):
+        w, h = self.size
+        px = np.floor(xy[:, 0]).astype(np.int64)
+        py = np.floor(xy[:, 1]).astype(np.int64)
+        keep = (
+            (px >= 0) & (px < w) & (py >= 0) & (py < h)
+            & (depth >= 0.0) & (depth <= 1.0)
+        )
+        for lst, value in zip(self.frags, [px, py, depth, colors]):
+            lst.append(value[keep])
+
+    def _concat(self, lists, shapes):
+        return [
+            np.concatenate(lst) if lst else np.zeros((0,) + shape)
+            for lst, shape in zip(lists, shapes)
+        ]
+
+    def tiles(self, xy, px, py, tile_size):
+        '''Bins primitives into screen tiles. Returns a list of
+        (x0, y0, x1, y1, triangles, fragments) tuples, one per tile with
+        anything to draw, where triangles and fragments are index arrays in
+        submission order.
+
+        Parameters
+        ----------
+        xy: (M, 3, 2) screen coordinates of the triangles.
+        px, py: (F,) pixel coordinates of the fragments.
+        tile_size: width and height in pixels of the tiles.
+        '''
+        w, h = self.size
+        nx, ny = -(-w // tile_size), -(-h // tile_size)
+        # tile ranges covered by each triangle bounding box
+        lo = np.floor(xy.min(axis=1) / tile_size).astype(np.int64)
+        hi = np.floor(xy.max(axis=1) / tile_size).astype(np.int64)
+        lo = np.maximum(lo, 0)
+        hi = np.minimum(hi, [nx - 1, ny - 1])
+        spans = hi - lo + 1
+        valid = np.all(spans > 0, axis=1)
+        tris = np.flatnonzero(valid)
+        counts = spans[tris, 0]*spans[tris, 1]
+        tri = np.repeat(tris, counts)
+        offset = np.arange(tri.size) \
+            - np.repeat(np.cumsum(counts) - counts, counts)
+        tx = lo[tri, 0] + offset % spans[tri, 0]
+        ty = lo[tri, 1] + offset // spans[tri, 0]
+        tri_tiles = ty*nx + tx
+        order = np.argsort(tri_tiles, kind='stable')
+        tri, tri_tiles = tri[order], tri_tiles[order]
+
+        frag_tiles = (py // tile_size)*nx + px // tile_size
+        frag = np.argsort(frag_tiles, kind='stable')
+        frag_tiles = frag_tiles[frag]
+
+        tiles = []
+        ids = np.union1d(tri_tiles, frag_tiles)
+        tri_bounds = np.searchsorted(tri_tiles, [ids, ids + 1])
+        frag_bounds = np.searchsorted(frag_tiles, [ids, ids + 1])
+        for k, tile in enumerate(ids):
+            x0, y0 = (tile % nx)*tile_size, (tile // nx)*tile_size
+            tiles.append((
+                x0, y0, min(x0 + tile_size, w), min(y0 + tile_size, h),
+                tri[tri_bounds[0, k]:tri_bounds[1, k]],
+                frag[frag_bounds[0, k]:frag_bounds[1, k]],
+            ))
+        return tiles
+
+    def rasterize(self, color, depth, tile_size, batch_size, small=16,
+            pool=None,
+    ):
+        '''Rasterizes all the primitives into the `color` and `depth`
+        buffers, one tile at a time, or concurrently on the executor `pool`.
+
+        Triangles whose bounding box covers at most `small` pixels are turned
+        into fragments up front, testing only the pixels of their boxes,
+        since evaluating them against whole tiles would mostly be wasted.
+        '''
+        xy, z, invw, colors = self._concat(
+            self.tris, [(3, 2), (3,), (3,), (3, 4)]
+        )
+        extent = np.ceil(xy.max(axis=1)) - np.floor(xy.min(axis=1))
+        is_small = extent[:, 0]*extent[:, 1] <= small
+        self._add_fragments(*triangle_fragments(
+            xy[is_small], z[is_small], invw[is_small], colors[is_small]
+        ))
+        large = ~is_small
+        tris = triangle_planes(xy[large], z[large]), invw[large], colors[large]
+        frags = self._concat(self.frags, [(), (), (), (4,)])
+        frags[0] = frags[0].astype(np.int64)
+        frags[1] = frags[1].astype(np.int64)
+        tiles = self.tiles(xy[large], frags[0], frags[1], tile_size)
+        if pool is None:
+            for tile in tiles:
+                raster_tile(tile, tris, frags, color, depth, batch_size)
+            return
+        futures = [
+            pool.submit(
+                raster_tile, tile, tris, frags, color, depth, batch_size
+            )
+            for tile in tiles
+        ]
+        for future in futures:
+            future.result()  # raises what the tile raised
+
+
+def raster_tile(tile, tris, frags, color, depth, batch_size):
+    '''Rasterizes the triangles and fragments binned into `tile` and writes
+    the ones passing the depth test into the `color` and `depth` buffers.
+    Only the pixels of the tile are written.'''
+    x0, y0, x1, y1, tri, frag = tile
+    tcolor = color[y0:y1, x0:x1].reshape(-1, 4)
+    tdepth = depth[y0:y1, x0:x1].reshape(-1)
+    if tri.size:
+        px, py = np.meshgrid(
+            np.arange(x0, x1) + 0.5, np.arange(y0, y1) + 0.5
+        )
+        px, py = px.ravel(), py.ravel()
+        planes, invw, colors = tris
+        for start in range(0, tri.size, batch_size):
+            batch = tri[start:start + batch_size]
+            _raster_triangles(
+                px, py, planes[batch], invw[batch], colors[batch],
+                tcolor, tdepth,
+            )
+    if frag.size:
+        fx, fy, fz, fcolor = frags
+        pixel = (fy[frag] - y0)*(x1 - x0) + fx[frag] - x0
+        z = fz[frag]
+        # nearest fragment per pixel, first submitted on ties
+        order = np.lexsort((np.arange(frag.size), z, pixel))
+        pixel, first = np.unique(pixel[order], return_index=True)
+        winners = order[first]
+        passed = z[winners] < tdepth[pixel]
+        pixel, winners = pixel[passed], winners[passed]
+        tdepth[pixel] = z[winners]
+        tcolor[pixel] = fcolor[frag[winners]]
+    color[y0:y1, x0:x1] = tcolor.reshape(y1 - y0, x1 - x0, 4)
+    depth[y0:y1, x0:x1] = tdepth.reshape(y1 - y0, x1 - x0)
+
+
+def _raster_triangles(px, py, planes, invw, colors, tcolor, tdepth):
+    '''Rasterizes a batch of B triangles over the P pixel centers (px, py)
+    of a tile, evaluating their planes (see `triangle_planes()`) as a
+    (B, 3, P) array.'''
+    values = planes[..., 0, np.newaxis]*px
+    values += planes[..., 1, np.newaxis]*py
+    values += planes[..., 2, np.newaxis]
+    l0, l1, depth = values[:, 0], values[:, 1], values[:, 2]
+    covered = (l0 >= 0.0) & (l1 >= 0.0) & (l0 + l1 <= 1.0) \
+        & (depth >= 0.0) & (depth <= 1.0)
+    depth[~covered] = np.inf
+    best = np.argmin(depth, axis=0)   # first triangle wins on ties
+    pixels = np.arange(px.size)
+    zbest = depth[best, pixels]
+    passed = zbest < tdepth
+    if not passed.any():
+        return
+    pixels, best = pixels[passed], best[passed]
+    tdepth[pixels] = zbest[passed]
+    # perspective correct interpolation of the colors of the winners only
+    b0, b1 = l0[best, pixels], l1[best, pixels]
+    weights = np.stack((b0, b1, 1.0 - b0 - b1), axis=1)*invw[best]
+    weights /= weights.sum(axis=1)[:, np.newaxis]
+    tcolor[pixels] = np.einsum('pk,pkc->pc', weights, colors[best])
+
+
+def triangle_planes(xy, z):
+    '''Returns an (M, 3, 3) array with the coefficients (a, b, c) of the
+    planes a*x + b*y + c giving the first two barycentric coordinates and
+    the depth over the screen of the (M, 3, 2) triangles `xy` with (M, 3)
+    vertex depths `z`. Degenerate triangles get NaN planes, that cover no
+    pixel.'''
+    x, y = xy[..., 0], xy[..., 1]
+    area = (x[:, 1] - x[:, 0])*(y[:, 2] - y[:, 0]) \
+        - (y[:, 1] - y[:, 0])*(x[:, 2] - x[:, 0])
+    area = np.where(np.abs(area) > 1e-12, area, np.nan)[:, np.newaxis]
+    # edge functions of the edges opposite to vertices 0 and 1
+    planes = np.empty((xy.shape[0], 3, 3))
+    for k, (i, j) in enumerate([(1, 2), (2, 0)]):
+        planes[:, k, 0] = y[:, i] - y[:, j]
+        planes[:, k, 1] = x[:, j] - x[:, i]
+        planes[:, k, 2] = x[:, i]*y[:, j] - y[:, i]*x[:, j]
+        planes[:, k] /= area
+    # depth = z2 + l0*(z0 - z2) + l1*(z1 - z2)
+    planes[:, 2] = (z[:, 0] - z[:, 2])[:, np.newaxis]*planes[:, 0] \
+        + (z[:, 1] - z[:, 2])[:, np.newaxis]*planes[:, 1]
+    planes[:, 2, 2] += z[:, 2]
+    return planes
+
+
+def triangle_fragments(xy, z, invw, colors):
+    '''Returns the (xy, depth, colors) of the fragments covered by small
+    triangles, testing the pixel centers inside their bounding boxes.'''
+    lo = np.ceil(xy.min(axis=1) - 0.5).astype(np.int64)
+    hi = np.floor(xy.max(axis=1) - 0.5).astype(np.int64)
+    spans = np.maximum(hi - lo + 1, 0)
+    counts = spans[:, 0]*spans[:, 1]
+    tri = np.repeat(np.arange(counts.size), counts)
+    starts = np.cumsum(counts) - counts
+    offset = np.arange(tri.size) - np.repeat(starts, counts)
+    px = lo[tri, 0] + offset % np.maximum(spans[tri, 0], 1) + 0.5
+    py = lo[tri, 1] + offset // np.maximum(spans[tri, 0], 1) + 0.5
+    planes = triangle_planes(xy, z)[tri]
+    l0 = planes[:, 0, 0]*px + planes[:, 0, 1]*py + planes[:, 0, 2]
+    l1 = planes[:, 1, 0]*px + planes[:, 1, 1]*py + planes[:, 1, 2]
+    depth = planes[:, 2, 0]*px + planes[:, 2, 1]*py + planes[:, 2, 2]
+    covered = (l0 >= 0.0) & (l1 >= 0.0) & (l0 + l1 <= 1.0)
+    tri, l0, l1 = tri[covered], l0[covered], l1[covered]
+    weights = np.stack((l0, l1, 1.0 - l0 - l1), axis=1)*invw[tri]
+    weights /= weights.sum(axis=1)[:, np.newaxis]
+    fragments = np.stack((px[covered], py[covered]), axis=1)
+    colors = np.einsum('pk,pkc->pc', weights, colors[tri])
+    return fragments, depth[covered], colors
+
+
+def mesh_primitives(mesh):
+    '''Returns an (M, k) array with the vertex indices of each of the M
+    primitives of `mesh`, k being 1, 2 or 3 for POINTS, LINES or
+    TRIANGLES.'''
+    k = mesh.primitive.value
+    prims = np.asarray(mesh.indices).reshape(k, -1).T
+    return prims[:mesh.no_indices] if mesh.no_indices else prims
+
+
+def to_clip(positions, mvp):
+    '''Returns the (N, 4) clip space coordinates of the (3, N) or (4, N)
+    `positions` of a mesh transformed by the 4x4 `mvp`, or an (I, N, 4)
+    array for an (I, 4, 4) stack of matrices.'''
+    positions = np.asarray(positions, dtype=np.float64)
+    mvp = np.asarray(mvp, dtype=np.float64)
+    if positions.shape[0] == 3:
+        return positions.T @ np.swapaxes(mvp[..., :3], -1, -2) \
+            + mvp[..., np.newaxis, :, 3]
+    return positions.T @ np.swapaxes(mvp, -1, -2)
+
+
+def vertex_colors(mesh):
+    '''Returns an (N, 4) array with the color of each vertex of `mesh`: its
+    colors, the flat lighting of `Dae` meshes computed from normals and the
+    lighting uniforms, or white.'''
+    n = mesh.positions.shape[1]
+    if mesh.colors is not None:
+        colors = np.asarray(mesh.colors, dtype=np.float64).T
+        if colors.shape[1] == 3:
+            colors = np.hstack((colors, np.ones((n, 1))))
+        return colors
+    uniforms = mesh.uniforms
+    if mesh.normals is not None and 'lDirection' in uniforms:
+        # same as data/shaders/flat.vs.glsl
+        normals = np.asarray(mesh.normals, dtype=np.float64).T
+        lambert = np.maximum(normals @ -uniforms['lDirection'], 0.0)
+        colors = np.empty((n, 4))
+        colors[:, :3] = uniforms['lAmbColor'] \
+            + lambert[:, np.newaxis]*uniforms['lDiffColor']
+        colors[:, 3] = 0.4
+        return colors
+    return np.ones((n, 4))
+
+
+def clip_triangles(clip, colors):
+    '''Clips (M, 3, 4) clip space triangles, with (M, 3, 4) vertex colors,
+    against the near plane (z >= -w). Triangles with one vertex behind the
+    plane become two triangles, with two vertices behind it become one, and
+    the ones completely behind it are dropped. Winding is preserved.'''
+    d = clip[..., 2] + clip[..., 3]
+    inside = d >= 0.0
+    count = inside.sum(axis=1)
+    out_clip, out_colors = [clip[count == 3]], [colors[count == 3]]
+    for n_inside in [1, 2]:
+        sel = np.flatnonzero(count == n_inside)
+        if sel.size == 0:
+            continue
+        # rotate (keeping the winding) so that the odd vertex out comes first
+        odd = inside[sel] if n_inside == 1 else ~inside[sel]
+        first = np.argmax(odd, axis=1)
+        rot = (first[:, np.newaxis] + np.arange(3)) % 3
+        c = np.take_along_axis(clip[sel], rot[..., np.newaxis], axis=1)
+        col = np.take_along_axis(colors[sel], rot[..., np.newaxis], axis=1)
+        dd = np.take_along_axis(d[sel], rot, axis=1)
+        # intersections along edges 0-1 and 0-2
+        t01 = (dd[:, 0]/(dd[:, 0] - dd[:, 1]))[:, np.newaxis]
+        t02 = (dd[:, 0]/(dd[:, 0] - dd[:, 2]))[:, np.newaxis]
+        p01 = c[:, 0] + (c[:, 1] - c[:, 0])*t01
+        p02 = c[:, 0] + (c[:, 2] - c[:, 0])*t02
+        c01 = col[:, 0] + (col[:, 1] - col[:, 0])*t01
+        c02 = col[:, 0] + (col[:, 2] - col[:, 0])*t02
+        if n_inside == 1:
+            out_clip.append(np.stack((c[:, 0], p01, p02), axis=1))
+            out_colors.append(np.stack((col[:, 0], c01, c02), axis=1))
+        else:
+            # vertex 0 is behind: quad p01, 1, 2, p02
+            out_clip.append(np.stack((p01, c[:, 1], c[:, 2]), axis=1))
+            out_colors.append(np.stack((c01, col[:, 1], col[:, 2]), axis=1))
+            out_clip.append(np.stack((p01, c[:, 2], p02), axis=1))
+            out_colors.append(np.stack((c01, col[:, 2], c02), axis=1))
+    return np.concatenate(out_clip), np.concatenate(out_colors)
+
+
+def clip_lines(clip, colors):
+    '''Clips (M, 2, 4) clip space lines, with (M, 2, 4) vertex colors, to
+    the view frustum (-w <= x, y, z <= w), the near plane first, so that
+    lines only span the visible part of the viewport. Lines completely
+    outside a plane are dropped.'''
+    # (axis, sign) of the planes sign*clip[axis] + w >= 0
+    for axis, sign in [(2, 1.0), (0, 1.0), (0, -1.0), (1, 1.0), (1, -1.0),
+            (2, -1.0)]:
+        d = sign*clip[..., axis] + clip[..., 3]
+        inside = d >= 0.0
+        keep = inside.any(axis=1)
+        clip, colors, d, inside = (
+            clip[keep], colors[keep], d[keep], inside[keep]
+        )
+        cross = np.flatnonzero(~inside.all(axis=1))
+        if cross.size == 0:
+            continue
+        # the ends of crossing lines have opposite signs, d0 != d1
+        t = (d[cross, 0]/(d[cross, 0] - d[cross, 1]))[:, np.newaxis]
+        p = clip[cross, 0] + (clip[cross, 1] - clip[cross, 0])*t
+        c = colors[cross, 0] + (colors[cross, 1] - colors[cross, 0])*t
+        clip, colors = clip.copy(), colors.copy()
+        for end in [0, 1]:
+            behind = ~inside[cross, end]
+            clip[cross[behind], end] = p[behind]
+            colors[cross[behind], end] = c[behind]
+    return clip, colors
@@ -2,17 +2,35 @@
 import nanogui as ng
 import numpy as np
 
-from nano3d.mesh import Primitive
+from nano3d import culling, picking
+from nano3d.batching import StaticBatcher
+from nano3d.lod import lod_chain
+from nano3d.mesh import (
+    ChunkedMesh, DynamicMesh, InfiniteGrid, Polyline, Primitive,
+)
+from nano3d.profiler import Profiler
+from nano3d.renderqueue import RenderQueue
+from nano3d.resources import (
+    BufferRing, ResourceCache, mesh_key, program_key,
+)
+from nano3d.scene import InstancedNode, MissingCameraNodeError
 
 class RendererManager():
 
     def __init__(self):
         self.renderers = []
 
-    def add_renderer(self, name, scene, camera=''):
+    def add_renderer(self, name, scene, camera='', backend=None):
         '''Adds a scene renderer for a specific camera.
-        By default uses the first camera in the scene.'''
-        renderer = Renderer(name, scene, camera)
+        By default uses the first camera in the scene.
+
+        Parameters
+        ----------
+        backend: the renderer class, `Renderer` (OpenGL) if None, or e.g:
+            `rasterizer.SoftwareRenderer` to render on the CPU.
+        '''
+        backend = Renderer if backend is None else backend
+        renderer = backend(name, scene, camera)
         self.renderers.append(renderer)
         return renderer
 
@@ -34,15 +52,33 @@ class Renderer():
         '''
         Raises
         ------
-        InvalidCameraNodeError: when `camera` does not match any of the
+        MissingCameraNodeError: when `camera` does not match any of the
             available cameras.
         '''
         self.name = name
         self.scene = scene
         self.camera_name = camera
         self.camera_node = None
-        self.shaders = []
+        self.shaders = {}  # node -> shader
+        self.chunk_shaders = {}  # (node, chunk index) -> shader
+        # shaders shared by the nodes with the same mesh and shader sources
+        self.resources = ResourceCache(self.create_shader, self.free_shader)
+        self.shader_keys = {}  # node -> key of its shader in resources
+        # node -> BufferRing of its DynamicMesh or InfiniteGrid, or of the
+        # decimated line of its Polyline
+        self.streams = {}
+        self._topology = None  # scene topology the shaders were synced at
+        # times the stages of `draw_handler()` and every draw, disabled
+        # until `profiler.enabled` is set
+        self.profiler = Profiler()
+        self.queue = RenderQueue(self.profiler)  # see `queue.stats`
+        self.batcher = None  # see `enable_static_batching()`
+        self.batch_shaders = {}  # batch index -> shader
+        self.lod = None  # see `enable_lod()`
+        # node -> (LODChain, {level: (key in resources, shader)})
+        self.lod_shaders = {}
         self.projection = np.eye(4)
+        self.size = None  # viewport size, known after the first resize
         self.primitives = {
             Primitive.POINTS: ng.gl.POINTS,
             Primitive.LINES: ng.gl.LINES,
@@ -52,53 +88,315 @@ class Renderer():
         for node in scene.nodes:
             if node.name == self.camera_name:
                 self.camera_node = node
-            if node.mesh is None:
-                continue  # may be a node without geometry, which is okay
-            shader = ng.GLShader()
-            shader.init(
-                node.mesh.material.name,
-                node.mesh.material.vsh,
-                node.mesh.material.fsh,
-            )
-            shader.bind()
-            shader.uploadIndices(node.mesh.indices)
-            for key in node.mesh.attribs:
-                shader.uploadAttrib(key, node.mesh.attribs[key])
-            self.shaders.append(shader)
         if self.camera_node == None:
             # the specified camera does not match any of the available cameras
             # in the scene
             raise MissingCameraNodeError()
+        self.sync()
+
+    def enable_static_batching(self, max_vertices=2**16):
+        '''Draws the static nodes (`node.static = True`) merged into a few
+        large meshes, see `batching.StaticBatcher`.'''
+        self.batcher = StaticBatcher(self.scene, max_vertices)
+        self.update_batches(range(len(self.batcher.batches)))
+
+    def enable_lod(self, max_error=1.0, **kwargs):
+        '''Draws TRIANGLES meshes at the coarsest level of detail whose
+        geometric error projects to at most `max_error` pixels, see
+        `lod.LODChain`. The levels of each mesh are built on first use and
+        cached with the mesh, `kwargs` are passed to `lod.LODChain`.'''
+        self.lod = dict(kwargs, max_error=max_error)
+
+    def select_lod(self, node, world, view):
+        '''Returns a tuple (shader, mesh) with the level of detail of the
+        mesh of `node` to draw this frame, uploading it if needed. The full
+        mesh is drawn until the viewport size is known.'''
+        if self.size is None:
+            return self.shaders[node], node.mesh
+        options = dict(self.lod)
+        max_error = options.pop('max_error')
+        chain = lod_chain(node.mesh, **options)
+        entry = self.lod_shaders.get(node)
+        if entry is None or entry[0] is not chain:
+            # the chain was rebuilt, its previous levels are not drawn anymore
+            self.release_lod(node)
+            entry = self.lod_shaders[node] = (chain, {})
+        level = chain.select(
+            world, view, self.projection, self.size[1], max_error
+        )
+        if level == 0:
+            return self.shaders[node], node.mesh
+        simple, levels = chain.meshes[level], entry[1]
+        if level not in levels:
+            key = self.shader_key(simple)
+            levels[level] = (key, self.resources.acquire(key, simple))
+        return levels[level][1], simple
+
+    def release_lod(self, node):
+        '''Releases the shaders of the levels of detail of `node`.'''
+        entry = self.lod_shaders.pop(node, None)
+        if entry is not None:
+            for key, _ in entry[1].values():
+                self.resources.release(key)
+
+    def update_batches(self, indices):
+        '''(Re)uploads the meshes of the batches at `indices`.'''
+        for i in indices:
+            shader = self.batch_shaders.pop(i, None)
+            if shader is not None:
+                shader.free()
+            batch = self.batcher.batches[i]
+            if batch is not None:
+                self.batch_shaders[i] = self.create_shader(batch.mesh)
+
+    def shader_key(self, mesh):
+        return program_key(mesh.material), mesh_key(mesh)
+
+    def add_node(self, node):
+        '''Gets the shader of `node`, compiling it and uploading the mesh
+        only if no other node with the same mesh and shaders has it.'''
+        if node.mesh is None:
+            return  # may be a node without geometry, which is okay
+        if isinstance(node.mesh, ChunkedMesh):
+            return  # chunks are uploaded as they become visible
+        if isinstance(node.mesh, (DynamicMesh, InfiniteGrid, Polyline)):
+            # polylines stream their decimated line
+            mesh = node.mesh
+            if isinstance(mesh, Polyline):
+                mesh = mesh.output
+            self.streams[node] = BufferRing(
+                mesh, self.create_shader, self.upload_range, self.free_shader,
+            )
+            return
+        key = self.shader_key(node.mesh)
+        self.shaders[node] = self.resources.acquire(key, node.mesh)
+        self.shader_keys[node] = key
+
+    def remove_node(self, node):
+        '''Releases the shaders and chunks of `node`. Shaders are freed with
+        the last node using them.'''
+        if node in self.shaders:
+            del self.shaders[node]
+            self.resources.release(self.shader_keys.pop(node))
+        self.release_lod(node)
+        if node in self.streams:
+            self.streams.pop(node).free()
+        for key in [key for key in self.chunk_shaders if key[0] is node]:
+            self.chunk_shaders.pop(key).free()
+
+    def sync(self):
+        '''Acquires the shaders of the nodes added to the scene, and releases
+        the ones of the nodes removed from it, since the last call.'''
+        if self._topology == self.scene.transforms.topology:
+            return
+        nodes = set(self.scene.nodes)
+        owners = set(self.shaders) | set(self.streams) \
+            | {node for node, _ in self.chunk_shaders}
+        for node in owners - nodes:
+            self.remove_node(node)
+        for node in self.scene.nodes:
+            if node not in self.shaders and node not in self.streams:
+                self.add_node(node)
+        self._topology = self.scene.transforms.topology
+
+    def create_shader(self, mesh):
+        '''Compiles the material of `mesh` and uploads its vertex data.'''
+        shader = ng.GLShader()
+        shader.init(mesh.material.name, mesh.material.vsh, mesh.material.fsh)
+        shader.bind()
+        shader.uploadIndices(mesh.indices)
+        for key in mesh.attribs:
+            shader.uploadAttrib(key, mesh.attribs[key])
+        self.profiler.count('bytes_uploaded', mesh.indices.nbytes + sum(
+            array.nbytes for array in mesh.attribs.values()
+        ))
+        return shader
+
+    def upload_range(self, shader, mesh, start, stop):
+        '''Updates the buffers of `shader` with the vertices start:stop of a
+        `DynamicMesh` and its primitives. The nanogui bindings only upload
+        whole buffers (glBufferData, no glBufferSubData), so all the used
+        vertices are sent, the dirty range only tells that something did
+        change since this copy was written.'''
+        shader.bind()
+        shader.uploadIndices(mesh.indices)
+        for key in mesh.attribs:
+            shader.uploadAttrib(key, mesh.attribs[key])
+        self.profiler.count('bytes_uploaded', mesh.indices.nbytes + sum(
+            array.nbytes for array in mesh.attribs.values()
+        ))
+
+    def free_shader(self, shader):
+        shader.free()
+
+    def visible_nodes(self):
+        '''Returns the nodes that are visible from the camera node, i.e: nodes
+        with geometry, flagged visible and inside the camera frustum. Does not
+        need an OpenGL context.'''
+        return culling.visible_nodes(
+            self.scene, self.camera_node, self.projection
+        )
 
     def draw_handler(self):
         '''Callback that gets called when rendering is needed'''
-        for i, node in enumerate(self.scene.nodes):
-            if node.mesh is None or not node.visible:
-                # may be a node without geometry, or invisible
+        profiler = self.profiler
+        profiler.begin_frame()
+        with profiler.scope('sync'):
+            self.sync()
+        with profiler.scope('world_mats'):
+            models = self.scene.world_mats()  # all world matrices at once
+        with profiler.scope('view_mat'):
+            view = self.camera_node.view_mat()  # frame invariant
+        clip_mat = self.projection @ view
+        with profiler.scope('cull'):
+            planes = culling.frustum_planes(clip_mat)
+            visible = culling.frustum_mask(self.scene, planes)
+        batched = {}
+        if self.batcher is not None:
+            with profiler.scope('batching'):
+                self.update_batches(self.batcher.update())
+                batched = self.batcher.members
+                self.queue_batches(view, clip_mat, planes)
+        with profiler.scope('queue'):
+            self.queue_nodes(np.flatnonzero(visible), batched, models, view)
+        with profiler.scope('submit'):
+            ng.gl.Enable(ng.gl.DEPTH_TEST)
+            stats = self.queue.submit(self.bind, self.set_uniform, self.draw)
+            ng.gl.Disable(ng.gl.DEPTH_TEST)
+        for name, value in stats.items():
+            profiler.count(name, value)
+        with profiler.scope('release_chunks'):
+            self.release_chunks()
+        profiler.end_frame()
+
+    def queue_nodes(self, indices, batched, models, view):
+        '''Queues the draws of the nodes at `indices` that are not in
+        `batched`, given the world matrices `models` and the `view`.'''
+        clip_mat = self.projection @ view
+        for i in indices:
+            # invisible nodes, nodes without geometry and out of the camera
+            # frustum are already skipped
+            node = self.scene.nodes[i]
+            if node in batched:
                 continue
-            model = node.model_mat()
-            view = self.camera_node.view_mat()
-            positions = node.mesh.positions
-            self.shaders[i].bind()
-            for key in node.mesh.uniforms:
-                self.shaders[i].setUniform(key, node.mesh.uniforms[key])
-            self.shaders[i].setUniform(
-                'mvp', self.projection @ view @ model
+            if isinstance(node, InstancedNode):
+                self.queue_instances(node, models[i], view, clip_mat)
+            elif isinstance(node.mesh, ChunkedMesh):
+                self.queue_chunks(node, models[i], view, clip_mat)
+            elif isinstance(node.mesh, (DynamicMesh, InfiniteGrid)):
+                if isinstance(node.mesh, InfiniteGrid):
+                    eye = np.linalg.inv(view @ models[i])[:3, 3]
+                    node.mesh.follow(eye)
+                self.queue.push(
+                    self.streams[node].current(), node.mesh,
+                    clip_mat @ models[i], view_depth(view, models[i]),
+                    name=node.name,
+                )
+            elif isinstance(node.mesh, Polyline):
+                if self.size is None:
+                    continue  # decimation needs the viewport size
+                mvp = clip_mat @ models[i]
+                mesh = node.mesh.decimate(mvp, self.size)
+                self.queue.push(
+                    self.streams[node].current(), mesh, mvp,
+                    view_depth(view, models[i]), name=node.name,
+                )
+            else:
+                shader, mesh = self.shaders[node], node.mesh
+                if self.lod is not None and mesh.primitive == \
+                        Primitive.TRIANGLES:
+                    shader, mesh = self.select_lod(node, models[i], view)
+                self.queue.push(
+                    shader, mesh, clip_mat @ models[i],
+                    view_depth(view, models[i]), name=node.name,
+                )
+
+    def bind(self, shader):
+        shader.bind()
+
+    def set_uniform(self, shader, name, value):
+        # materials with their own shaders may not declare a tint
+        shader.setUniform(name, value, name != 'tint')
+
+    def draw(self, shader, mesh):
+        if mesh.primitive == Primitive.TRIANGLES:
+            self.profiler.count('triangles', mesh.no_indices)
+        shader.drawIndexed(self.primitives[mesh.primitive], 0, mesh.no_indices)
+
+    def queue_batches(self, view, clip_mat, planes):
+        '''Queues the static batches inside the frustum.'''
+        batches = self.batcher.meshes()
+        if not batches:
+            return
+        # unbounded batches, e.g: of grids, are never culled
+        bounded = np.array([mesh.aabb() is not None for _, mesh in batches])
+        aabbs = np.array([
+            np.zeros((2, 3)) if mesh.aabb() is None else mesh.aabb()
+            for _, mesh in batches
+        ])
+        visible = culling.aabbs_in_frustum(planes, aabbs) | ~bounded
+        for k in np.flatnonzero(visible):
+            i, mesh = batches[k]
+            center = np.eye(4)
+            center[:-1, -1] = aabbs[k].mean(axis=0)
+            depth = view_depth(view, center)
+            self.queue.push(
+                self.batch_shaders[i], mesh, clip_mat, depth,
+                name='batch{}'.format(i),
             )
-            ng.gl.Enable(ng.gl.DEPTH_TEST)
-            # ng.gl.Enable(ng.gl.CULL_FACE)
-            self.shaders[i].drawIndexed(
-                self.primitives[node.mesh.primitive],
-                0,
-                node.mesh.no_indices
+
+    def queue_instances(self, node, world, view, clip_mat):
+        '''Queues the instances of an `InstancedNode` inside the frustum. The
+        mesh is uploaded once and, as the draws share the shader, it is bound
+        once, then each instance only sets the `mvp` and `tint` uniforms and
+        issues its draw call. (The nanogui bindings do not expose
+        glDrawElementsInstanced.)'''
+        shader, mesh = self.shaders[node], node.mesh
+        mats = node.instance_mats(world)
+        inside = culling.aabbs_in_frustum(
+            culling.frustum_planes(clip_mat), node.instance_aabbs(mats)
+        )
+        for i in np.flatnonzero(inside):
+            self.queue.push(
+                shader, mesh, clip_mat @ mats[i], view_depth(view, mats[i]),
+                node.colors[i], node.name,
             )
-            # ng.gl.Disable(ng.gl.CULL_FACE)
-            ng.gl.Disable(ng.gl.DEPTH_TEST)
+
+    def queue_chunks(self, node, world, view, clip_mat):
+        '''Queues the chunks of a `ChunkedMesh` inside the frustum, loading
+        and uploading the ones that are not resident yet.'''
+        mvp = clip_mat @ world
+        depth = view_depth(view, world)
+        for i, chunk in node.mesh.chunks(node.mesh.visible_chunks(mvp)):
+            shader = self.chunk_shaders.get((node, i))
+            if shader is None:
+                shader = self.create_shader(chunk)
+                self.chunk_shaders[(node, i)] = shader
+            self.queue.push(shader, chunk, mvp, depth, name=node.name)
+
+    def release_chunks(self):
+        '''Frees the GPU buffers of chunks evicted from their mesh.'''
+        for (node, i), shader in list(self.chunk_shaders.items()):
+            if not node.mesh.is_loaded(i):
+                shader.free()
+                del self.chunk_shaders[(node, i)]
 
     def resize_handler(self, size):
         '''Callback that gets called when the rendering canvas is resized'''
+        self.size = size
         self.projection = self.camera_node.projection_mat(size)
 
+    def pick(self, pos):
+        '''Returns the `picking.Hit` with the nearest triangle under the screen
+        point `pos` (e.g: the mouse position), or None.'''
+        if self.size is None:
+            return None  # the viewport is not known before the first resize
+        return picking.pick_screen(
+            self.scene, self.camera_node, pos, self.size
+        )
+
 
-class MissingCameraNodeError(Exception):
-    pass
+def view_depth(view, world):
+    '''Returns the distance in front of the camera of the origin of the
+    `world` matrix, given the `view` matrix.'''
+    return -(view[2, :-1] @ world[:-1, -1] + view[2, -1])
@@ -0,0 +1,139 @@
+import weakref
+
+import numpy as np
+
+from nano3d.profiler import Profiler
+from nano3d.resources import program_key
+
+
+class Draw():
+    '''A draw call: a mesh drawn with a shader and per draw uniforms.'''
+    __slots__ = ['shader', 'mesh', 'mvp', 'tint', 'depth', 'name']
+
+    def __init__(self, shader, mesh, mvp, tint, depth, name):
+        self.shader = shader
+        self.mesh = mesh
+        self.mvp = mvp
+        self.tint = tint
+        self.depth = depth
+        self.name = name
+
+
+class RenderQueue():
+    '''Collects the draw calls of a frame, sorts them and submits them while
+    skipping redundant state changes.
+
+    Draws are sorted by a key made of, in order of significance, the shader
+    program (identified by the hash of its sources), the shader itself (its
+    buffers and uniforms), the primitive type and the view depth, front to
+    back, so that draws sharing state are adjacent and near geometry fills
+    the depth buffer first. While submitting, a shader is only bound when it
+    differs from the bound one and a uniform is only sent when its value
+    differs from the last one sent to that shader during the frame.
+
+    `stats` counts, for the last submitted frame, the draws, binds and
+    uniform uploads performed and the ones skipped. Each draw is timed as a
+    scope of `profiler`, named after the draw.
+    '''
+    def __init__(self, profiler=None):
+        self.draws = []
+        self.stats = {}
+        self.profiler = Profiler() if profiler is None else profiler
+        self._programs = {}  # program key -> rank in the sort key
+        # material -> program rank, dropped with the material
+        self._materials = weakref.WeakKeyDictionary()
+        self._shaders = {}  # id(shader) -> rank in the sort key
+
+    def __len__(self):
+        return len(self.draws)
+
+    def clear(self):
+        self.draws = []
+        self._shaders = {}
+
+    def push(self, shader, mesh, mvp, depth=0.0, tint=None, name='draw'):
+        '''Adds a draw call to the queue.
+
+        Parameters
+        ----------
+        shader: the compiled shader holding the mesh buffers.
+        mesh: the `Mesh` drawn, whose material and uniforms go with it.
+        mvp: the 4x4 model-view-projection matrix of the draw.
+        depth: the view space distance of the geometry, used to sort the
+            draws of a same shader front to back.
+        tint: the RGBA color multiplying the vertex colors, white if None.
+        name: the name of the draw in the profiler, e.g: the node name.
+        '''
+        self.draws.append(Draw(shader, mesh, mvp, tint, depth, name))
+
+    def keys(self):
+        '''Returns an (M, 4) array with the sort key of every draw, most
+        significant column first.'''
+        keys = np.empty((len(self.draws), 4))
+        for i, draw in enumerate(self.draws):
+            keys[i, 0] = self._program_rank(draw.mesh.material)
+            keys[i, 1] = self._shaders.setdefault(
+                id(draw.shader), len(self._shaders)
+            )
+            keys[i, 2] = draw.mesh.primitive.value
+            keys[i, 3] = draw.depth
+        return keys
+
+    def _program_rank(self, material):
+        # hashing the sources once per material
+        rank = self._materials.get(material)
+        if rank is None:
+            program = program_key(material)
+            rank = self._programs.setdefault(program, len(self._programs))
+            self._materials[material] = rank
+        return rank
+
+    def order(self):
+        '''Returns the indices of the draws in submission order.'''
+        keys = self.keys()
+        return np.lexsort(keys.T[::-1])
+
+    def submit(self, bind, set_uniform, draw):
+        '''Submits the queued draws, sorted, through the backend callables
+        and empties the queue. Returns `stats`.
+
+        Parameters
+        ----------
+        bind: called as `bind(shader)` to make a shader current.
+        set_uniform: called as `set_uniform(shader, name, value)`.
+        draw: called as `draw(shader, mesh)` to issue the draw call.
+        '''
+        stats = dict.fromkeys([
+            'draws', 'binds', 'binds_skipped', 'uniforms', 'uniforms_skipped'
+        ], 0)
+        sent = {}  # id(shader) -> {uniform name: last value sent}
+        current = None
+        white = np.ones(4, dtype=np.float32)
+        for i in self.order():
+            call = self.draws[i]
+            shader = call.shader
+            if shader is current:
+                stats['binds_skipped'] += 1
+            else:
+                bind(shader)
+                current = shader
+                stats['binds'] += 1
+            values = sent.setdefault(id(shader), {})
+            uniforms = list(call.mesh.uniforms.items()) + [
+                ('mvp', call.mvp),
+                ('tint', white if call.tint is None else call.tint),
+            ]
+            for name, value in uniforms:
+                last = values.get(name)
+                if last is not None and np.array_equal(last, value):
+                    stats['uniforms_skipped'] += 1
+                    continue
+                set_uniform(shader, name, value)
+                values[name] = value
+                stats['uniforms'] += 1
+            with self.profiler.scope(call.name):
+                draw(shader, call.mesh)
+            stats['draws'] += 1
+        self.stats = stats
+        self.clear()
+        return stats
@@ -0,0 +1,154 @@
+import hashlib
+
+
+class ResourceCache():
+    '''Reference counted resources shared by many users, e.g: the GPU
+    programs and buffers of the nodes of a scene.
+
+    `acquire()` returns the resource stored under a key, creating it on the
+    first request, and `release()` drops one reference, destroying the
+    resource once nobody holds it anymore. Keys must be hashable.
+    '''
+    def __init__(self, create, destroy=None):
+        '''
+        Parameters
+        ----------
+        create: a callable building the resource from the arguments given to
+            `acquire()`.
+        destroy: a callable freeing a resource, e.g: `GLShader.free`, called
+            when its last reference is released.
+        '''
+        self.create = create
+        self.destroy = destroy
+        self._entries = {}  # key -> [resource, references]
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def acquire(self, key, *args, **kwargs):
+        '''Returns the resource stored under `key` and adds a reference to
+        it. On a miss the resource is built with `create(*args, **kwargs)`.'''
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            entry = [self.create(*args, **kwargs), 0]
+            self._entries[key] = entry
+        else:
+            self.hits += 1
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, key):
+        '''Drops a reference to the resource stored under `key`. Returns True
+        if it was the last one and the resource got destroyed.
+
+        Raises
+        ------
+        KeyError: if there is no resource under `key`.
+        '''
+        entry = self._entries[key]
+        entry[1] -= 1
+        if entry[1] > 0:
+            return False
+        del self._entries[key]
+        if self.destroy is not None:
+            self.destroy(entry[0])
+        return True
+
+    def get(self, key):
+        '''Returns the resource stored under `key`, without adding a
+        reference, or None.'''
+        entry = self._entries.get(key)
+        return None if entry is None else entry[0]
+
+    def references(self, key):
+        '''Returns the number of references to the resource under `key`.'''
+        entry = self._entries.get(key)
+        return 0 if entry is None else entry[1]
+
+    def clear(self):
+        '''Destroys all the resources, whatever their references.'''
+        entries, self._entries = self._entries, {}
+        if self.destroy is not None:
+            for resource, _ in entries.values():
+                self.destroy(resource)
+
+
+def program_key(material):
+    '''Returns a key identifying the shader program of `material` by the
+    hash of its sources, so that materials with the same shaders share it
+    whatever their names.'''
+    digest = hashlib.blake2b(digest_size=16)
+    for source in [material.vsh, material.fsh]:
+        digest.update(source.encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def mesh_key(mesh):
+    '''Returns a key identifying the vertex data of `mesh`. Meshes are
+    identified by object identity, the key is only unique while the mesh is
+    alive, which holding a reference to it in the resource ensures.'''
+    return id(mesh)
+
+
+class BufferRing():
+    '''The rotating GPU copies of a `DynamicMesh`, for double or triple
+    buffering.
+
+    Each frame the mesh changed, the next copy in the ring is brought up to
+    date, uploading only the vertices changed since that copy was last
+    written (see `DynamicMesh.dirty_range()`), and drawn, so the copies the
+    previous frames drew from are left alone while the GPU may still read
+    them. Frames without changes keep drawing the current copy.
+    '''
+    def __init__(self, mesh, create, upload, destroy=None):
+        '''
+        Parameters
+        ----------
+        mesh: the `DynamicMesh` streamed, or any mesh with its `buffers`,
+            `version` and `dirty_range()`, e.g: an `InfiniteGrid`.
+        create: a callable building a copy from the mesh, e.g: uploading all
+            of it to a new shader.
+        upload: called as `upload(copy, mesh, start, stop)` to update the
+            vertices start:stop of a copy, and the primitives.
+        destroy: a callable freeing a copy.
+        '''
+        self.mesh = mesh
+        self.create = create
+        self.upload = upload
+        self.destroy = destroy
+        self.copies = []  # [copy, version of the mesh it holds]
+        self.index = -1  # the copy drawn last
+
+    def __len__(self):
+        return len(self.copies)
+
+    def current(self):
+        '''Returns the copy to draw this frame, updating one if needed.'''
+        mesh = self.mesh
+        if self.index >= 0 and self.copies[self.index][1] == mesh.version:
+            return self.copies[self.index][0]
+        self.index = (self.index + 1) % mesh.buffers
+        if self.index == len(self.copies):
+            self.copies.append([self.create(mesh), mesh.version])
+            return self.copies[self.index][0]
+        entry = self.copies[self.index]
+        changed = mesh.dirty_range(entry[1])
+        if changed is not None:
+            self.upload(entry[0], mesh, *changed)
+        entry[1] = mesh.version
+        return entry[0]
+
+    def free(self):
+        '''Destroys all the copies.'''
+        copies, self.copies = self.copies, []
+        self.index = -1
+        if self.destroy is not None:
+            for copy, _ in copies:
+                self.destroy(copy)
@@ -1,8 +1,11 @@
+import itertools
 
 import numpy as np
 import quaternion as qua
 
+from nano3d.bvh import SceneBVH
 from nano3d.camera import CameraOrtho, CameraPerspective
+from nano3d.culling import transform_aabbs
 from nano3d.mesh import Mesh
 
 class SceneManager():
@@ -37,16 +40,296 @@ class SceneManager():
 class Scene():
     def __init__(self, name):
         self.name = name
-        self.nodes = []
+        self.transforms = TransformStore()
+        self.bvh = None  # optional spatial index, see `build_bvh()`
+
+    @property
+    def nodes(self):
+        '''All the nodes in the scene, children included. Parents always come
+        before their children.'''
+        return self.transforms.nodes
 
     def add_node(self, node):
+        '''Adds `node`, and all its descendants, as a root of the scene graph.
+        If `node` has a parent it is detached from it first.'''
+        if node.parent is not None:
+            node.parent.remove_child(node)
+        self.transforms.adopt(node)
+
+    def remove_node(self, node):
+        '''Removes `node`, and all its descendants, from the scene. The
+        subtree keeps its transforms in a store of its own, so it can be added
+        again later. Renderers release the resources of removed nodes on their
+        next frame.
+
+        Raises
+        ------
+        ValueError: if `node` is not in the scene.
+        '''
+        if node._store is not self.transforms:
+            raise ValueError('node {} is not in the scene'.format(node.name))
+        if node.parent is not None:
+            node.parent.remove_child(node)
+        TransformStore().adopt(node)
+
+    def build_bvh(self, leaf_size=4):
+        '''Builds a `SceneBVH` over the world space bounds of the nodes, which
+        is then used by culling and picking queries.'''
+        self.bvh = SceneBVH(self, leaf_size)
+        return self.bvh
+
+    def model_mats(self):
+        '''Returns an (N, 4, 4) array with the model matrices of all the nodes
+        in the scene, in the same order as `nodes`.'''
+        return self.transforms.model_mats()
+
+    def world_mats(self):
+        '''Returns an (N, 4, 4) array with the world matrices of all the nodes
+        in the scene, in the same order as `nodes`.'''
+        return self.transforms.world_mats()
+
+
+class TransformStore():
+    '''Keeps the positions, orientations and scaling factors of a collection
+    of nodes in contiguous (N, 3), (N, 4) and (N, 3) arrays, so that all the
+    model matrices can be evaluated at once. Every node references one row of
+    a store: a standalone node owns a store of its own and is moved into the
+    scene store once added to a scene. A node and all its descendants always
+    share the same store, and parents are stored before their children.
+
+    Model and world matrices are cached. Each row carries a version number,
+    bumped by `touch()` whenever the node transform is set, and only the rows
+    whose version differs from the one of their cached matrix are recomputed.
+    World matrices are propagated top-down one depth level at a time, so only
+    the dirty subtrees are recomputed. Versions come from a single counter
+    shared by all stores, so they can also be used by nodes to validate
+    caches of their own (see `CameraNode.view_mat()`).
+    '''
+    _clock = itertools.count(1)
+    _arrays = [
+        '_positions', '_orientations', '_scales', '_parents', '_depths',
+        '_versions', '_model_mats', '_model_versions', '_world_mats',
+        '_world_versions', '_world_stamps',
+    ]
+
+    def __init__(self, capacity=1):
+        self.nodes = []
+        self._positions = np.zeros((capacity, 3), dtype=np.float32)
+        self._orientations = np.zeros((capacity, 4), dtype=np.float64)
+        self._orientations[:, 0] = 1.0
+        self._scales = np.ones((capacity, 3), dtype=np.float32)
+        self._parents = np.full(capacity, -1, dtype=np.int64)
+        self._depths = np.zeros(capacity, dtype=np.int64)
+        self._versions = np.zeros(capacity, dtype=np.int64)
+        self._model_mats = np.zeros((capacity, 4, 4), dtype=np.float32)
+        self._model_versions = np.full(capacity, -1, dtype=np.int64)
+        self._world_mats = np.zeros((capacity, 4, 4), dtype=np.float32)
+        self._world_versions = np.full(capacity, -1, dtype=np.int64)
+        self._world_stamps = np.zeros(capacity, dtype=np.int64)
+        self._levels = None  # row indices grouped by depth, built lazily
+        self.topology = 0  # bumped whenever nodes are added, moved or removed
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def positions(self):
+        return self._positions[:len(self)]
+
+    @property
+    def orientations(self):
+        '''Quaternions as (w, x, y, z) rows.'''
+        return self._orientations[:len(self)]
+
+    @property
+    def scales(self):
+        return self._scales[:len(self)]
+
+    @property
+    def parents(self):
+        '''Row index of the parent of each node, -1 for root nodes.'''
+        return self._parents[:len(self)]
+
+    @property
+    def versions(self):
+        return self._versions[:len(self)]
+
+    @property
+    def world_stamps(self):
+        '''Version of the last world matrix computed for each node. Unlike
+        `versions`, it also changes when only an ancestor of the node moved.'''
+        return self._world_stamps[:len(self)]
+
+    def touch(self, index):
+        '''Marks the transform at `index` as changed.'''
+        self._versions[index] = next(self._clock)
+
+    def add(self, node, parent=-1):
+        '''Appends a row with the identity transform for `node` and returns its
+        index. Storage grows by doubling, so appending is amortized O(1).'''
+        index = len(self)
+        if index == self._positions.shape[0]:
+            self._grow(2*index)
+        self._positions[index] = 0.0
+        self._orientations[index] = (1.0, 0.0, 0.0, 0.0)
+        self._scales[index] = 1.0
+        self._parents[index] = parent
+        self._depths[index] = 0 if parent < 0 else self._depths[parent] + 1
+        self.touch(index)
         self.nodes.append(node)
+        self._levels = None
+        self.topology += 1
+        return index
+
+    def adopt(self, node):
+        '''Moves the transform of `node`, and of all its descendants, from
+        their current store into this one. The parent of `node`, if any, must
+        already be in this store.'''
+        src = node._store
+        if src is self:
+            return
+        rows = []
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            row = n._index
+            parent = -1 if n.parent is None else n.parent._index
+            index = self.add(n, parent)
+            self._positions[index] = src._positions[row]
+            self._orientations[index] = src._orientations[row]
+            self._scales[index] = src._scales[row]
+            n._store, n._index = self, index
+            rows.append(row)
+            stack.extend(reversed(n.children))
+        src._discard(rows)
+
+    def reparent(self, index, parent):
+        '''Sets the parent of the node at `index` to the node at row `parent`
+        (-1 for none). The parent must come before the node in the store.'''
+        self._parents[index] = parent
+        self._levels = None
+        self.topology += 1
+        self.touch(index)
+        # the depth of the whole subtree changes, which is only known once
+        # levels are rebuilt from the parent indices
+        self._depths[:len(self)] = self._compute_depths()
+
+    def _compute_depths(self):
+        parents = self.parents
+        depths = np.zeros(len(self), dtype=np.int64)
+        for index, parent in enumerate(parents):
+            if parent >= 0:
+                depths[index] = depths[parent] + 1
+        return depths
+
+    def _discard(self, rows):
+        '''Removes `rows` from the store, compacting the remaining ones. The
+        rows are expected to be whole subtrees.'''
+        n = len(self)
+        keep = np.ones(n, dtype=bool)
+        keep[rows] = False
+        if keep.all():
+            return
+        remap = np.cumsum(keep) - 1
+        m = int(remap[-1]) + 1 if n else 0
+        for attr in self._arrays:
+            arr = getattr(self, attr)
+            arr[:m] = arr[:n][keep]
+        parents = self._parents[:m]
+        parents[parents >= 0] = remap[parents[parents >= 0]]
+        self.nodes[:] = [node for node, k in zip(self.nodes, keep) if k]
+        for index, node in enumerate(self.nodes):
+            node._index = index
+        self._levels = None
+        self.topology += 1
+
+    def _grow(self, capacity):
+        for attr in self._arrays:
+            old = getattr(self, attr)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:old.shape[0]] = old
+            setattr(self, attr, new)
+
+    def _update_model_mats(self, rows):
+        '''Recomputes the cached model matrices of `rows`.'''
+        rotations = qua.as_rotation_matrix(
+            qua.as_quat_array(self._orientations[rows])
+        )
+        mats = self._model_mats
+        # scaling the columns of the rotation is the same as R @ diag(scale)
+        mats[rows, :-1, :-1] = \
+            rotations * self._scales[rows][:, np.newaxis, :]
+        mats[rows, :-1, -1] = self._positions[rows]
+        mats[rows, -1, :-1] = 0.0
+        mats[rows, -1, -1] = 1.0
+        self._model_versions[rows] = self._versions[rows]
+
+    def model_mats(self):
+        '''Returns an (N, 4, 4) array with the model matrices, i.e:
+        translation * rotation * scaling, of all the nodes in the store.
+
+        The returned array is the cache itself and must not be modified.'''
+        n = len(self)
+        dirty = np.flatnonzero(self._versions[:n] != self._model_versions[:n])
+        if dirty.size:
+            self._update_model_mats(dirty)
+        return self._model_mats[:n]
+
+    def model_mat(self, index):
+        '''Returns the (cached) model matrix at `index`.'''
+        if self._versions[index] != self._model_versions[index]:
+            self._update_model_mats([index])
+        return self._model_mats[index]
+
+    def levels(self):
+        '''Returns a list with the row indices of each depth level.'''
+        if self._levels is None:
+            depths = self._depths[:len(self)]
+            order = np.argsort(depths, kind='stable')
+            bounds = np.flatnonzero(np.diff(depths[order])) + 1
+            self._levels = np.split(order, bounds) if order.size else []
+        return self._levels
+
+    def world_mats(self):
+        '''Returns an (N, 4, 4) array with the world matrices, i.e: the
+        product of the model matrices from the root down to each node, of all
+        the nodes in the store.
+
+        The returned array is the cache itself and must not be modified.'''
+        n = len(self)
+        dirty = self._versions[:n] != self._world_versions[:n]
+        if not dirty.any():
+            return self._world_mats[:n]
+        models = self.model_mats()
+        worlds = self._world_mats
+        for depth, level in enumerate(self.levels()):
+            if depth == 0:
+                rows = level[dirty[level]]
+                worlds[rows] = models[rows]
+            else:
+                parents = self._parents[level]
+                # a node is dirty if its own transform or its parent changed
+                dirty[level] |= dirty[parents]
+                rows = level[dirty[level]]
+                worlds[rows] = worlds[self._parents[rows]] @ models[rows]
+        self._world_stamps[np.flatnonzero(dirty)] = next(self._clock)
+        self._world_versions[:n] = self._versions[:n]
+        return worlds[:n]
+
+    def world_mat(self, index):
+        '''Returns the (cached) world matrix at `index`.'''
+        return self.world_mats()[index]
 
 
 class Node():
     '''The Node object maintains the position, orientation and scaling factor of
     a mesh linked to it. All the applied transformations impact the respective
     mesh geometry.
+
+    `position` and `scale` are views onto the node row of its TransformStore.
+    Assigning to them (including augmented assignments such as
+    `node.position += delta`) invalidates the cached matrices, writing to
+    individual elements (`node.position[0] = 1.0`) does not.
     '''
     def __init__(self, name,
             mesh=None,
@@ -85,19 +368,27 @@ class Node():
                 'respectively.'
             )
 
+        self.parent = None
+        self.children = []
+        self._store = TransformStore()
+        self._index = self._store.add(self)
         self.position = position
         self.orientation = orientation
         self.scale = scale
         self.visible = True  # whether this node is visible for rendering
+        # whether the node may be merged with others, see `StaticBatcher`
+        self.static = False
 
     @property
     def position(self):
-        return self._position
+        '''A view onto this node's row of the transform store.'''
+        return self._store._positions[self._index]
 
     @position.setter
     def position(self, position):
         if type(position) in [np.ndarray, tuple] and len(position) == 3:
-            self._position = np.array(position, dtype=np.float32)
+            self._store._positions[self._index] = position
+            self._store.touch(self._index)
         else:
             raise ValueError(
                 'position must be either a 3-tuple or an numpy.ndarray'
@@ -105,37 +396,80 @@ class Node():
 
     @property
     def orientation(self):
-        return self._orientation
+        return np.quaternion(*self._store._orientations[self._index])
 
     @orientation.setter
     def orientation(self, orientation):
         if type(orientation) == np.quaternion:
-            self._orientation = orientation
+            self._store._orientations[self._index] = \
+                qua.as_float_array(orientation)
         elif type(orientation) == tuple and len(orientation) == 4:
-            self._orientation = np.quaternion(*orientation)
+            self._store._orientations[self._index] = orientation
         else:
             raise ValueError(
                 'orientation must be either a 4-tuple or an numpy.quaternion'
             )
+        self._store.touch(self._index)
 
     @property
     def scale(self):
-        return self._scale
+        return self._store._scales[self._index]
 
     @scale.setter
     def scale(self, scale):
-        self._scale = np.array(scale, dtype=np.float32)
         if type(scale) in [np.ndarray, tuple] and len(scale) == 3:
-            self._scale = np.array(scale, dtype=np.float32)
+            self._store._scales[self._index] = scale
+            self._store.touch(self._index)
         else:
             raise ValueError(
                 'scale must be either a 3-tuple or an numpy.ndarray'
             )
 
+    def add_child(self, child):
+        '''Attaches `child`, and all its descendants, to this node. The child
+        transform becomes relative to this node.
+
+        Raises
+        ------
+        ValueError: if `child` is this node or one of its ancestors.
+        '''
+        node = self
+        while node is not None:
+            if node is child:
+                raise ValueError('a node cannot be a child of itself')
+            node = node.parent
+        if child.parent is not None:
+            child.parent.remove_child(child)
+        if child._store is self._store:
+            # children must come after their parent in the store, so move the
+            # subtree out and append it again below
+            TransformStore().adopt(child)
+        child.parent = self
+        self._store.adopt(child)
+        self.children.append(child)
+
+    def remove_child(self, child):
+        '''Detaches `child` from this node. The child stays in the same store
+        (and scene) as a root node.'''
+        self.children.remove(child)
+        child.parent = None
+        self._store.reparent(child._index, -1)
+
+    def aabb(self):
+        '''Returns the (2, 3) bounds of the node geometry in model space, or
+        None if the node has no bounded geometry.'''
+        return None if self.mesh is None else self.mesh.aabb()
+
     def model_mat(self):
-        '''Returns the model matrix, i.e: translation * rotation * scaling.'''
-        return \
-            self.translation_mat() @ self.rotation_mat() @ self.scaling_mat()
+        '''Returns the model matrix, i.e: translation * rotation * scaling.
+        The matrix is cached and only rebuilt after the node transform is set,
+        it must not be modified.'''
+        return self._store.model_mat(self._index)
+
+    def world_mat(self):
+        '''Returns the world matrix, i.e: the model matrix of the node
+        composed with the world matrix of its parent.'''
+        return self._store.world_mat(self._index)
 
     def translation_mat(self):
         '''Returns the translation matrix for this node'''
@@ -161,10 +495,27 @@ class Node():
 class CameraNode(Node):
     def __init__(self, camera, name, mesh=None, *args, **kwargs):
         self.camera = camera
+        # store version (world stamp if parented) of the cached view matrix
+        self._view_version = None
         super(CameraNode, self).__init__(name, mesh, *args, **kwargs)
 
     def view_mat(self):
-        '''Returns the view matrix for this camera node.'''
+        '''Returns the view matrix for this camera node. The matrix is cached
+        and only rebuilt after the node transform is set, it must not be
+        modified. The view matrix of cameras attached to a parent node is the
+        inverse of their world matrix, cached until the world stamp of the
+        camera changes, i.e: until the camera or one of its ancestors moves.'''
+        if self.parent is not None:
+            world = self.world_mat()  # brings the world stamps up to date
+            stamp = self._store._world_stamps[self._index]
+            if self._view_version != stamp:
+                self._view_version = stamp
+                self.view = np.linalg.inv(world)
+            return self.view
+        version = self._store._versions[self._index]
+        if self._view_version == version:
+            return self.view
+        self._view_version = version
         trans = self.translation_mat()
         trans[:-1, 3] = -trans[:-1, 3]  # <-- efficient matrix inversion
         rot = self.rotation_mat()
@@ -276,18 +627,21 @@ class CameraFPSNode(CameraNode):
         '''
         self.camera = camera
         self.snap = snap
+        # store version (world stamp if parented) of the cached view matrix
+        self._view_version = None
         super(CameraNode, self).__init__(name, mesh, *args, **kwargs)
 
     @property
     def position(self):
-        return self._position
+        return self._store._positions[self._index]
 
     @position.setter
     def position(self, position):
         if type(position) in [np.ndarray, tuple] and len(position) == 3:
-            self._position = np.array(position, dtype=np.float32)
             if self.snap != None:
-                self._position = np.around(self._position, decimals=self.snap)
+                position = np.around(position, decimals=self.snap)
+            self._store._positions[self._index] = position
+            self._store.touch(self._index)
         else:
             raise ValueError(
                 'position must be either a 3-tuple or an numpy.ndarray'
@@ -318,3 +672,103 @@ class CameraFPSNode(CameraNode):
 
 class LightNode(Node):
     pass
+
+
+class InstancedNode(Node):
+    '''A node that draws its mesh once per instance, e.g: the trees of a
+    forest. The mesh geometry is shared by all the instances, each instance
+    has its own transform, relative to the node, and color.
+
+    Instance colors multiply the vertex colors, through the `tint` uniform
+    of the shaders.
+    '''
+    def __init__(self, name, mesh, transforms=None, colors=None,
+            *args, **kwargs
+    ):
+        '''
+        Parameters
+        ----------
+        name: a string that identifies the node.
+        mesh: the `Mesh` drawn by every instance.
+        transforms: an (N, 4, 4) array with the instance transforms in node
+            space, a single identity instance if None.
+        colors: an (N, 4) array with the RGBA instance colors, white if None.
+
+        See `Node` for the other parameters.
+
+        Raises
+        ------
+        ValueError: if any of the input parameters does not respect its type.
+        '''
+        super(InstancedNode, self).__init__(name, mesh, *args, **kwargs)
+        if transforms is None:
+            transforms = np.eye(4, dtype=np.float32)[np.newaxis]
+        self.set_instances(transforms, colors)
+
+    def set_instances(self, transforms, colors=None):
+        '''Replaces the instances. A `SceneBVH` holding this node must be
+        rebuilt afterwards.
+
+        Raises
+        ------
+        ValueError: if `transforms` is not (N, 4, 4) or `colors` not (N, 4).
+        '''
+        transforms = np.ascontiguousarray(transforms, dtype=np.float32)
+        if transforms.ndim != 3 or transforms.shape[1:] != (4, 4):
+            raise ValueError('transforms must be an (N, 4, 4) array')
+        n = transforms.shape[0]
+        if colors is None:
+            colors = np.ones((n, 4), dtype=np.float32)
+        colors = np.ascontiguousarray(colors, dtype=np.float32)
+        if colors.shape != (n, 4):
+            raise ValueError('colors must be an (N, 4) array')
+        self._transforms = transforms
+        self._colors = colors
+        self._aabb = None
+
+    @property
+    def transforms(self):
+        return self._transforms
+
+    @property
+    def colors(self):
+        return self._colors
+
+    @property
+    def count(self):
+        '''The number of instances.'''
+        return self._transforms.shape[0]
+
+    def instance_mats(self, world=None):
+        '''Returns an (N, 4, 4) array with the world matrix of each instance,
+        given the node `world` matrix (the current one if None).'''
+        world = self.world_mat() if world is None else world
+        return world @ self._transforms
+
+    def instance_aabbs(self, mats):
+        '''Returns an (N, 2, 3) array with the bounds of the mesh
+        transformed by each of the (N, 4, 4) `mats`, e.g: the world space
+        bounds of the instances given `instance_mats()`.'''
+        aabb = self.mesh.aabb()
+        if aabb is None:
+            return None
+        return transform_aabbs(
+            np.broadcast_to(aabb, (len(mats), 2, 3)), mats
+        )
+
+    def aabb(self):
+        '''Returns the (2, 3) bounds of all the instances in model space, or
+        None if the mesh is unbounded.'''
+        if self._aabb is None and self.count:
+            aabbs = self.instance_aabbs(self._transforms)
+            if aabbs is None:
+                return None
+            self._aabb = np.array([aabbs[:, 0].min(0), aabbs[:, 1].max(0)])
+        return self._aabb
+
+
+class MissingCameraNodeError(Exception):
+    '''Raised by renderers given a camera name matching no camera node of
+    their scene.'''
+    pass
+
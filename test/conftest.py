@@ -0,0 +1,67 @@
+import collada as co
+import numpy as np
+import pytest
+
+
+def make_dae(path, no_objects=2, grid=4, normals=True):
+    '''Writes a collada file with `no_objects` geometries, each a triangulated
+    (grid x grid) height field with per-triangle normals, or none.'''
+    dae = co.Collada()
+    nodes = []
+    for k in range(no_objects):
+        x, z = np.meshgrid(np.arange(grid + 1.0), np.arange(grid + 1.0))
+        y = np.sin(x + k)*np.cos(z)
+        verts = np.stack((x.ravel() + k*grid, y.ravel(), z.ravel()), axis=1)
+        cells = np.arange((grid + 1)*grid).reshape(grid, grid + 1)[:, :-1]
+        cells = cells.ravel()
+        tris = np.concatenate((
+            np.stack((cells, cells + grid + 1, cells + 1), axis=1),
+            np.stack((cells + 1, cells + grid + 1, cells + grid + 2), axis=1),
+        ))
+        e1 = verts[tris[:, 1]] - verts[tris[:, 0]]
+        e2 = verts[tris[:, 2]] - verts[tris[:, 0]]
+        flat = np.cross(e1, e2)
+        flat /= np.linalg.norm(flat, axis=1)[:, np.newaxis]
+        vsrc = co.source.FloatSource(
+            'verts{}'.format(k), verts.ravel(), ('X', 'Y', 'Z')
+        )
+        nsrc = co.source.FloatSource(
+            'normals{}'.format(k), flat.ravel(), ('X', 'Y', 'Z')
+        )
+        geom = co.geometry.Geometry(
+            dae, 'geom{}'.format(k), 'geom{}'.format(k),
+            [vsrc, nsrc] if normals else [vsrc],
+        )
+        inputs = co.source.InputList()
+        inputs.addInput(0, 'VERTEX', '#verts{}'.format(k))
+        if normals:
+            inputs.addInput(1, 'NORMAL', '#normals{}'.format(k))
+            normal_index = np.repeat(np.arange(tris.shape[0]), 3)
+            interleaved = np.stack(
+                (tris, normal_index.reshape(-1, 3)), axis=2
+            ).ravel()
+        else:
+            interleaved = tris.ravel()
+        geom.primitives.append(
+            geom.createTriangleSet(interleaved, inputs, 'material')
+        )
+        dae.geometries.append(geom)
+        nodes.append(co.scene.Node(
+            'node{}'.format(k), children=[co.scene.GeometryNode(geom, [])]
+        ))
+    scene = co.scene.Scene('scene', nodes)
+    dae.scenes.append(scene)
+    dae.scene = scene
+    with open(str(path), 'wb') as f:
+        dae.write(f)
+    return path
+
+
+@pytest.fixture
+def dae_file(tmp_path):
+    return make_dae(tmp_path / 'mesh.dae')
+
+
+@pytest.fixture
+def smooth_dae_file(tmp_path):
+    return make_dae(tmp_path / 'smooth.dae', normals=False)
@@ -0,0 +1,67 @@
+import numpy as np
+
+from nano3d.batching import StaticBatcher, merge_meshes
+from nano3d.mesh import CubeWired, Grid, Line
+from nano3d.scene import Node, Scene
+
+
+def make_scene(n=10):
+    scene = Scene('scene')
+    for i in range(n):
+        node = Node('cube{}'.format(i), CubeWired(), position=(2.0*i, 0.0, 0.0))
+        node.static = True
+        scene.add_node(node)
+    scene.add_node(Node('dynamic', CubeWired()))
+    line = Node('line', Line([(0.0, 0.0, 0.0, 1.0), (1.0, 1.0, 1.0, 1.0)]))
+    line.static = True
+    scene.add_node(line)
+    return scene
+
+def test_merge_meshes():
+    a, b = CubeWired(), CubeWired()
+    world = np.eye(4)
+    world[:-1, -1] = (5.0, 0.0, 0.0)
+    merged = merge_meshes([a, b], [np.eye(4), world])
+    assert merged.positions.shape == (4, 16)
+    assert np.allclose(merged.aabb(), [[0.0, 0.0, 0.0], [6.0, 1.0, 1.0]])
+    assert np.allclose(merged.colors[:, 8:], b.colors)  # colors are copied
+    assert merged.no_indices == 24
+    assert merged.indices[:, 12:].min() == 8
+    assert merged.attribs['position'] is merged.positions
+
+def test_merge_grids():
+    world = np.eye(4)
+    world[:-1, -1] = (5.0, 0.0, 0.0)
+    merged = merge_meshes([Grid(2), Grid(2)], [np.eye(4), world])
+    # points at infinity are directions, translations leave them alone
+    assert np.array_equal(merged.positions[:, 12], [0.0, 0.0, -1.0, 0.0])
+    assert np.array_equal(merged.positions[:, 14], [3.0, 0.0, 0.0, 1.0])
+
+def test_static_batcher():
+    scene = make_scene()
+    batcher = StaticBatcher(scene, max_vertices=32)
+    # 80 cube vertices in batches of up to 32, the line shares their state
+    assert [len(b.counts) for b in batcher.batches] == [4, 4, 3]
+    assert len(batcher.members) == 11
+    assert batcher.update() == set()
+
+    cube = scene.nodes[5]
+    cube.position = (0.0, 10.0, 0.0)
+    assert batcher.update() == {1}
+    assert np.isclose(batcher.batches[1].mesh.aabb()[1, 1], 11.0)
+    assert batcher.update() == set()
+
+    cube.static = False
+    assert batcher.update() == {1}
+    assert len(batcher.batches[1].counts) == 3
+    for name in ['cube8', 'cube9', 'line']:
+        scene.remove_node([n for n in scene.nodes if n.name == name][0])
+    assert batcher.update() == {2}
+    assert batcher.batches[2] is None
+    assert len(batcher.meshes()) == 2
+
+    added = Node('new', CubeWired())
+    added.static = True
+    scene.add_node(added)
+    assert batcher.update() == {1}
+    assert added in batcher.batches[1].counts
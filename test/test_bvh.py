@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from nano3d.bvh import BVH
+from nano3d.camera import CameraPerspective
+from nano3d.culling import visibility_mask
+from nano3d.mesh import CubeWired
+from nano3d.scene import CameraNode, Node, Scene
+
+
+def random_aabbs(n, seed=0):
+    rng = np.random.default_rng(seed)
+    lo = rng.uniform(-100.0, 100.0, (n, 3))
+    return np.stack((lo, lo + rng.uniform(0.1, 2.0, (n, 3))), axis=1)
+
+def brute_aabb(aabbs, lo, hi):
+    return np.flatnonzero(
+        np.all((aabbs[:, 0] <= hi) & (aabbs[:, 1] >= lo), axis=1)
+    )
+
+@pytest.mark.parametrize('n', [0, 1, 7, 1000])
+def test_bvh_query_aabb(n):
+    aabbs = random_aabbs(n)
+    bvh = BVH(aabbs, leaf_size=4)
+    lo, hi = np.array([-20.0, -30.0, -40.0]), np.array([30.0, 20.0, 10.0])
+    assert np.array_equal(bvh.query_aabb(lo, hi), brute_aabb(aabbs, lo, hi))
+
+def test_bvh_refit():
+    aabbs = random_aabbs(500)
+    bvh = BVH(aabbs)
+    moved = np.arange(0, 500, 7)
+    aabbs[moved] += 50.0
+    bvh.refit(moved, aabbs[moved])
+    lo, hi = np.array([0.0, 0.0, 0.0]), np.array([60.0, 60.0, 60.0])
+    assert np.array_equal(bvh.query_aabb(lo, hi), brute_aabb(aabbs, lo, hi))
+
+def test_bvh_nearest_and_ray():
+    aabbs = random_aabbs(1000)
+    bvh = BVH(aabbs)
+    point = np.array([1.0, 2.0, 3.0])
+    delta = np.maximum(np.maximum(aabbs[:, 0] - point, point - aabbs[:, 1]), 0)
+    dist = np.linalg.norm(delta, axis=1)
+    index, d = bvh.nearest(point)
+    assert np.isclose(d, dist.min(), atol=1e-4)
+    prims, tnear = bvh.query_ray((0.0, 0.0, -200.0), (0.0, 0.0, 1.0))
+    assert np.all(np.diff(tnear) >= 0.0)
+    expected = np.flatnonzero(
+        (aabbs[:, 0, 0] <= 0.0) & (aabbs[:, 1, 0] >= 0.0)
+        & (aabbs[:, 0, 1] <= 0.0) & (aabbs[:, 1, 1] >= 0.0)
+    )
+    assert np.array_equal(np.sort(prims), expected)
+
+def test_scene_bvh_culling():
+    scene = Scene('scene')
+    camnode = CameraNode(CameraPerspective(aspect=1.0), 'cam')
+    scene.add_node(camnode)
+    for i in range(50):
+        scene.add_node(Node('cube{}'.format(i), CubeWired(),
+            position=(0.0, 0.0, 10.0 - i)))
+    projection = camnode.projection_mat()
+    expected = visibility_mask(scene, camnode, projection)
+    scene.build_bvh()
+    assert np.array_equal(visibility_mask(scene, camnode, projection), expected)
+    scene.nodes[1].position = (0.0, 0.0, -5.0)  # move into view
+    scene.nodes[30].position = (0.0, 0.0, 50.0)  # move out of view
+    mask = visibility_mask(scene, camnode, projection)
+    assert mask[1] and not mask[30]
+    scene.bvh = None
+    assert np.array_equal(visibility_mask(scene, camnode, projection), mask)
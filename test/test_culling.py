@@ -0,0 +1,66 @@
+import numpy as np
+
+from nano3d.camera import CameraPerspective
+from nano3d.culling import (
+    aabbs_in_frustum, frustum_planes, transform_aabbs, visible_nodes
+)
+from nano3d.mesh import CubeWired, Grid, Mesh
+from nano3d.scene import CameraNode, Node, Scene
+
+
+def test_mesh_bounds():
+    mesh = CubeWired()
+    assert np.allclose(mesh.aabb(), [[0.0, 0.0, 0.0], [1.0, 1.0, 1.0]])
+    center, radius = mesh.bounding_sphere()
+    assert np.allclose(center, (0.5, 0.5, 0.5))
+    assert np.isclose(radius, np.sqrt(3)/2.)
+    assert Mesh().aabb() is None
+
+def test_transform_aabbs():
+    mats = np.tile(np.eye(4, dtype=np.float32), (2, 1, 1))
+    mats[1, :-1, -1] = (1.0, 2.0, 3.0)
+    mats[1, 0, 0] = -2.0
+    aabbs = np.array([[[0.0, 0.0, 0.0], [1.0, 1.0, 1.0]]]*2)
+    world = transform_aabbs(aabbs, mats)
+    assert np.allclose(world[0], aabbs[0])
+    assert np.allclose(world[1], [[-1.0, 2.0, 3.0], [1.0, 3.0, 4.0]])
+
+def test_aabbs_in_frustum():
+    camnode = CameraNode(CameraPerspective(aspect=1.0), 'cam')
+    planes = frustum_planes(camnode.projection_mat() @ camnode.view_mat())
+    aabbs = np.array([
+        [[-0.5, -0.5, -5.5], [0.5, 0.5, -4.5]],      # in front
+        [[-0.5, -0.5, 4.5], [0.5, 0.5, 5.5]],        # behind
+        [[50.0, -0.5, -5.5], [51.0, 0.5, -4.5]],     # far right
+        [[-0.5, -0.5, -200.0], [0.5, 0.5, -150.0]],  # beyond far plane
+        [[-10.0, -10.0, -1.0], [10.0, 10.0, 1.0]],   # crossing near plane
+    ])
+    assert list(aabbs_in_frustum(planes, aabbs)) == [
+        True, False, False, False, True
+    ]
+
+def test_visible_nodes():
+    scene = Scene('scene')
+    camnode = CameraNode(CameraPerspective(aspect=1.0), 'cam')
+    camnode.rotate(0.0, np.pi, 0.0)  # look towards +zz
+    scene.add_node(camnode)
+    front = Node('front', CubeWired(), position=(0.0, 0.0, 5.0))
+    back = Node('back', CubeWired(), position=(0.0, 0.0, -5.0))
+    hidden = Node('hidden', CubeWired(), position=(0.0, 0.0, 5.0))
+    hidden.visible = False
+    empty = Node('empty', Mesh())
+    for node in [front, back, hidden, empty]:
+        scene.add_node(node)
+    visible = visible_nodes(scene, camnode, camnode.projection_mat())
+    assert visible == [front, empty]
+
+def test_grid_unbounded():
+    # the ticks of the grid are behind the camera, its lines go to infinity
+    scene = Scene('scene')
+    scene.add_node(CameraNode(CameraPerspective(aspect=1.0), 'cam', position=(0.0, 1.0, -50.0)))
+    scene.add_node(Node('grid', Grid(10)))
+    assert Grid(10).aabb() is None
+    camnode = scene.nodes[0]
+    nodes = visible_nodes(scene, camnode, camnode.projection_mat())
+    assert [node.name for node in nodes] == ['grid']
+
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from nano3d.camera import CameraOrtho, CameraPerspective
+from nano3d.lod import LODChain, lod_chain, simplify
+from nano3d.mesh import BadPrimitiveError, CubeWired, Mesh, Primitive
+from nano3d.rasterizer import SoftwareRenderer
+from nano3d.scene import CameraNode, Node, Scene
+
+
+def sphere(n=64):
+    '''A UV sphere of radius 1 with 2*n*n triangles.'''
+    theta, phi = np.meshgrid(np.linspace(0, np.pi, n+1), np.linspace(0, 2*np.pi, n+1))
+    xyz = np.stack((np.sin(theta)*np.cos(phi), np.sin(theta)*np.sin(phi), np.cos(theta)))
+    mesh = Mesh()
+    mesh.primitive = Primitive.TRIANGLES
+    mesh.positions = xyz.reshape(3, -1).astype(np.float32)
+    mesh.normals = mesh.positions
+    mesh.colors = np.ones((4, xyz[0].size), dtype=np.float32)
+    cells = np.arange((n+1)*n).reshape(n, n+1)[:, :-1].ravel()
+    mesh.indices = np.concatenate((
+        np.stack((cells, cells + 1, cells + n + 2), axis=1),
+        np.stack((cells, cells + n + 2, cells + n + 1), axis=1),
+    )).T.astype(np.int32)
+    mesh.no_indices = mesh.indices.shape[1]
+    mesh.attribs = {'position': mesh.positions, 'color': mesh.colors}
+    return mesh
+
+def test_simplify():
+    mesh = sphere()
+    simple = simplify(mesh, 0.25)
+    assert simple.no_indices < mesh.no_indices/10
+    assert simple.indices.max() < simple.positions.shape[1]
+    assert set(simple.attribs) == {'position', 'color'}
+    # no degenerate triangles and vertices stay close to the surface
+    t = simple.indices.T
+    assert np.all((t[:, 0] != t[:, 1]) & (t[:, 1] != t[:, 2]) & (t[:, 2] != t[:, 0]))
+    radii = np.linalg.norm(simple.positions, axis=0)
+    assert np.all(np.abs(radii - 1.0) < 0.25*np.sqrt(3))
+    assert np.allclose(np.linalg.norm(simple.normals, axis=0), 1.0)
+
+def test_lod_chain():
+    mesh = sphere()
+    chain = LODChain(mesh, levels=4)
+    assert len(chain) == 4 and chain.meshes[0] is mesh
+    counts = [m.no_indices for m in chain.meshes]
+    assert counts == sorted(counts, reverse=True)
+    assert lod_chain(mesh) is lod_chain(mesh)
+    with pytest.raises(BadPrimitiveError):
+        LODChain(CubeWired())
+
+def test_lod_select():
+    chain = LODChain(sphere(), levels=4)
+    camnode = CameraNode(CameraPerspective(aspect=1.0), 'cam')
+    view, projection = camnode.view_mat(), camnode.projection_mat()
+    levels = []
+    for distance in [2.0, 20.0, 80.0, 5000.0]:
+        world = np.eye(4)
+        world[2, 3] = -distance
+        levels.append(chain.select(world, view, projection, 600))
+    assert levels[0] == 0 and levels[-1] == 3
+    assert levels == sorted(levels)
+    # twice the pixel budget never selects a finer level
+    world[2, 3] = -20.0
+    assert chain.select(world, view, projection, 600, 2.0) >= levels[1]
+    # the camera inside the mesh gets the full resolution level
+    world[2, 3] = -0.5
+    assert chain.select(world, view, projection, 600) == 0
+    ortho = CameraNode(CameraOrtho(projw=1000.0, projh=1000.0), 'ortho')
+    assert chain.select(np.eye(4), ortho.view_mat(), ortho.projection_mat(), 600) == 3
+
+def test_rasterizer_lod():
+    scene = Scene('scene')
+    scene.add_node(CameraNode(CameraPerspective(aspect=1.0), 'cam', position=(0.0, 0.0, 60.0)))
+    mesh = sphere()
+    scene.add_node(Node('sphere', mesh))
+    renderer = SoftwareRenderer('r', scene, 'cam', size=(64, 64))
+    renderer.draw_handler()
+    full = renderer.depth < 1.0
+    renderer.enable_lod(max_error=1.0)
+    assert renderer.select_lod(mesh, np.eye(4), scene.nodes[0].view_mat(), renderer.projection) is not mesh
+    renderer.draw_handler()
+    assert abs(int((renderer.depth < 1.0).sum()) - int(full.sum())) <= 0.2*full.sum()
@@ -0,0 +1,254 @@
+import array
+import os
+
+import numpy as np
+import pytest
+
+from nano3d.mesh import (
+    ChunkedMesh, CubeWired, Dae, DynamicMesh, Grid, InfiniteGrid, Line, Mesh,
+    Polyline, Primitive, decimate_columns,
+)
+from nano3d.meshcache import MeshCache
+
+
+def test_dae(dae_file):
+    mesh = Dae(str(dae_file))
+    assert mesh.primitive == Primitive.TRIANGLES
+    # flat shaded, every corner has its own normal
+    assert mesh.positions.shape == (3, 2*96)
+    assert mesh.normals.shape == (3, 2*96)
+    assert mesh.indices.shape == (3, 2*32)
+    assert mesh.no_indices == 2*32
+    # indices of the second object are offset past the first one
+    assert mesh.indices[:, :32].max() < 96 <= mesh.indices[:, 32:].min()
+    assert np.allclose(np.linalg.norm(mesh.normals, axis=0), 1.0)
+    tris = mesh.triangles()
+    faces = np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0])
+    corners = mesh.normals[:, mesh.indices].transpose(2, 1, 0)
+    assert np.allclose(np.cross(corners, faces[:, np.newaxis]), 0.0, atol=1e-5)
+
+def test_dae_without_normals(smooth_dae_file):
+    daefile = smooth_dae_file
+    mesh = Dae(str(daefile))
+    assert mesh.positions.shape == (3, 2*25)
+    assert np.allclose(np.linalg.norm(mesh.normals, axis=0), 1.0)
+    assert np.all(mesh.normals[1] > 0.0)  # the height fields face up
+    creased = Dae(str(daefile), crease_angle=1.0)
+    assert creased.positions.shape[1] > 2*25
+    assert set(mesh.timings) >= {'parse', 'assemble', 'total'}
+
+def test_dae_cache(dae_file, tmp_path):
+    cache = MeshCache(tmp_path / 'cache')
+    parsed = Dae(str(dae_file), cache=cache)
+    assert 'parse' in parsed.timings and len(cache.entries()) == 1
+    cached = Dae(str(dae_file), cache=cache)
+    assert 'parse' not in cached.timings
+    # memory-mapped, neither copied nor writeable
+    assert not cached.positions.flags.owndata
+    assert not cached.positions.flags.writeable
+    for name in ['positions', 'indices', 'normals']:
+        assert np.array_equal(getattr(parsed, name), getattr(cached, name))
+    assert cached.attribs['position'] is cached.positions
+    assert set(cached.uniforms) == set(parsed.uniforms)
+    assert cached.no_indices == parsed.no_indices
+    assert cached.primitive == Primitive.TRIANGLES
+
+def test_dae_cache_options(smooth_dae_file, tmp_path):
+    cache = MeshCache(tmp_path / 'cache')
+    daefile = str(smooth_dae_file)
+    assert Dae(daefile, cache=cache).positions.shape[1] == 2*25
+    # other options miss, and get their own entry
+    creased = Dae(daefile, cache=cache, crease_angle=1.0)
+    assert 'parse' in creased.timings and creased.positions.shape[1] > 2*25
+    cached = Dae(daefile, cache=cache, crease_angle=1.0)
+    assert 'parse' not in cached.timings
+    assert cached.positions.shape == creased.positions.shape
+    optimized = Dae(daefile, cache=cache, crease_angle=1.0, optimize=True)
+    assert 'parse' in optimized.timings
+    cached = Dae(daefile, cache=cache, crease_angle=1.0, optimize=True)
+    assert 'parse' not in cached.timings and 'optimize' not in cached.timings
+    assert len(cache.entries()) == 3
+    assert Dae(daefile, cache=cache).positions.shape[1] == 2*25
+
+def test_mesh_cache_lru(tmp_path):
+    sources = []
+    for i in range(3):
+        source = tmp_path / 'src{}.bin'.format(i)
+        source.write_bytes(bytes([i]))
+        sources.append(source)
+    cache = MeshCache(tmp_path / 'cache', max_bytes=2**40)
+    arrays = {'positions': np.zeros((3, 1000), dtype=np.float32)}
+    entries = [cache.put(source, arrays) for source in sources]
+    os.utime(str(entries[0]), (0, 0))  # least recently used
+    os.utime(str(entries[1]), (1, 1))
+    cache.max_bytes = cache.size() - 1
+    cache.evict()
+    assert cache.get(sources[0]) is None
+    assert cache.get(sources[1]) is not None
+    assert cache.get(sources[2]) is not None
+
+def test_chunked_mesh(tmp_path):
+    rng = np.random.default_rng(0)
+    points = rng.uniform(-10.0, 10.0, (10000, 3)).astype(np.float32)
+    points[:, 0] = np.sort(points[:, 0])  # spatially coherent chunks
+    np.save(str(tmp_path / 'points.npy'), points)
+    source = np.load(str(tmp_path / 'points.npy'), mmap_mode='r')
+    mesh = ChunkedMesh(source, chunk_size=1000, budget=3*1000*(12 + 4 + 16))
+    assert len(mesh) == 10
+    assert np.allclose(mesh.aabb(), [points.min(axis=0), points.max(axis=0)])
+    for i, chunk in mesh.chunks():
+        assert np.array_equal(chunk.positions.T, points[i*1000:(i+1)*1000])
+        assert np.allclose(chunk.aabb(), mesh.bounds[i])
+        assert mesh.resident_bytes <= mesh.budget
+    assert [mesh.is_loaded(i) for i in range(10)] == [False]*7 + [True]*3
+
+def test_chunked_mesh_indexed():
+    positions = np.arange(30, dtype=np.float32).reshape(10, 3)
+    indices = np.array([[0, 9, 5], [1, 2, 3], [9, 8, 7]])
+    mesh = ChunkedMesh(positions, indices,
+        primitive=Primitive.TRIANGLES, chunk_size=2)
+    assert len(mesh) == 2
+    chunk = mesh.chunk(0)
+    assert np.array_equal(
+        chunk.positions.T[chunk.indices.T], positions[indices[:2]]
+    )
+    assert np.array_equal(mesh.bounds[1], [[21, 22, 23], [27, 28, 29]])
+
+def test_mesh_setters_do_not_copy():
+    mesh = Mesh()
+    positions = np.zeros((100, 4), dtype=np.float32).T  # column-major
+    mesh.positions = positions
+    assert mesh.positions is positions
+    indices = np.arange(10, dtype=np.int32)
+    mesh.indices = indices
+    assert mesh.indices is indices
+    mesh.colors = np.zeros((100, 8), dtype=np.float32)[:, ::2].T
+    assert mesh.colors.flags.f_contiguous  # strided input is compacted
+    mesh.normals = [[0.0, 1.0], [1.0, 0.0], [0.0, 0.0]]
+    assert mesh.normals.dtype == np.float32
+    buffer = array.array('f', range(12))
+    mesh.positions = memoryview(buffer)
+    assert np.shares_memory(mesh.positions, np.frombuffer(buffer, np.float32))
+
+def test_mesh_set_buffer():
+    mesh = Mesh()
+    raw = bytearray(np.arange(12, dtype=np.float32).tobytes())
+    mesh.set_buffer('positions', raw, 3)
+    assert mesh.positions.shape == (3, 4)
+    assert np.array_equal(mesh.positions[:, 1], (3.0, 4.0, 5.0))
+    raw[:4] = np.float32(7.0).tobytes()
+    assert mesh.positions[0, 0] == 7.0
+
+def test_mesh_interleave():
+    mesh = CubeWired()
+    mesh.normals = np.ones((3, 8), dtype=np.float32)
+    positions = mesh.positions.copy()
+    mesh.interleave()
+    assert mesh.layout == 'interleaved'
+    # colors alias positions in CubeWired and are packed once
+    assert mesh.vertices.shape == (8, 4 + 3)
+    assert mesh.colors is mesh.positions
+    assert np.array_equal(mesh.positions, positions)
+    assert np.shares_memory(mesh.positions, mesh.vertices)
+    assert mesh.attribs['position'] is mesh.positions
+    mesh.normals = np.zeros((3, 8))
+    assert np.all(mesh.vertices[:, 4:7] == 0.0)
+    mesh.colors = np.zeros((4, 8))
+    assert np.array_equal(mesh.positions, positions)
+    mesh.planarize()
+    assert mesh.layout == 'planar'
+    assert mesh.positions.flags.f_contiguous
+    assert np.array_equal(mesh.positions, positions)
+    assert mesh.attribs['position'] is mesh.positions
+
+def test_line():
+    line = Line(np.zeros((5, 4)), colors=[(1, 0, 0, 1), (0, 1, 0, 1)])
+    assert line.indices.dtype == np.int32
+    assert np.array_equal(line.indices[:, -1], (3, 4))
+    assert np.array_equal(line.colors[:, -1], (0, 1, 0, 1))
+    assert line.no_indices == 4
+    assert Line(np.zeros((3, 3))).colors.shape == (4, 3)
+
+def test_dynamic_mesh():
+    mesh = DynamicMesh(Primitive.LINES, capacity=4)
+    assert mesh.no_indices == 0 and mesh.aabb() is None
+    mesh.append([(0.0, 0.0, 0.0), (1.0, 0.0, 0.0), (1.0, 1.0, 0.0)])
+    assert mesh.positions.shape == (3, 3) and mesh.no_indices == 2
+    assert mesh.indices.T.tolist() == [[0, 1], [1, 2]]
+    assert np.allclose(mesh.colors, 1.0)
+    assert mesh.attribs['position'] is mesh.positions
+    since = mesh.version
+    # growing doubles the capacity, copies remain valid
+    mesh.append(np.ones((3, 4)), colors=(1.0, 0.0, 0.0, 1.0))
+    assert (mesh.count, mesh.capacity, mesh.no_indices) == (6, 8, 5)
+    assert mesh.dirty_range(since) == (0, 6)  # reallocated
+    assert np.allclose(mesh.aabb(), [[0.0, 0.0, 0.0], [1.0, 1.0, 1.0]])
+    since = mesh.version
+    mesh.append([(2.0, 2.0, 2.0)])
+    mesh.update(1, colors=[(0.0, 1.0, 0.0, 1.0)])
+    assert mesh.dirty_range(since) == (1, 7)
+    assert mesh.dirty_range(mesh.version) is None
+    assert mesh.colors[:, 1].tolist() == [0.0, 1.0, 0.0, 1.0]
+    assert np.allclose(mesh.aabb()[1], 2.0)
+    with pytest.raises(IndexError):
+        mesh.update(6, np.zeros((2, 3)))
+    mesh.clear()
+    assert mesh.no_indices == 0 and mesh.capacity == 8
+    triangles = DynamicMesh(Primitive.TRIANGLES)
+    triangles.append(np.zeros((7, 3)))
+    assert triangles.no_indices == 2 and triangles.indices[:, 1].tolist() == [3, 4, 5]
+
+def test_polyline():
+    line = Polyline(chunk_size=4, max_points=6)
+    assert line.decimate(np.eye(4), (8, 8)).no_indices == 0
+    line.append(np.column_stack((np.arange(5.0), np.zeros((5, 2)))))
+    assert len(line.chunks()) == 2 and line.indices.dtype == np.int32
+    assert line.positions.shape == (3, 5) and line.no_indices == 4
+    line.append(np.column_stack((np.arange(5.0, 13.0), np.ones((8, 2)))))
+    # the oldest chunk is dropped, at least max_points are kept
+    assert len(line) == 9 and line.points()[0, 0] == 4.0
+    assert np.allclose(line.aabb(), [[4.0, 0.0, 0.0], [12.0, 1.0, 1.0]])
+    assert line.indices[:, -1].tolist() == [7, 8]
+
+def test_decimate_columns():
+    # a noisy time series, a column every 1000 samples
+    rng = np.random.default_rng(0)
+    t = np.linspace(-1.0, 1.0, 64000, endpoint=False)
+    points = np.column_stack((t, rng.uniform(-1.0, 1.0, t.size), np.zeros_like(t)))
+    kept = decimate_columns(points, np.eye(4), (64, 64))
+    assert len(kept) <= 4*64 and kept[0] == 0 and kept[-1] == t.size - 1
+    # the vertical extent of every column is kept
+    columns = np.floor((t + 1.0)*32.0).astype(int)
+    for c in [0, 31, 63]:
+        y = points[columns == c, 1]
+        assert set([y.min(), y.max()]) <= set(points[kept[columns[kept] == c], 1])
+    # runs are split at the 16 chunk boundaries
+    line = Polyline(points, chunk_size=2**12)
+    assert line.decimate(np.eye(4), (64, 64)).count <= 4*(64 + 16)
+    assert line.decimate(np.eye(4), (64, 64)) is line.output
+
+def test_grid():
+    grid = Grid(2)
+    assert grid.positions.dtype == np.float32 and grid.positions.shape == (4, 12)
+    assert grid.indices.shape == (2, 16) and grid.indices[:, 4].tolist() == [1, 2]
+    # the lines go to points at infinity
+    assert grid.positions[:, 0].tolist() == [0.0, 0.0, -1.0, 0.0]
+
+def test_infinite_grid():
+    grid = InfiniteGrid(cell_size=1.0, extent=4, levels=2, ratio=10)
+    positions, colors = grid.positions, grid.colors
+    assert positions.shape == (3, 2*2*9*3) and grid.no_indices == 2*2*9*2
+    assert grid.aabb() is None and grid.dirty_range(grid.version) is None
+    version = grid.version
+    assert not grid.follow((0.9, 0.2, 0.1))  # same cell
+    assert grid.follow((1e6 + 0.5, 0.2, -3e5))
+    assert grid.dirty_range(version) == (0, positions.shape[1])
+    # regenerated in place around the camera
+    assert grid.positions is positions and grid.colors is colors
+    assert np.isclose(np.median(positions[0]), 1e6, atol=10.0)
+    assert np.all(np.abs(positions[0] - 1e6) <= 40.5)
+    # lines fade out with the distance, and the fine level with the height
+    assert np.allclose(colors[3, ::3], 0.0) and colors[3].max() > 0.9
+    grid.follow((1e6, 3.5, -3e5))
+    fine, coarse = colors[3].reshape(2, -1)
+    assert fine.max() < 0.2 < coarse.max()
@@ -0,0 +1,139 @@
+import numpy as np
+import pytest
+
+from nano3d.mesh import (
+    BadPrimitiveError, CubeWired, Dae, Mesh, Primitive, smooth_normals,
+)
+from nano3d.meshcache import MeshCache
+from nano3d.meshopt import (
+    acmr, compute_normals, forsyth_order, optimize, optimize_triangles, weld,
+)
+
+
+def grid(n=32):
+    '''An (n x n) grid of quads split in triangles with unshared vertices,
+    the triangles shuffled.'''
+    x, y = np.meshgrid(np.arange(n + 1.0), np.arange(n + 1.0))
+    xyz = np.stack((x.ravel(), y.ravel(), np.zeros(x.size)))
+    cells = np.arange((n+1)*n).reshape(n, n+1)[:, :-1].ravel()
+    tris = np.concatenate((
+        np.stack((cells, cells + 1, cells + n + 2), axis=1),
+        np.stack((cells, cells + n + 2, cells + n + 1), axis=1),
+    ))
+    tris = tris[np.random.default_rng(0).permutation(len(tris))]
+    mesh = Mesh()
+    mesh.primitive = Primitive.TRIANGLES
+    mesh.positions = xyz[:, tris.ravel()].astype(np.float32)
+    mesh.normals = np.tile([[0.0], [0.0], [1.0]], (1, tris.size))
+    mesh.indices = np.arange(tris.size).reshape(-1, 3).T
+    mesh.no_indices = len(tris)
+    mesh.attribs = {'position': mesh.positions, 'normal': mesh.normals}
+    return mesh
+
+def test_weld():
+    mesh = grid(4)
+    corners = mesh.triangles()
+    weld(mesh)
+    assert mesh.positions.shape[1] == 25
+    assert mesh.attribs['position'] is mesh.positions
+    assert np.array_equal(mesh.triangles(), corners)
+    # different normals are not welded
+    mesh = grid(4)
+    mesh.normals[:, ::2] = [[1.0], [0.0], [0.0]]
+    weld(mesh)
+    assert mesh.positions.shape[1] > 25
+
+def test_optimize():
+    mesh = grid()
+    corners = {tuple(map(tuple, t)) for t in mesh.triangles().tolist()}
+    reports = optimize(mesh)
+    assert [r['stage'] for r in reports] == [
+        'weld', 'triangles', 'vertices', 'indices'
+    ]
+    weld_, triangles, vertices, indices = reports
+    assert weld_['vertices'] == (6*32*32, 33*33)
+    assert triangles['acmr'][1] < 0.8 < triangles['acmr'][0]
+    assert indices['index_bytes'] == (
+        4*6*32*32, 2*6*32*32
+    )
+    assert mesh.indices.dtype == np.uint16
+    # the first vertices come first, the same triangles are drawn
+    assert mesh.indices[:, 0].tolist() == [0, 1, 2]
+    assert {tuple(map(tuple, t)) for t in mesh.triangles().tolist()} == corners
+
+def test_forsyth_order():
+    tris = np.array([[0, 1, 2], [3, 4, 5], [1, 2, 6]])
+    order = forsyth_order(tris, 7, cache_size=8)
+    assert sorted(order.tolist()) == [0, 1, 2]
+    # triangles sharing vertices are drawn one after the other
+    assert abs(order.tolist().index(0) - order.tolist().index(2)) == 1
+
+def test_acmr():
+    mesh = CubeWired()
+    assert acmr(mesh) == 8/12
+    assert acmr(mesh, cache_size=1) > 8/12
+    with pytest.raises(BadPrimitiveError):
+        optimize_triangles(mesh)
+    reports = optimize(mesh)
+    assert 'triangles' not in [r['stage'] for r in reports]
+    assert mesh.colors is mesh.positions
+
+def test_dae_optimize(dae_file, tmp_path):
+    plain = Dae(str(dae_file))
+    mesh = Dae(str(dae_file), optimize=True)
+    assert len(mesh.optimization) == 4 and 'optimize' in mesh.timings
+    assert mesh.positions.shape[1] <= plain.positions.shape[1]
+    assert mesh.indices.dtype == np.uint16
+    assert np.allclose(mesh.aabb(), plain.aabb())
+    cache = MeshCache(tmp_path / 'cache')
+    Dae(str(dae_file), cache=cache, optimize=True)
+    cached = Dae(str(dae_file), cache=cache, optimize=True)
+    assert cached.optimization == []  # cached optimized
+    assert np.array_equal(cached.indices, mesh.indices)
+
+def test_compute_normals():
+    # a cube with shared corners
+    mesh = Mesh()
+    mesh.primitive = Primitive.TRIANGLES
+    corners = np.array(np.meshgrid([0, 1], [0, 1], [0, 1], indexing='ij'))
+    mesh.positions = corners.reshape(3, -1).astype(np.float32)
+    quads = [
+        [0, 1, 3, 2], [4, 6, 7, 5], [0, 4, 5, 1],
+        [2, 3, 7, 6], [0, 2, 6, 4], [1, 5, 7, 3],
+    ]
+    mesh.indices = np.array([
+        t for a, b, c, d in quads for t in [(a, b, c), (a, c, d)]
+    ]).T
+    mesh.no_indices = 12
+    mesh.attribs = {'position': mesh.positions}
+    compute_normals(mesh)
+    assert mesh.attribs['normal'] is mesh.normals
+    assert np.allclose(np.linalg.norm(mesh.normals, axis=0), 1.0)
+    outward = mesh.positions - 0.5
+    assert np.all(np.sum(mesh.normals*outward, axis=0) > 0.5)
+    assert np.allclose(mesh.normals[:, [0, 7]], [[-1, 1]]*3/np.sqrt(3.0))
+    # the faces are at 90 degrees, split into 6*4 flat shaded vertices
+    compute_normals(mesh, crease_angle=60.0)
+    assert mesh.positions.shape[1] == 24
+    assert np.allclose(np.abs(mesh.normals).sum(axis=0), 1.0)
+    tris = mesh.triangles()
+    faces = np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0])
+    assert np.allclose(mesh.normals[:, mesh.indices[0]].T, faces)
+
+def test_crease_high_valence():
+    # the tip of a cone of 50000 triangles, with normals all around
+    m = 50000
+    a = np.linspace(0.0, 2*np.pi, m, endpoint=False)
+    positions = np.vstack(([0.0, 0.0, 1.0], np.column_stack((np.cos(a), np.sin(a), np.zeros(m))))).T
+    triangles = np.column_stack((np.zeros(m, int), 1 + np.arange(m), 1 + (np.arange(m) + 1) % m))
+    normals, source, split = smooth_normals(positions, triangles, crease_angle=30.0)
+    # the tip is split in a few vertices, whose corners are within the angle
+    tips = np.flatnonzero(source == 0)
+    assert 4 <= len(tips) <= 16
+    assert np.array_equal(source[split], triangles)
+    corners = positions.T[triangles]
+    faces = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    faces /= np.linalg.norm(faces, axis=1)[:, None]
+    cosines = np.sum(normals[:, split[:, 0]].T*faces, axis=1)
+    assert cosines.min() > np.cos(np.radians(30.0))
+
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from nano3d.camera import CameraPerspective
+from nano3d.mesh import ChunkedMesh, Mesh, Primitive
+from nano3d.picking import pick, pick_screen, ray_triangles, unproject
+from nano3d.scene import CameraNode, InstancedNode, Node, Scene
+
+
+def quad(n=1):
+    '''A unit quad on the xy plane split into 2*n*n triangles.'''
+    mesh = Mesh()
+    mesh.primitive = Primitive.TRIANGLES
+    x, y = np.meshgrid(np.linspace(-0.5, 0.5, n+1), np.linspace(-0.5, 0.5, n+1))
+    mesh.positions = np.stack((x.ravel(), y.ravel(), np.zeros(x.size)))
+    cells = np.arange((n+1)*n).reshape(n, n+1)[:, :-1].ravel()
+    indices = np.concatenate((
+        np.stack((cells, cells + 1, cells + n + 2), axis=1),
+        np.stack((cells, cells + n + 2, cells + n + 1), axis=1),
+    ))
+    mesh.indices = indices.T
+    return mesh
+
+def test_ray_triangles():
+    tris = np.array([
+        [[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [0.0, 1.0, 0.0]],
+        [[0.0, 0.0, 2.0], [1.0, 0.0, 2.0], [0.0, 1.0, 2.0]],
+        [[5.0, 5.0, 1.0], [6.0, 5.0, 1.0], [5.0, 6.0, 1.0]],
+    ])
+    t = ray_triangles(np.array([0.2, 0.2, -1.0]), np.array([0.0, 0.0, 1.0]), tris)
+    assert np.allclose(t, [1.0, 3.0, np.inf])
+
+def test_unproject_center():
+    camnode = CameraNode(CameraPerspective(), 'cam', position=(1.0, 2.0, 3.0))
+    origin, direction = unproject(camnode, (400, 300), (800, 600))
+    assert np.allclose(direction, (0.0, 0.0, -1.0))
+    assert np.allclose(origin, (1.0, 2.0, 3.0 - camnode.camera.near))
+
+@pytest.mark.parametrize('with_bvh', [False, True])
+def test_pick(with_bvh):
+    scene = Scene('scene')
+    camnode = CameraNode(CameraPerspective(), 'cam', position=(0.0, 0.0, 5.0))
+    scene.add_node(camnode)
+    near = Node('near', quad(16), position=(0.0, 0.0, 1.0))
+    far = Node('far', quad(), scale=(10.0, 10.0, 1.0))
+    scene.add_node(far)
+    scene.add_node(near)
+    if with_bvh:
+        scene.build_bvh()
+    hit = pick_screen(scene, camnode, (400, 300), (800, 600))
+    assert hit.node is near
+    assert np.isclose(hit.distance, 4.0 - camnode.camera.near)
+    assert np.allclose(hit.point, (0.0, 0.0, 1.0))
+    hit = pick(scene, (2.0, 2.0, 5.0), (0.0, 0.0, -1.0))
+    assert hit.node is far
+    assert pick(scene, (20.0, 0.0, 5.0), (0.0, 0.0, -1.0)) is None
+
+@pytest.mark.parametrize('with_bvh', [False, True])
+def test_pick_instances(with_bvh):
+    scene = Scene('scene')
+    transforms = np.tile(np.eye(4), (3, 1, 1))
+    transforms[:, 0, -1] = (-2.0, 0.0, 2.0)
+    transforms[1, 2, -1] = 1.0  # the middle one is nearer
+    scene.add_node(InstancedNode('forest', quad(4), transforms, position=(0.0, 1.0, 0.0)))
+    if with_bvh:
+        scene.build_bvh()
+    hit = pick(scene, (2.1, 1.1, 5.0), (0.0, 0.0, -1.0))
+    assert hit.instance == 2 and np.isclose(hit.distance, 5.0)
+    hit = pick(scene, (0.0, 1.0, 5.0), (0.0, 0.0, -1.0))
+    assert hit.instance == 1 and np.isclose(hit.distance, 4.0)
+    assert pick(scene, (1.0, 1.0, 5.0), (0.0, 0.0, -1.0)) is None
+
+@pytest.mark.parametrize('with_bvh', [False, True])
+def test_pick_chunked(with_bvh):
+    scene = Scene('scene')
+    mesh = quad(8)
+    chunked = ChunkedMesh(mesh.positions.T, mesh.indices.T, primitive=Primitive.TRIANGLES, chunk_size=16)
+    scene.add_node(Node('chunked', chunked, position=(0.0, 0.0, 1.0)))
+    if with_bvh:
+        scene.build_bvh()
+    hit = pick(scene, (0.3, 0.2, 5.0), (0.0, 0.0, -1.0))
+    assert hit.node.name == 'chunked' and np.isclose(hit.distance, 4.0)
+    # the index of the triangle in the whole mesh
+    scene = Scene('flat')
+    scene.add_node(Node('mesh', mesh, position=(0.0, 0.0, 1.0)))
+    assert hit.triangle == pick(scene, (0.3, 0.2, 5.0), (0.0, 0.0, -1.0)).triangle
+    assert chunked.positions is None
+
@@ -0,0 +1,71 @@
+import json
+
+import numpy as np
+
+from nano3d.camera import CameraPerspective
+from nano3d.mesh import CubeWired, Mesh, Primitive
+from nano3d.profiler import Profiler
+from nano3d.rasterizer import SoftwareRenderer
+from nano3d.scene import CameraNode, Node, Scene
+
+
+def test_profiler(tmp_path):
+    profiler = Profiler(frames=3)
+    # disabled, nothing is recorded
+    profiler.begin_frame()
+    with profiler.scope('a'):
+        profiler.count('draws')
+    profiler.end_frame()
+    assert len(profiler.frames) == 0 and not profiler.recording
+
+    profiler.enabled = True
+    for i in range(5):
+        profiler.begin_frame()
+        with profiler.scope('outer', i=i):
+            with profiler.scope('inner'):
+                profiler.count('draws', 2)
+            profiler.count('draws')
+        profiler.wrap(lambda: None, 'handler')()
+        profiler.end_frame()
+    assert [frame.index for frame in profiler.frames] == [2, 3, 4]
+    frame = profiler.frames[-1]
+    assert frame.counters == {'draws': 3}
+    inner, outer, handler = frame.events
+    assert (inner[0], inner[3]) == ('inner', 1)
+    assert (outer[0], outer[3], outer[5]) == ('outer', 0, {'i': 4})
+    assert outer[1] <= inner[1] and inner[2] <= outer[2]
+    summary = profiler.summary()
+    assert summary['inner']['calls'] == 3 and summary['frame']['calls'] == 3
+    assert summary['frame']['max'] >= summary['outer']['mean']
+
+    profiler.save_chrome_trace(tmp_path / 'trace.json')
+    with open(str(tmp_path / 'trace.json')) as f:
+        events = json.load(f)['traceEvents']
+    assert [e['name'] for e in events[:5]] == [
+        'frame', 'inner', 'outer', 'handler', 'counters'
+    ]
+    assert events[4]['ph'] == 'C' and events[4]['args'] == {'draws': 3}
+    assert all(e['ts'] >= 0.0 for e in events)
+
+def test_profile_software_renderer():
+    scene = Scene('scene')
+    scene.add_node(CameraNode(CameraPerspective(aspect=1.0), 'cam', position=(0.0, 0.0, 5.0)))
+    scene.add_node(Node('cube', CubeWired()))
+    quad = Mesh()
+    quad.primitive = Primitive.TRIANGLES
+    quad.positions = np.array([[-1, -1, 0], [1, -1, 0], [1, 1, 0], [-1, 1, 0]]).T
+    quad.indices = np.array([[0, 1, 2], [0, 2, 3]]).T
+    scene.add_node(Node('quad', quad))
+    renderer = SoftwareRenderer('r', scene, 'cam', size=(32, 32))
+    renderer.profiler.enabled = True
+    renderer.draw_handler()
+    frame = renderer.profiler.frames[-1]
+    names = [event[0] for event in frame.events]
+    for name in ['view_mat', 'cull', 'world_mats', 'geometry', 'cube', 'quad', 'rasterize']:
+        assert name in names
+    assert frame.counters == {'draws': 2, 'triangles': 2}
+    # the shared geometry of render_views is recorded in its first frame
+    views = [scene.nodes[0].view_mat()]*2
+    list(renderer.render_views(views))
+    first, second = [[event[0] for event in frame.events] for frame in list(renderer.profiler.frames)[-2:]]
+    assert 'scene_geometry' in first and 'scene_geometry' not in second
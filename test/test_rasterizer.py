@@ -0,0 +1,234 @@
+import numpy as np
+import pytest
+
+from nano3d.camera import CameraPerspective
+from nano3d.mesh import (
+    ChunkedMesh, CubeWired, DynamicMesh, InfiniteGrid, Line, Mesh, Polyline,
+    Primitive,
+)
+from nano3d.rasterizer import (
+    Frame, MissingCameraNodeError, SoftwareRenderer, clip_lines, clip_triangles,
+    load_ppm,
+)
+from nano3d.scene import CameraNode, InstancedNode, Node, Scene
+
+
+def colored_quad(color, size=1.0):
+    '''A square of side `size` on the xy plane made of 2 triangles.'''
+    mesh = Mesh()
+    mesh.primitive = Primitive.TRIANGLES
+    h = size/2.0
+    mesh.positions = np.array([[-h, -h, 0.0], [h, -h, 0.0], [h, h, 0.0], [-h, h, 0.0]]).T
+    mesh.colors = np.tile(np.array(color, dtype=np.float32), (4, 1)).T
+    mesh.indices = np.array([[0, 1, 2], [0, 2, 3]]).T
+    return mesh
+
+def make_scene():
+    scene = Scene('scene')
+    scene.add_node(CameraNode(CameraPerspective(aspect=1.0), 'cam', position=(0.0, 0.0, 5.0)))
+    return scene
+
+def test_missing_camera():
+    with pytest.raises(MissingCameraNodeError):
+        SoftwareRenderer('r', make_scene(), 'nope', size=(32, 32))
+
+def test_depth_test():
+    scene = make_scene()
+    # the far red quad is submitted last but must stay behind the green one
+    scene.add_node(Node('near', colored_quad((0.0, 1.0, 0.0, 1.0), 0.5), position=(0.0, 0.0, 1.0)))
+    scene.add_node(Node('far', colored_quad((1.0, 0.0, 0.0, 1.0), 2.0)))
+    renderer = SoftwareRenderer('r', scene, 'cam', size=(64, 64), tile_size=16)
+    renderer.draw_handler()
+    image = renderer.image()
+    assert list(image[32, 32]) == [0, 255, 0, 255]
+    assert list(image[32, 24]) == [255, 0, 0, 255]
+    assert list(image[0, 0]) == [26, 26, 26, 255]  # background
+    assert renderer.depth[32, 32] < renderer.depth[32, 24] < 1.0
+    assert renderer.depth[0, 0] == 1.0
+
+def test_tile_size_independent():
+    scene = make_scene()
+    scene.add_node(Node('quad', colored_quad((0.2, 0.4, 0.6, 1.0), 1.5), position=(0.2, -0.1, 0.0)))
+    scene.add_node(Node('cube', CubeWired(), position=(-1.0, -1.0, 0.0)))
+    images = []
+    for tile_size in [8, 13, 64]:
+        renderer = SoftwareRenderer('r', scene, 'cam', size=(50, 40), tile_size=tile_size)
+        renderer.draw_handler()
+        images.append(renderer.image())
+    assert (images[0] != images[0][0, 0]).any()
+    assert all((image == images[0]).all() for image in images[1:])
+
+def test_chunked_points():
+    scene = make_scene()
+    positions = np.array([[0.0, 0.0, 0.0], [0.5, 0.5, 0.0], [0.0, 0.0, 10.0]])
+    colors = np.ones((3, 4), dtype=np.float32)
+    scene.add_node(Node('points', ChunkedMesh(positions, colors=colors, chunk_size=2)))
+    renderer = SoftwareRenderer('r', scene, 'cam', size=(64, 64))
+    renderer.draw_handler()
+    lit = np.argwhere(renderer.image()[..., 0] == 255)
+    assert len(lit) == 2  # the third point is behind the camera
+    assert [32, 32] in lit.tolist()
+
+def test_clip_triangles():
+    # one vertex behind the near plane (z < -w) turns the triangle into two
+    clip = np.array([[[0.0, 0.0, 0.0, 1.0], [1.0, 0.0, 0.0, 1.0], [0.0, 1.0, -3.0, 1.0]]])
+    colors = np.ones((1, 3, 4))
+    clipped, _ = clip_triangles(clip, colors)
+    assert clipped.shape == (2, 3, 4)
+    assert np.all(clipped[..., 2] + clipped[..., 3] >= -1e-12)
+    # everything behind
+    clip[..., 2] = -3.0
+    clipped, _ = clip_triangles(clip, colors)
+    assert clipped.shape == (0, 3, 4)
+
+def test_clip_lines():
+    # a line starting far off screen is clipped to the viewport
+    clip = np.array([[[-2000.0, 0.0, 0.0, 1.0], [0.5, 0.0, 0.0, 1.0]]])
+    colors = np.ones((1, 2, 4))
+    clipped, _ = clip_lines(clip, colors)
+    assert np.allclose(clipped[0, :, 0], [-1.0, 0.5])
+    frame = Frame((640, 480))
+    frame._add_lines(clip, colors)
+    assert len(frame.frags[0][0]) >= 479
+    # orthographic lines on the near plane and lines completely outside
+    clip = np.array([
+        [[-0.5, 0.0, 0.0, 1.0], [0.5, 0.0, 0.0, 1.0]],
+        [[2.0, 0.0, 0.0, 1.0], [3.0, 0.5, 0.0, 1.0]],
+    ])
+    with np.errstate(all='raise'):
+        clipped, _ = clip_lines(clip, np.ones((2, 2, 4)))
+    assert np.array_equal(clipped, clip[:1])
+
+def test_workers_deterministic():
+    scene = make_scene()
+    rng = np.random.default_rng(0)
+    for i in range(20):
+        scene.add_node(Node(
+            'quad{}'.format(i), colored_quad(rng.uniform(size=4), rng.uniform(0.1, 1.0)),
+            position=rng.uniform(-1.0, 1.0, 3),
+        ))
+    images = []
+    for workers in [1, 4]:
+        renderer = SoftwareRenderer('r', scene, 'cam', size=(97, 80), tile_size=16, workers=workers)
+        renderer.draw_handler()
+        renderer.close()
+        images.append((renderer.color.copy(), renderer.depth.copy()))
+    assert (images[0][0] == images[1][0]).all()
+    assert (images[0][1] == images[1][1]).all()
+
+def test_render_views(tmp_path):
+    scene = make_scene()
+    camnode = scene.nodes[0]
+    scene.add_node(Node('quad', colored_quad((0.2, 0.4, 0.6, 1.0), 1.5)))
+    scene.add_node(Node('cube', CubeWired(), position=(-1.0, -1.0, 0.0)))
+    scene.add_node(Node('points', ChunkedMesh(np.zeros((5, 3)), chunk_size=2)))
+    renderer = SoftwareRenderer('r', scene, 'cam', size=(40, 30))
+    positions = [(0.0, 0.0, 5.0), (1.0, 0.5, 4.0), (-2.0, 0.0, 6.0)]
+    expected, views = [], []
+    for position in positions:
+        camnode.position = position
+        renderer.draw_handler()
+        expected.append(renderer.image())
+        views.append(camnode.view_mat())
+    images = list(renderer.render_views(np.array(views)))
+    assert len(images) == 3
+    assert all((a == b).all() for a, b in zip(images, expected))
+    assert not (images[0] == images[1]).all()
+
+    projections = np.array([renderer.projection]*3)
+    paths = renderer.write_views(views, tmp_path / 'out', projections)
+    assert [p.name for p in paths] == ['view00000.ppm', 'view00001.ppm', 'view00002.ppm']
+    assert all((load_ppm(p) == e[..., :3]).all() for p, e in zip(paths, expected))
+
+def test_render_views_chunked():
+    scene = make_scene()
+    quad = colored_quad((1.0, 0.5, 0.0, 1.0), 1.5)
+    scene.add_node(Node('chunked', ChunkedMesh(
+        quad.positions.T, quad.indices.T, quad.colors.T, Primitive.TRIANGLES, chunk_size=1,
+    )))
+    renderer = SoftwareRenderer('r', scene, 'cam', size=(32, 32))
+    renderer.draw_handler()
+    expected = renderer.image()
+    assert (expected[..., 0] == 255).sum() > 0
+    image, = renderer.render_views([scene.nodes[0].view_mat()])
+    assert (image == expected).all()
+
+def test_render_views_view_dependent():
+    scene = make_scene()
+    camnode = scene.nodes[0]
+    t = np.linspace(0.0, 8.0*np.pi, 20000)
+    line = Polyline(np.column_stack((np.cos(t), np.sin(t), np.zeros_like(t)))*(t/t[-1])[:, None])
+    grid = InfiniteGrid(extent=8, levels=2)
+    scene.add_node(Node('spiral', line))
+    scene.add_node(Node('grid', grid, position=(0.0, -1.0, 0.0)))
+    renderer = SoftwareRenderer('r', scene, 'cam', size=(32, 32))
+    expected, views = [], []
+    for position in [(0.0, 0.0, 5.0), (40.0, 0.0, 5.0)]:
+        camnode.position = position
+        renderer.draw_handler()
+        expected.append(renderer.image())
+        views.append(camnode.view_mat())
+    line._positions = None  # the full resolution points
+    images = list(renderer.render_views(views))
+    assert all((a == b).all() for a, b in zip(images, expected))
+    # decimated and following the last view
+    assert line._positions is None and grid.cell[0] == 40
+
+def test_instances():
+    scene = make_scene()
+    transforms = np.tile(np.eye(4), (3, 1, 1))
+    transforms[:, 0, -1] = (-1.0, 1.0, 30.0)  # the last one is out of view
+    colors = [(1.0, 0.0, 0.0, 1.0), (0.0, 0.0, 1.0, 1.0), (0.0, 1.0, 0.0, 1.0)]
+    scene.add_node(InstancedNode('quads', colored_quad((1.0, 1.0, 1.0, 1.0), 0.5), transforms, colors))
+    renderer = SoftwareRenderer('r', scene, 'cam', size=(64, 64))
+    renderer.draw_handler()
+    image = renderer.image()
+    assert list(image[32, 32]) == [26, 26, 26, 255]
+    assert list(image[32, 22]) == [255, 0, 0, 255]
+    assert list(image[32, 42]) == [0, 0, 255, 255]
+    (batch,) = renderer.render_views([scene.nodes[0].view_mat()])
+    assert (batch == image).all()
+
+def test_dynamic_mesh():
+    scene = make_scene()
+    trace = DynamicMesh(Primitive.POINTS, capacity=2)
+    scene.add_node(Node('trace', trace))
+    renderer = SoftwareRenderer('r', scene, 'cam', size=(32, 32))
+    renderer.draw_handler()
+    assert np.all(renderer.depth == 1.0)
+    trace.append([(0.0, 0.0, 0.0)])
+    renderer.draw_handler()
+    assert (renderer.depth < 1.0).sum() == 1
+    trace.append(np.column_stack((np.linspace(-1.0, 1.0, 9), np.zeros((9, 2)))))
+    renderer.draw_handler()
+    assert (renderer.depth < 1.0).sum() > 5
+
+def test_polyline():
+    # a long spiral, drawn decimated and at full resolution
+    t = np.linspace(0.0, 40.0*np.pi, 200000)
+    points = np.column_stack((np.cos(t), np.sin(t), np.zeros_like(t)))*(t/t[-1])[:, None]
+    images = []
+    for mesh in [Polyline(points, chunk_size=2**14), Line(points)]:
+        scene = make_scene()
+        scene.add_node(Node('spiral', mesh))
+        renderer = SoftwareRenderer('r', scene, 'cam', size=(64, 64))
+        renderer.draw_handler()
+        images.append(renderer.depth < 1.0)
+    mvp = renderer.projection @ renderer.camera_node.view_mat()
+    assert 10*len(Polyline(points).decimate(mvp, (64, 64))) < len(points)
+    assert (images[0] != images[1]).sum() <= 0.02*images[1].sum()
+
+def test_infinite_grid():
+    scene = make_scene()
+    grid = InfiniteGrid(extent=8, levels=2)
+    scene.add_node(Node('grid', grid, position=(0.0, -1.0, 0.0)))
+    renderer = SoftwareRenderer('r', scene, 'cam', size=(32, 32))
+    renderer.draw_handler()
+    assert grid.cell == (0, 1, 5)  # the camera position in the node space
+    covered = (renderer.depth < 1.0).sum()
+    assert covered > 0
+    renderer.camera_node.position += (1e5, 0.0, 0.0)
+    renderer.draw_handler()
+    assert grid.cell == (100000, 1, 5)
+    # up to float32 rounding of the far away positions
+    assert abs(int((renderer.depth < 1.0).sum()) - int(covered)) <= 0.02*covered
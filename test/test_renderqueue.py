@@ -0,0 +1,72 @@
+import numpy as np
+
+from nano3d.material import Material
+from nano3d.mesh import CubeWired
+from nano3d.profiler import Profiler
+from nano3d.renderqueue import RenderQueue
+
+
+class Recorder():
+    def __init__(self):
+        self.calls = []
+
+    def bind(self, shader):
+        self.calls.append(('bind', shader))
+
+    def set_uniform(self, shader, name, value):
+        self.calls.append(('uniform', shader, name))
+
+    def draw(self, shader, mesh):
+        self.calls.append(('draw', shader, mesh))
+
+
+def test_render_queue():
+    a, b = CubeWired(), CubeWired()
+    b.uniforms = {'light': np.ones(3)}
+    c = CubeWired()
+    c.material = Material('other')
+    c.material.fsh = c.material.fsh.replace('fColor', 'vec4(1.0)')
+    queue = RenderQueue()
+    # interleaved shaders, a and b share a program
+    queue.push('sa', a, np.eye(4), depth=5.0)
+    queue.push('sc', c, np.eye(4), depth=1.0)
+    queue.push('sb', b, np.eye(4), depth=3.0)
+    queue.push('sa', a, 2*np.eye(4), depth=2.0)
+    queue.push('sb', b, np.eye(4), depth=4.0, tint=(1.0, 0.0, 0.0, 1.0))
+    backend = Recorder()
+    stats = queue.submit(backend.bind, backend.set_uniform, backend.draw)
+    draws = [call[1] for call in backend.calls if call[0] == 'draw']
+    assert draws == ['sa', 'sa', 'sb', 'sb', 'sc']
+    assert [call[1] for call in backend.calls if call[0] == 'bind'] == ['sa', 'sb', 'sc']
+    # front to back within a shader
+    first = backend.calls.index(('draw', 'sa', a))
+    assert backend.calls[first - 2:first] == [('uniform', 'sa', 'mvp'), ('uniform', 'sa', 'tint')]
+    assert stats == {
+        'draws': 5, 'binds': 3, 'binds_skipped': 2,
+        # the 2nd draw of each shader skips the unchanged white tint (sa),
+        # light and identity mvp (sb)
+        'uniforms': 9, 'uniforms_skipped': 3,
+    }
+    assert len(queue) == 0
+
+def test_render_queue_profiler():
+    profiler = Profiler(enabled=True)
+    queue = RenderQueue(profiler)
+    queue.push('sa', CubeWired(), np.eye(4), depth=2.0, name='far')
+    queue.push('sa', CubeWired(), np.eye(4), depth=1.0, name='near')
+    backend = Recorder()
+    profiler.begin_frame()
+    queue.submit(backend.bind, backend.set_uniform, backend.draw)
+    profiler.end_frame()
+    assert [event[0] for event in profiler.frames[0].events] == ['near', 'far']
+
+def test_render_queue_drops_materials():
+    queue = RenderQueue()
+    mesh = CubeWired()
+    mesh.material = Material('transient')
+    queue.push('s', mesh, np.eye(4))
+    queue.submit(*[lambda *args: None]*3)
+    assert len(queue._materials) == 1
+    del mesh
+    assert len(queue._materials) == 0
+
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from nano3d.material import Material
+from nano3d.mesh import DynamicMesh
+from nano3d.resources import BufferRing, ResourceCache, program_key
+
+
+def test_resource_cache():
+    created, destroyed = [], []
+    def create(name):
+        created.append(name)
+        return name.upper()
+    cache = ResourceCache(create, destroyed.append)
+    assert cache.acquire('a', 'prop') == 'PROP'
+    assert cache.acquire('a', 'prop') == 'PROP'
+    assert cache.acquire('b', 'tree') == 'TREE'
+    assert created == ['prop', 'tree']
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert cache.references('a') == 2 and len(cache) == 2
+    assert not cache.release('a')
+    assert cache.release('a')
+    assert destroyed == ['PROP'] and 'a' not in cache
+    with pytest.raises(KeyError):
+        cache.release('a')
+    cache.clear()
+    assert destroyed == ['PROP', 'TREE'] and len(cache) == 0
+
+def test_program_key():
+    a, b, c = Material('a'), Material('b'), Material('c')
+    c.fsh = c.fsh.replace('fColor', 'vec4(1.0)')
+    assert program_key(a) == program_key(b)
+    assert program_key(a) != program_key(c)
+
+def test_buffer_ring():
+    mesh = DynamicMesh(capacity=16, buffers=3)
+    uploads = []
+    ring = BufferRing(
+        mesh, lambda mesh: [mesh.count],
+        lambda copy, mesh, start, stop: uploads.append((copy, start, stop)),
+    )
+    mesh.append(np.zeros((4, 3)))
+    first = ring.current()
+    assert ring.current() is first  # unchanged, no rotation
+    mesh.append(np.zeros((2, 3)))
+    second = ring.current()
+    mesh.append(np.zeros((2, 3)))
+    third = ring.current()
+    assert len(ring) == 3 and first[0] == 4
+    mesh.append(np.zeros((1, 3)))
+    # back to the first copy, which misses the last three appends
+    assert ring.current() is first and uploads == [(first, 4, 9)]
+    mesh.update(0, np.ones((1, 3)))
+    assert ring.current() is second and uploads[-1] == (second, 0, 9)
+    ring.free()
+    assert len(ring) == 0
@@ -4,8 +4,8 @@ import pytest
 import quaternion as qua
 
 from nano3d.camera import CameraPerspective
-from nano3d.mesh import Mesh
-from nano3d.scene import CameraFPSNode, Node
+from nano3d.mesh import CubeWired, Mesh
+from nano3d.scene import CameraFPSNode, InstancedNode, Node, Scene
 
 
 def test_node_position():
@@ -55,3 +55,112 @@ def test_node_scale():
         [0.0, 0.0, 0.0, 1.0],
     ], dtype=np.float32))
 
+
+def test_scene_model_mats():
+    scene = Scene('scene')
+    nodes = [Node('node{}'.format(i), Mesh()) for i in range(5)]
+    for i, node in enumerate(nodes):
+        node.position = (float(i), 2.0, 3.0)
+        node.scale = (1.0, 2.0, float(i + 1))
+        scene.add_node(node)
+    nodes[3].rotate(0.3, 0.2, 0.1)
+    nodes[4].position += (1.0, 1.0, 1.0)
+    mats = scene.model_mats()
+    assert mats.shape == (5, 4, 4)
+    for node, mat in zip(nodes, mats):
+        assert np.allclose(mat, node.model_mat(), atol=1e-6)
+    assert np.allclose(nodes[4].position, (5.0, 3.0, 4.0))
+
+def test_node_model_mat_cache():
+    node = Node('node', Mesh())
+    node.position = (1.0, 2.0, 3.0)
+    mat = node.model_mat()
+    assert np.shares_memory(mat, node.model_mat())
+    node.position += (1.0, 0.0, 0.0)
+    assert np.allclose(node.model_mat()[:-1, -1], (2.0, 2.0, 3.0))
+    node.scale = (2.0, 2.0, 2.0)
+    assert np.allclose(np.diag(node.model_mat()), (2.0, 2.0, 2.0, 1.0))
+
+def test_camera_view_mat_cache():
+    node = CameraFPSNode(name='cam', camera=CameraPerspective())
+    view = node.view_mat()
+    assert node.view_mat() is view
+    node.move_frwd(1.0)
+    assert np.allclose(node.view_mat()[:-1, -1], (0.0, 0.0, 1.0))
+    node.rotate_in_yy(np.pi/2.)
+    assert node.view_mat() is not view
+    assert np.allclose(node.view_mat()[:-1, :-1], node.rotation_mat()[:-1, :-1].T)
+
+def test_camera_view_mat_cache_parented():
+    rig = Node('rig', position=(0.0, 0.0, 5.0))
+    cam = CameraFPSNode(name='cam', camera=CameraPerspective())
+    rig.add_child(cam)
+    view = cam.view_mat()
+    assert np.allclose(view, np.linalg.inv(cam.world_mat()))
+    assert cam.view_mat() is view
+    # moving an ancestor only changes the world stamp of the camera
+    rig.position = (1.0, 0.0, 5.0)
+    assert cam.view_mat() is not view
+    assert np.allclose(cam.view_mat()[:-1, -1], (-1.0, 0.0, -5.0))
+    rig.remove_child(cam)
+    assert np.allclose(cam.view_mat(), np.eye(4))
+
+def test_scene_hierarchy_world_mats():
+    scene = Scene('scene')
+    car = Node('car', Mesh(), position=(10.0, 0.0, 0.0))
+    wheel = Node('wheel', Mesh(), position=(1.0, 0.0, 0.0))
+    bolt = Node('bolt', Mesh(), position=(0.0, 1.0, 0.0))
+    wheel.add_child(bolt)
+    car.add_child(wheel)
+    scene.add_node(Node('ground', Mesh()))
+    scene.add_node(car)
+    assert scene.nodes == [scene.nodes[0], car, wheel, bolt]
+    assert np.allclose(bolt.world_mat()[:-1, -1], (11.0, 1.0, 0.0))
+
+    car.rotate(0.0, np.pi/2., 0.0)
+    worlds = scene.world_mats()
+    for node in scene.nodes:
+        expected = node.model_mat()
+        parent = node.parent
+        while parent is not None:
+            expected = parent.model_mat() @ expected
+            parent = parent.parent
+        assert np.allclose(worlds[node._index], expected, atol=1e-6)
+
+    car.remove_child(wheel)
+    assert wheel.parent is None and wheel in scene.nodes
+    assert np.allclose(bolt.world_mat()[:-1, -1], (1.0, 1.0, 0.0))
+    with pytest.raises(ValueError):
+        bolt.add_child(wheel)
+
+def test_instanced_node():
+    transforms = np.tile(np.eye(4), (2, 1, 1))
+    transforms[1, :-1, -1] = (3.0, 0.0, -1.0)
+    node = InstancedNode('cubes', CubeWired(), transforms, position=(1.0, 0.0, 0.0))
+    assert node.count == 2
+    assert np.allclose(node.colors, 1.0)
+    assert np.allclose(node.aabb(), [[0.0, 0.0, -1.0], [4.0, 1.0, 1.0]])
+    mats = node.instance_mats()
+    assert np.allclose(mats[1][:-1, -1], (4.0, 0.0, -1.0))
+    assert np.allclose(node.instance_aabbs(mats)[1], [[4.0, 0.0, -1.0], [5.0, 1.0, 0.0]])
+    with pytest.raises(ValueError):
+        node.set_instances(np.eye(4))
+    with pytest.raises(ValueError):
+        node.set_instances(transforms, np.ones((3, 4)))
+
+def test_scene_remove_node():
+    scene = Scene('scene')
+    car = Node('car', Mesh(), position=(10.0, 0.0, 0.0))
+    wheel = Node('wheel', Mesh(), position=(1.0, 0.0, 0.0))
+    car.add_child(wheel)
+    scene.add_node(Node('ground', Mesh()))
+    scene.add_node(car)
+    topology = scene.transforms.topology
+    scene.remove_node(car)
+    assert [node.name for node in scene.nodes] == ['ground']
+    assert scene.transforms.topology != topology
+    assert np.allclose(wheel.world_mat()[:-1, -1], (11.0, 0.0, 0.0))
+    with pytest.raises(ValueError):
+        scene.remove_node(car)
+    scene.add_node(car)
+    assert scene.nodes[1:] == [car, wheel]